@@ -0,0 +1,10 @@
+# -*- coding: UTF-8 -*-
+"""
+benchmarks of the task flow lifecycle, run:
+
+    python -m benchmarks --flows 10000 --depth 3 --fan-out 2 --diamond --output result.json
+
+and compare the results of two versions:
+
+    python -m benchmarks.compare old.json new.json
+"""
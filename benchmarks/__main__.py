@@ -0,0 +1,3 @@
+from benchmarks.lifecycle import main
+
+main()
@@ -0,0 +1,31 @@
+# -*- coding: UTF-8 -*-
+"""
+compare two results of the benchmark, e.g.
+
+    python -m benchmarks.compare old.json new.json
+"""
+import json
+import sys
+
+from benchmarks.lifecycle import OPERATIONS
+
+
+def compare(old, new, out=sys.stdout):
+    out.write('%-10s %12s %12s %8s %10s %10s %8s %8s\n' % (
+        'operation', 'old ops/sec', 'new ops/sec', 'ratio', 'old p99', 'new p99', 'reads', 'writes'))
+    for operation in OPERATIONS:
+        old_stats = old['operations'].get(operation, {})
+        new_stats = new['operations'].get(operation, {})
+        if not old_stats.get('count') or not new_stats.get('count'):
+            continue
+        old_ops, new_ops = old_stats['ops_per_sec'] or 0, new_stats['ops_per_sec'] or 0
+        out.write('%-10s %12.1f %12.1f %8.2f %10.3f %10.3f %+8.2f %+8.2f\n' % (
+            operation, old_ops, new_ops, new_ops / old_ops if old_ops else 0,
+            old_stats['latency_ms']['p99'], new_stats['latency_ms']['p99'],
+            new_stats['reads_per_op'] - old_stats['reads_per_op'],
+            new_stats['writes_per_op'] - old_stats['writes_per_op']))
+
+
+if __name__ == '__main__':
+    with open(sys.argv[1]) as old, open(sys.argv[2]) as new:
+        compare(json.load(old), json.load(new))
@@ -0,0 +1,73 @@
+# -*- coding: UTF-8 -*-
+from lite_task_flow.backends import Backend
+
+
+class CountingBackend(Backend):
+    """
+    a backend counts the round trips (reads and writes) to the backend it
+    wraps, e.g. a batch update is one write
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.reads = 0
+        self.writes = 0
+
+    def get(self, id_):
+        self.reads += 1
+        return self.backend.get(id_)
+
+    def get_many(self, ids):
+        self.reads += 1
+        return self.backend.get_many(ids)
+
+    def get_task(self, task_flow_id, tag):
+        self.reads += 1
+        return self.backend.get_task(task_flow_id, tag)
+
+    def get_tasks(self, keys):
+        self.reads += 1
+        return self.backend.get_tasks(keys)
+
+    def get_task_flow_tasks(self, task_flow_id):
+        self.reads += 1
+        return self.backend.get_task_flow_tasks(task_flow_id)
+
+    def iter_task_flow_ids(self, status=None, failed=None, root_task_cls=None, batch_size=100):
+        self.reads += 1
+        return self.backend.iter_task_flow_ids(status, failed, root_task_cls, batch_size)
+
+    def iter_pending_task_ids(self, task_cls, batch_size=100):
+        self.reads += 1
+        return self.backend.iter_pending_task_ids(task_cls, batch_size)
+
+    def iter_queue_item_ids(self, status, batch_size=100):
+        self.reads += 1
+        return self.backend.iter_queue_item_ids(status, batch_size)
+
+    def iter_hook_event_ids(self, status, batch_size=100):
+        self.reads += 1
+        return self.backend.iter_hook_event_ids(status, batch_size)
+
+    def iter_timer_ids(self, status, batch_size=100):
+        self.reads += 1
+        return self.backend.iter_timer_ids(status, batch_size)
+
+    def insert(self, doc):
+        self.writes += 1
+        return self.backend.insert(doc)
+
+    def insert_many(self, docs, defer_indexes=False):
+        self.writes += 1
+        return self.backend.insert_many(docs, defer_indexes)
+
+    def deferred_indexes(self):
+        return self.backend.deferred_indexes()
+
+    def update(self, doc):
+        self.writes += 1
+        return self.backend.update(doc)
+
+    def update_many(self, docs, inserts=()):
+        self.writes += 1
+        return self.backend.update_many(docs, inserts)
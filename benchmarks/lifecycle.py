@@ -0,0 +1,209 @@
+# -*- coding: UTF-8 -*-
+"""
+measure the throughput and latency of each step of the task flow lifecycle:
+create ('new_task_flow'), start, approve (until all the tasks are approved),
+execute and refuse. the engine executes in background (see
+TaskFlowEngine.background_execution), so the last approval enqueues the task
+flow instead of executing it, and the executions are measured on their own
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+from datetime import datetime
+from timeit import default_timer
+
+import lite_task_flow
+from lite_task_flow import TaskFlowEngine, new_task_flow
+from lite_task_flow.exceptions import TaskFlowDelayed
+from lite_task_flow.backends.memory import MemoryBackend
+
+from benchmarks import shapes
+from benchmarks.counting import CountingBackend
+
+OPERATIONS = ['create', 'start', 'approve', 'execute', 'refuse']
+
+
+def percentile(sorted_values, p):
+    """
+    :param sorted_values: a non-empty sorted list
+    :param p: 0 ~ 100
+    """
+    index = int(round(p / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+class Recorder(object):
+    """
+    record the latency and the storage round trips of each operation
+    """
+
+    def __init__(self, backend):
+        """
+        :type backend: benchmarks.counting.CountingBackend
+        """
+        self.backend = backend
+        self.latencies = dict((operation, []) for operation in OPERATIONS)
+        self.reads = dict.fromkeys(OPERATIONS, 0)
+        self.writes = dict.fromkeys(OPERATIONS, 0)
+
+    def measure(self, operation, fn, *args):
+        """
+        perform fn and record it as an 'operation'
+
+        :return: the exception raised by fn, None if nothing is raised
+        """
+        reads, writes = self.backend.reads, self.backend.writes
+        start = default_timer()
+        error = None
+        try:
+            fn(*args)
+        except TaskFlowDelayed as e:
+            error = e
+        self.latencies[operation].append(default_timer() - start)
+        self.reads[operation] += self.backend.reads - reads
+        self.writes[operation] += self.backend.writes - writes
+        return error
+
+    def stats(self, operation):
+        latencies = sorted(self.latencies[operation])
+        count = len(latencies)
+        if not count:
+            return dict(count=0)
+        seconds = sum(latencies)
+        return dict(count=count,
+                    seconds=seconds,
+                    ops_per_sec=count / seconds if seconds else None,
+                    latency_ms=dict((name, percentile(latencies, p) * 1000)
+                                    for name, p in [('p50', 50), ('p90', 90), ('p99', 99),
+                                                    ('max', 100)]),
+                    reads_per_op=float(self.reads[operation]) / count,
+                    writes_per_op=float(self.writes[operation]) / count)
+
+
+def open_backend(name, path):
+    if name == 'memory':
+        return MemoryBackend()
+    if name == 'sqlite':
+        from lite_task_flow.backends.sqlite import SQLiteBackend
+        return SQLiteBackend(path + '/task_flow.db')
+    if name == 'codernity':
+        from CodernityDB.database import Database
+        from lite_task_flow.indexes import add_index
+        from lite_task_flow.backends.codernity import CodernityBackend
+        db = Database(path)
+        db.create()
+        add_index(db)
+        return CodernityBackend(db)
+    raise ValueError('unknown backend: ' + name)
+
+
+def open_sharded_backend(name, path, shards):
+    from lite_task_flow.backends.sharded import ShardedBackend
+    backends = []
+    for i in xrange(shards):
+        shard_path = '%s/%d' % (path, i)
+        os.mkdir(shard_path)
+        backends.append(open_backend(name, shard_path))
+    return ShardedBackend(backends)
+
+
+def run(flows, depth, fan_out, diamond=False, backend='memory', shards=1):
+    """
+    run the lifecycle of 'flows' task flows of the shape
+
+    :param shards: if greater than 1, the task flows are spread over this
+        number of backends
+    :return: the result, which could be dumped as JSON
+    """
+    path = tempfile.mkdtemp()
+    try:
+        if shards > 1:
+            counting_backend = CountingBackend(open_sharded_backend(backend, path, shards))
+        else:
+            counting_backend = CountingBackend(open_backend(backend, path))
+        TaskFlowEngine(counting_backend, background_execution=True)
+        task_cls = shapes.task_cls(depth, fan_out, diamond)
+        recorder = Recorder(counting_backend)
+
+        task_flows = []
+        for i in xrange(flows):
+            recorder.measure('create', lambda: task_flows.append(new_task_flow(task_cls)))
+
+        pending = []
+        for task_flow in task_flows:
+            e = recorder.measure('start', task_flow.start)
+            if e is not None:
+                pending.append((task_flow, e.task))
+        while pending:
+            delayed = []
+            for task_flow, task in pending:
+                e = recorder.measure('approve', task_flow.approve, task)
+                if e is not None:
+                    delayed.append((task_flow, e.task))
+            pending = delayed
+
+        for task_flow in task_flows:
+            recorder.measure('execute', task_flow.execute)
+
+        for i in xrange(flows):
+            task_flow = new_task_flow(task_cls)
+            try:
+                task_flow.start()
+                task = task_flow.root_task
+            except TaskFlowDelayed as e:
+                task = e.task
+            recorder.measure('refuse', task_flow.refuse, task)
+    finally:
+        shutil.rmtree(path)
+
+    return dict(version=lite_task_flow.__version__,
+                python=platform.python_version(),
+                time=datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                backend=backend,
+                shards=shards,
+                flows=flows,
+                shape=dict(depth=depth, fan_out=fan_out, diamond=diamond,
+                           tasks=shapes.size(depth, fan_out, diamond)),
+                operations=dict((operation, recorder.stats(operation)) for operation in OPERATIONS))
+
+
+def report(result, out=sys.stdout):
+    shape = result['shape']
+    out.write('%d flows, depth %d, fan out %d%s (%d tasks), %s backend%s\n' % (
+        result['flows'], shape['depth'], shape['fan_out'], ', diamond' if shape['diamond'] else '',
+        shape['tasks'], result['backend'],
+        ' x %d shards' % result['shards'] if result.get('shards', 1) > 1 else ''))
+    out.write('%-10s %8s %12s %10s %10s %10s %8s %8s\n' % (
+        'operation', 'count', 'ops/sec', 'p50 ms', 'p90 ms', 'p99 ms', 'reads', 'writes'))
+    for operation in OPERATIONS:
+        stats = result['operations'][operation]
+        if not stats['count']:
+            continue
+        out.write('%-10s %8d %12.1f %10.3f %10.3f %10.3f %8.2f %8.2f\n' % (
+            operation, stats['count'], stats['ops_per_sec'] or 0, stats['latency_ms']['p50'],
+            stats['latency_ms']['p90'], stats['latency_ms']['p99'], stats['reads_per_op'],
+            stats['writes_per_op']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--flows', type=int, default=10000, help='the number of task flows')
+    parser.add_argument('--depth', type=int, default=3, help='the number of levels of a task flow')
+    parser.add_argument('--fan-out', type=int, default=2,
+                        help='the number of tasks each task depends on')
+    parser.add_argument('--diamond', action='store_true',
+                        help='the tasks of a level share their dependencies')
+    parser.add_argument('--backend', choices=['memory', 'sqlite', 'codernity'], default='memory')
+    parser.add_argument('--shards', type=int, default=1, help='the number of the shards of the backend')
+    parser.add_argument('--output', help='write the result as JSON to this file')
+    args = parser.parse_args(argv)
+
+    result = run(args.flows, args.depth, args.fan_out, args.diamond, args.backend, args.shards)
+    report(result)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2, sort_keys=True)
@@ -0,0 +1,65 @@
+# -*- coding: UTF-8 -*-
+"""
+synthetic task classes of configurable shapes
+"""
+from lite_task_flow import Task, register_task_cls
+
+
+class SyntheticTask(Task):
+    """
+    a node of a layered dependency graph, it's identified by its level and its
+    index in the level, the root is (0, 0).
+
+    in a tree, a node of level l depends on 'fan_out' nodes of level l + 1 of
+    its own. in a diamond, all the nodes of level l depend on the same
+    'fan_out' nodes of level l + 1
+    """
+
+    depth = 1
+    fan_out = 1
+    diamond = False
+
+    @property
+    def level(self):
+        return self.extra_params.get('level', 0)
+
+    @property
+    def index(self):
+        return self.extra_params.get('index', 0)
+
+    @property
+    def tag(self):
+        return 'n%d_%d' % (self.level, self.index)
+
+    @property
+    def dependencies(self):
+        if self.level + 1 >= self.depth:
+            return []
+        if self.diamond:
+            indexes = xrange(self.fan_out)
+        else:
+            indexes = xrange(self.index * self.fan_out, (self.index + 1) * self.fan_out)
+        return [self.__class__(self.task_flow, level=self.level + 1, index=index) for index in indexes]
+
+
+def task_cls(depth, fan_out, diamond=False):
+    """
+    create (and register) the task class of the shape
+
+    :param depth: the number of levels
+    :param fan_out: the number of nodes each node depends on
+    :param diamond: if the nodes of a level share their dependencies
+    """
+    name = 'Synthetic%s_%d_%d' % ('Diamond' if diamond else 'Tree', depth, fan_out)
+    cls = type(name, (SyntheticTask,), dict(depth=depth, fan_out=fan_out, diamond=diamond))
+    register_task_cls(cls)
+    return cls
+
+
+def size(depth, fan_out, diamond=False):
+    """
+    :return: the number of the tasks of a task flow of the shape
+    """
+    if diamond:
+        return 1 + fan_out * (depth - 1)
+    return sum(fan_out ** level for level in xrange(depth))
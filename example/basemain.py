@@ -12,7 +12,7 @@ from CodernityDB.database import Database
 from CodernityDB.hash_index import HashIndex
 from sqlalchemy.orm.exc import NoResultFound
 
-from lite_task_flow import TaskFlowEngine, Task, new_task_flow, exceptions, constants, get_task_flow, register_task_cls, get_task
+from lite_task_flow import TaskFlowEngine, Task, new_task_flow, exceptions, constants, get_tasks, register_task_cls, get_task, pending_tasks
 
 app = Flask(__name__)
 app.config['DEBUG'] = True
@@ -53,6 +53,8 @@ class PermitTravel(Task):
     def tag(self):
         return "PERMIT_TRAVEL"
 
+register_task_cls(PermitTravel)
+
 @app.route("/")
 def index():
     return redirect(url_for('task_list'))
@@ -108,22 +110,25 @@ def task():
 @login_required
 def task_list():
     if current_user.group.name == 'Customers':
-        task_list = (task for task in db.get_many('task_with_initiator', current_user, limit=-1, with_doc=True) if task['doc']['extra_params']['username'] == current_user.username)
+        task_ids = [task['_id'] for task in db.get_many('task_with_initiator', current_user, limit=-1, with_doc=True) if task['doc']['extra_params']['username'] == current_user.username]
+        tasks = get_tasks(task_ids)
+        task_list = [tasks[task_id] for task_id in task_ids]
     else:
-        task_list = db.all('permit_travel', with_doc=True)
+        # the applications waiting for permitting
+        task_list = pending_tasks(PermitTravel)
     def _to_dict(task):
 
         return {
-            "id_": task['_id'],
-            "create_time": datetime.strptime(task['create_time'], "%Y-%m-%d %H:%M:%S"),
-            "approved": task['approved'],
-            "approve_time": task.get('approve_time'),
-            "username": task['extra_params']['username'],
-            "destination": task['extra_params']['destination'],
-            'contact': task['extra_params']['contact'],
-            'task_flow': get_task_flow(task['task_flow_id']),
+            "id_": task.id_,
+            "create_time": datetime.strptime(task.create_time, "%Y-%m-%d %H:%M:%S"),
+            "approved": task.approved,
+            "approve_time": task.approved_time,
+            "username": task.extra_params['username'],
+            "destination": task.extra_params['destination'],
+            'contact': task.extra_params['contact'],
+            'task_flow': task.task_flow,
         }
-    return render_template('/task-list.html', task_list=(_to_dict(task['doc']) for task in task_list), constants=constants)
+    return render_template('/task-list.html', task_list=(_to_dict(task) for task in task_list), constants=constants)
 
 @app.route('/process-task/<id_>', methods=['POST'])
 @login_required
@@ -39,23 +39,9 @@ class TaskWithIntiator(HashIndex):
     def make_key(self, key):
         return md5(key.username).digest()
 
-class PermitTravelIndex(HashIndex):
-
-    def __init__(self, *args, **kwargs):
-        kwargs['key_format'] = 'I'
-        super(PermitTravelIndex, self).__init__(*args, **kwargs)
-    
-    def make_key_value(self, data):
-        if data['t'] == constants.TASK_TYPE_CODE and data['tag'] == 'PERMIT_TRAVEL':
-            return 0, None
-   
-    def make_key(self, key):
-        return 0
-
 codernity_db = Database('db')
 codernity_db.create()
 codernity_db.add_index(TaskWithIntiator(codernity_db.path, 'task_with_initiator'))
-codernity_db.add_index(PermitTravelIndex(codernity_db.path, 'permit_travel'))
 from lite_task_flow.indexes import add_index
 add_index(codernity_db)
 
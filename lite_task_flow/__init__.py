@@ -4,5 +4,8 @@ __version__ = "0.9.0"
 
 from lite_task_flow.task import Task
 from lite_task_flow.task_flow_engine import TaskFlowEngine
-from lite_task_flow.functions import (new_task_flow, get_task_flow,
-                                        register_task_cls, get_task, get_task_from_doc)
+from lite_task_flow.async_task_flow import AsyncTask, AsyncTaskFlow
+from lite_task_flow.functions import (new_task_flow, get_task_flow, get_task_flows,
+                                        register_task_cls, get_task, get_tasks,
+                                        get_task_from_doc, list_task_flows, pending_tasks,
+                                        approve_many, new_task_flows)
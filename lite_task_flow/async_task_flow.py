@@ -0,0 +1,301 @@
+# -*- coding: UTF-8 -*-
+"""
+the asynchronous api of task flow, the operations return futures instead of
+blocking the calling thread.
+
+all the storage access and hooks of all the asynchronous task flows are
+performed in one thread (TaskFlowEngine.storage_executor), the bodies of the
+tasks are performed in the engine's executor (or in the storage thread if
+there's no executor), and the bodies of AsyncTask are performed without
+occupying any thread, so thousands of in-flight task flows could share a few
+threads.
+"""
+import threading
+
+from concurrent.futures import Future
+
+from lite_task_flow.task import Task
+from lite_task_flow.task_flow_engine import TaskFlowEngine
+from lite_task_flow.execution_plan import ExecutionProgress, submit_task
+from lite_task_flow import constants
+from lite_task_flow.exceptions import TaskFlowRefused, TaskFlowProcessing
+
+_hook_futures = threading.local()
+
+
+def gather(futures):
+    """
+    :return: a future done when all the futures are done, its result is the
+        list of the futures' results, or the first exception raised
+    """
+    ret = Future()
+    futures = list(futures)
+    if not futures:
+        ret.set_result([])
+        return ret
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def _done(future):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0]:
+                return
+        for future in futures:
+            if future.exception() is not None:
+                ret.set_exception(future.exception())
+                return
+        ret.set_result([future.result() for future in futures])
+
+    for future in futures:
+        future.add_done_callback(_done)
+    return ret
+
+
+def _transfer(source, target):
+    """
+    resolve the future 'target' with the result of the future 'source' (done)
+    """
+    if source.exception() is not None:
+        target.set_exception(source.exception())
+    else:
+        target.set_result(source.result())
+
+
+def _as_future(fn, *args):
+    """
+    call fn, if it returns a future, return it, else return a future resolved
+    with the result (or exception) of the call
+    """
+    ret = Future()
+    try:
+        result = fn(*args)
+    except Exception as e:
+        ret.set_exception(e)
+        return ret
+    if isinstance(result, Future):
+        return result
+    ret.set_result(result)
+    return ret
+
+
+class AsyncTask(Task):
+    """
+    a task whose body and hooks could be asynchronous, namely '__call__',
+    'on_approved', 'on_delayed', 'on_refused' and 'after_executed' could return
+    futures, the task flow waits for them without occupying any thread.
+
+    note, '__call__' is invoked in the storage thread, so it should NOT block
+    """
+
+    def invoke_hook(self, hook, *args):
+        ret = super(AsyncTask, self).invoke_hook(hook, *args)
+        if isinstance(ret, Future):
+            futures = getattr(_hook_futures, 'futures', None)
+            if futures is not None:
+                futures.append(ret)
+        return ret
+
+
+class _Operation(object):
+    """
+    an asynchronous operation on a task flow, all of its steps are performed in
+    the storage thread, and it's done after all the futures returned by the
+    hooks are done
+    """
+
+    def __init__(self):
+        self.result = Future()
+        self.hook_futures = []
+
+    def submit(self, fn, *args):
+        """
+        perform fn in the storage thread
+
+        :return: a future of fn's result, if fn returns a future, it's chained
+        """
+        ret = Future()
+
+        def _run():
+            _hook_futures.futures = self.hook_futures
+            try:
+                result = _as_future(fn, *args)
+            finally:
+                _hook_futures.futures = None
+            result.add_done_callback(lambda f: _transfer(f, ret))
+
+        TaskFlowEngine.instance.storage_executor.submit(_run)
+        return ret
+
+    def then(self, future, fn):
+        """
+        perform fn(future) in the storage thread when the future is done
+
+        :return: a future of fn's result
+        """
+        ret = Future()
+        future.add_done_callback(lambda f: self.submit(fn, f).add_done_callback(
+            lambda f_: _transfer(f_, ret)))
+        return ret
+
+    def finish(self, future):
+        """
+        finish the operation when the future and the futures of the hooks are
+        done
+
+        :return: the result future of the operation
+        """
+        def _done(f):
+            gather(self.hook_futures).add_done_callback(
+                lambda hooks: _transfer(hooks if f.exception() is None and
+                                        hooks.exception() is not None else f,
+                                        self.result))
+
+        future.add_done_callback(_done)
+        return self.result
+
+
+class _AsyncExecution(object):
+    """
+    execute an execution plan asynchronously, when a task fails, no more tasks
+    will be performed, and the first exception is raised after the running tasks
+    finish
+    """
+
+    def __init__(self, operation, plan, executor):
+        self.operation = operation
+        self.plan = plan
+        self.executor = executor
+        self.progress = ExecutionProgress(plan)
+        self.running = 0
+        self.error = None
+        self.result = Future()
+
+    def start(self):
+        """
+        should be invoked in the storage thread
+
+        :return: a future done when all the tasks are executed
+        """
+        self._run(self.progress.ready())
+        return self.result
+
+    def _run(self, tags):
+        tags = list(tags)
+        while tags and self.error is None:
+            task = self.plan.tasks[tags.pop(0)]
+            if not self.plan.should_perform(task):
+                tags.extend(self.progress.release(task.tag))
+                continue
+            self.running += 1
+            self.operation.then(self._perform(task), lambda body, task=task: self._record(task, body))
+        if not self.running:
+            if self.error is not None:
+                self.result.set_exception(self.error)
+            else:
+                self.result.set_result(None)
+
+    def _perform(self, task):
+        """
+        :return: a future of the task's body
+        """
+        if isinstance(task, AsyncTask):
+            return _as_future(task.perform)
+        if self.executor is not None:
+            return submit_task(self.executor, task)
+        return _as_future(task.perform)
+
+    def _record(self, task, body):
+        self.running -= 1
+        try:
+            self.plan.perform(task, body.result)
+        except Exception as e:
+            if self.error is None:
+                self.error = e
+            released = []
+        else:
+            released = self.progress.release(task.tag)
+        self._run(released)
+
+
+class AsyncTaskFlow(object):
+    """
+    the asynchronous counterpart of TaskFlow, each operation returns a future
+    resolved with what the operation of TaskFlow returns or raises
+    """
+
+    def __init__(self, task_flow):
+        """
+        :type task_flow: lite_task_flow.task_flow.TaskFlow
+        """
+        self.task_flow = task_flow
+
+    def start(self):
+        """
+        start the task flow
+
+        :rtype: concurrent.futures.Future
+        """
+        return self._perform(self._approve, self.task_flow.root_task)
+
+    def approve(self, task):
+        """
+        approve the task
+
+        :rtype: concurrent.futures.Future
+        """
+        return self._perform(self._approve, task)
+
+    def refuse(self, task):
+        """
+        refuse the task flow
+
+        :rtype: concurrent.futures.Future
+        """
+        return self._perform(lambda operation: self.task_flow.refuse(task))
+
+    def execute(self, executor=None):
+        """
+        execute the task flow
+
+        :rtype: concurrent.futures.Future
+        """
+        return self._perform(self._execute, executor)
+
+    def _perform(self, fn, *args):
+        operation = _Operation()
+        return operation.finish(operation.submit(fn, operation, *args))
+
+    def _approve(self, operation, task):
+        # the approval is written in a session, and performed again after the
+        # task flow is refreshed if it conflicts, as TaskFlow.approve does
+        task_docs = self.task_flow._transact(self._check_approval, task)
+        if TaskFlowEngine.instance.background_execution:
+            # enqueued along with the approval
+            return
+        return self._execute_plan(operation, TaskFlowEngine.instance.executor, task_docs)
+
+    def _check_approval(self, task):
+        task.approve()
+        return self.task_flow._check_all_approved(task)
+
+    def _execute(self, operation, executor):
+        if self.task_flow.status == constants.TASK_FLOW_REFUSED:
+            raise TaskFlowRefused()
+        elif self.task_flow.status == constants.TASK_FLOW_PROCESSING:
+            raise TaskFlowProcessing()
+        return self._execute_plan(operation, executor or TaskFlowEngine.instance.executor)
+
+    def _execute_plan(self, operation, executor, task_docs=None):
+        execution = _AsyncExecution(operation, self.task_flow.execution_plan(task_docs), executor)
+        return operation.then(execution.start(), self._executed)
+
+    def _executed(self, execution):
+        task_flow = self.task_flow
+        if execution.exception() is not None:
+            task_flow.failed = True
+            task_flow.update()
+            raise execution.exception()
+        task_flow.failed = False
+        task_flow.status = constants.TASK_FLOW_EXECUTED
+        task_flow.update()
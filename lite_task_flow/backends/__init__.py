@@ -0,0 +1,168 @@
+# -*- coding: UTF-8 -*-
+from contextlib import contextmanager
+
+from lite_task_flow.exceptions import DocumentNotFound
+
+
+class Backend(object):
+    """
+    the storage of the documents of task flows and tasks.
+
+    a document is a dict, it has an id ('_id') and a revision ('_rev'), a task
+    flow's document has 't' == constants.TASK_FLOW_TYPE_CODE, a task's
+    document has 't' == constants.TASK_TYPE_CODE
+    """
+
+    def get(self, id_):
+        """
+        :raise DocumentNotFound: if there's no such document
+        """
+        raise NotImplementedError
+
+    def get_many(self, ids):
+        """
+        :return: a dict of documents indexed by id, the ids not found are absent
+        """
+        ret = {}
+        for id_ in ids:
+            try:
+                ret[id_] = self.get(id_)
+            except DocumentNotFound:
+                pass
+        return ret
+
+    def get_task(self, task_flow_id, tag):
+        """
+        get the document of the task by task flow id and tag
+
+        :raise DocumentNotFound: if there's no such document
+        """
+        raise NotImplementedError
+
+    def get_tasks(self, keys):
+        """
+        :param keys: (task flow id, tag) pairs
+        :return: a dict of task documents indexed by (task flow id, tag), the
+            pairs not found are absent
+        """
+        ret = {}
+        for key in keys:
+            try:
+                ret[key] = self.get_task(*key)
+            except DocumentNotFound:
+                pass
+        return ret
+
+    def get_task_flow_tasks(self, task_flow_id):
+        """
+        get all the task documents of the task flow in one scan, note, the
+        documents may have no revision
+
+        :return: a list of task documents
+        """
+        raise NotImplementedError
+
+    def iter_task_flow_ids(self, status=None, failed=None, root_task_cls=None, batch_size=100,
+                           keyed=False):
+        """
+        iterate over the ids of the task flows ordered by status, failed and
+        create time, by pages of 'batch_size' entries
+
+        :param status: only the task flows of this status if provided
+        :param failed: only the task flows (not) failed if provided
+        :param root_task_cls: only the task flows of this root task's class
+            (name) if provided
+        :param keyed: if True, iterate over (the time ordered by, id) read from
+            the index instead, so the results of several backends could be
+            merged without reading the documents
+        """
+        raise NotImplementedError
+
+    def iter_pending_task_ids(self, task_cls, batch_size=100, keyed=False):
+        """
+        iterate over the ids of the tasks submitted but neither approved nor
+        refused, ordered by create time, by pages of 'batch_size' entries
+
+        :param task_cls: the tasks' class (name)
+        :param keyed: see 'iter_task_flow_ids'
+        """
+        raise NotImplementedError
+
+    def iter_queue_item_ids(self, status, batch_size=100, keyed=False):
+        """
+        iterate over the ids of the items of the execution queue of the status,
+        ordered by create time, by pages of 'batch_size' entries
+
+        :param status: constants.QUEUE_ITEM_QUEUED, QUEUE_ITEM_CLAIMED, etc.
+        :param keyed: see 'iter_task_flow_ids'
+        """
+        raise NotImplementedError
+
+    def iter_hook_event_ids(self, status, batch_size=100, keyed=False):
+        """
+        iterate over the ids of the hook events (see lite_task_flow.hooks) of
+        the status, ordered by due time, by pages of 'batch_size' entries
+
+        :param status: constants.HOOK_EVENT_QUEUED, HOOK_EVENT_CLAIMED, etc.
+        :param keyed: see 'iter_task_flow_ids'
+        """
+        raise NotImplementedError
+
+    def iter_timer_ids(self, status, batch_size=100, keyed=False):
+        """
+        iterate over the ids of the timers (see lite_task_flow.scheduler) of
+        the status, ordered by due time, by pages of 'batch_size' entries
+
+        :param status: constants.TIMER_PENDING, TIMER_FIRED, etc.
+        :param keyed: see 'iter_task_flow_ids'
+        """
+        raise NotImplementedError
+
+    def insert(self, doc):
+        """
+        insert the document, '_id' (if absent) and '_rev' of the document are set
+
+        :return: a dict contains '_id' and '_rev' of the document
+        """
+        raise NotImplementedError
+
+    def insert_many(self, docs, defer_indexes=False):
+        """
+        insert the documents, in one transaction if the backend supports, see
+        'insert'
+
+        :param defer_indexes: if True, the documents may be indexed when the
+            enclosing 'deferred_indexes' exits instead, it should be invoked in
+            one
+        :return: a list of dicts contain '_id' and '_rev' of the documents
+        """
+        return [self.insert(doc) for doc in docs]
+
+    @contextmanager
+    def deferred_indexes(self):
+        """
+        a context manager for bulk loading, the indexes are not updated when the
+        documents are inserted in it (see 'insert_many'), but built in one pass
+        when it exits. so the queries may miss the documents inserted before it
+        exits. it has no effect if the backend doesn't support it
+        """
+        yield
+
+    def update(self, doc):
+        """
+        update the document, '_rev' of the document is set to the new revision
+
+        :raise DocumentConflict: if '_rev' of the document is not the latest
+        :return: a dict contains '_id' and '_rev' of the document
+        """
+        raise NotImplementedError
+
+    def update_many(self, docs, inserts=()):
+        """
+        update the documents, and insert the documents 'inserts' (see
+        'insert_many') after, in one transaction if the backend supports
+        """
+        for doc in docs:
+            self.update(doc)
+        if inserts:
+            self.insert_many(inserts)
@@ -0,0 +1,166 @@
+# -*- coding: UTF-8 -*-
+import threading
+from contextlib import contextmanager
+from hashlib import md5
+
+from CodernityDB.database import RecordNotFound, RevConflict
+from CodernityDB.tree_index import ElemNotFound
+
+from lite_task_flow import constants
+from lite_task_flow.backends import Backend
+from lite_task_flow.exceptions import DocumentNotFound, DocumentConflict
+
+
+class CodernityBackend(Backend):
+    """
+    the backend stores documents in a CodernityDB database, the indexes in
+    lite_task_flow.indexes should be added to the database (see
+    lite_task_flow.indexes.add_index)
+    """
+
+    def __init__(self, db):
+        """
+        :type db: CodernityDB.database.Database
+        """
+        self.db = db
+        # the ids of the documents inserted in the id index only (see
+        # 'deferred_indexes')
+        self._unindexed_ids = []
+        self._lock = threading.Lock()
+
+    def get(self, id_):
+        try:
+            return self.db.get('id', id_)
+        except RecordNotFound:
+            raise DocumentNotFound(id_)
+
+    def get_task(self, task_flow_id, tag):
+        try:
+            return self.db.get('task', dict(task_flow_id=task_flow_id, tag=tag), with_doc=True)['doc']
+        except RecordNotFound:
+            raise DocumentNotFound((task_flow_id, tag))
+
+    def get_task_flow_tasks(self, task_flow_id):
+        ret = []
+        for data in self.db.get_many('task_flow_tasks', task_flow_id, limit=-1):
+            doc = dict(data)
+            doc.pop('key', None)
+            ret.append(doc)
+        return ret
+
+    def iter_task_flow_ids(self, status=None, failed=None, root_task_cls=None, batch_size=100,
+                           keyed=False):
+        if status is None:
+            statuses = sorted([constants.TASK_FLOW_APPROVED, constants.TASK_FLOW_REFUSED,
+                               constants.TASK_FLOW_PROCESSING, constants.TASK_FLOW_EXECUTED])
+        else:
+            statuses = [status]
+        faileds = [False, True] if failed is None else [failed]
+        for status in statuses:
+            for failed in faileds:
+                prefix = '%d%d' % (status, failed)
+                for data in self._iter_tree_index('task_flow_status', prefix, 51, batch_size):
+                    if root_task_cls is None or data['root_task_cls'] == root_task_cls:
+                        yield self._entry(data, prefix) if keyed else data['_id']
+
+    def iter_pending_task_ids(self, task_cls, batch_size=100, keyed=False):
+        return self._iter_ids('pending_task', md5(task_cls).hexdigest(), batch_size, keyed)
+
+    def iter_queue_item_ids(self, status, batch_size=100, keyed=False):
+        return self._iter_ids('queue_item', '%d' % status, batch_size, keyed)
+
+    def iter_hook_event_ids(self, status, batch_size=100, keyed=False):
+        return self._iter_ids('due_hook_event', '%d' % status, batch_size, keyed)
+
+    def iter_timer_ids(self, status, batch_size=100, keyed=False):
+        return self._iter_ids('timer', '%d' % status, batch_size, keyed)
+
+    def _iter_ids(self, index_name, prefix, batch_size, keyed=False):
+        for data in self._iter_tree_index(index_name, prefix, 51, batch_size):
+            yield self._entry(data, prefix) if keyed else data['_id']
+
+    def _entry(self, data, prefix):
+        """
+        :return: (the time ordered by, id) of the entry of a tree based index,
+            the key is the prefix, the time and the id (padded by NULs)
+        """
+        return data['key'].rstrip('\x00')[len(prefix):-32], data['_id']
+
+    def _iter_tree_index(self, index_name, prefix, suffix_length, batch_size):
+        """
+        iterate over the entries of a tree based index whose keys start with
+        'prefix'. the keys end with the documents' ids, so they're unique, the
+        index is read by pages of 'batch_size' entries, each page starts right
+        after the last key of the previous page
+
+        :param suffix_length: the length of the keys without the prefix
+        """
+        end = prefix + '\xff' * suffix_length
+        start, inclusive_start = prefix, True
+        while True:
+            try:
+                page = list(self.db.get_many(index_name, start=start, end=end, limit=batch_size,
+                                             inclusive_start=inclusive_start))
+            except ElemNotFound:
+                # raised by the tree index when the range hits a leaf whose only
+                # entry is deleted, namely there's nothing in the range
+                page = []
+            for data in page:
+                yield data
+            if len(page) < batch_size:
+                break
+            start, inclusive_start = page[-1]['key'], False
+
+    def insert(self, doc):
+        return self.db.insert(doc)
+
+    def insert_many(self, docs, defer_indexes=False):
+        if not defer_indexes:
+            return [self.insert(doc) for doc in docs]
+        ret = [self._insert_id_index(doc) for doc in docs]
+        with self._lock:
+            self._unindexed_ids.extend(doc['_id'] for doc in docs)
+        return ret
+
+    def _insert_id_index(self, doc):
+        """
+        insert the document in the id index only, like what Database.insert
+        does for all the indexes
+        """
+        id_index = self.db.id_ind
+        ret = {'_id': doc.get('_id') or id_index.create_key(), '_rev': self.db.create_new_rev()}
+        # the id index takes '_id' and '_rev' out of the document it's given
+        _id, value = id_index.make_key_value(dict(doc, **ret))
+        id_index.insert_with_storage(_id, ret['_rev'], value)
+        doc.update(ret)
+        return ret
+
+    @contextmanager
+    def deferred_indexes(self):
+        """
+        the documents inserted by 'insert_many' with 'defer_indexes' in it are
+        inserted in the id index only, they're inserted in the other indexes
+        when it exits. the other documents are indexed as usual
+        """
+        try:
+            yield
+        finally:
+            with self._lock:
+                ids, self._unindexed_ids = self._unindexed_ids, []
+            indexes = self.db.indexes[1:]
+            for id_ in ids:
+                doc = self.db.get('id', id_)
+                for index in indexes:
+                    key_value = index.make_key_value(doc)
+                    if key_value:
+                        index.insert_with_storage(id_, *key_value)
+
+    def update(self, doc):
+        # CodernityDB pops '_id' and '_rev' of the document when it makes the
+        # key, they're put back if it conflicts
+        id_, rev = doc['_id'], doc['_rev']
+        try:
+            return self.db.update(doc)
+        except RevConflict:
+            doc.update(_id=id_, _rev=rev)
+            raise DocumentConflict(id_)
@@ -0,0 +1,197 @@
+# -*- coding: UTF-8 -*-
+import threading
+from bisect import bisect_left, bisect_right, insort
+from copy import deepcopy
+from itertools import count
+from uuid import uuid4
+
+from lite_task_flow import constants
+from lite_task_flow.backends import Backend
+from lite_task_flow.exceptions import DocumentNotFound, DocumentConflict
+
+
+class MemoryBackend(Backend):
+    """
+    the backend keeps documents in memory, they are lost when the process exits.
+    it's meant for tests, benchmarks and the task flows needn't be persisted.
+
+    like the other backends, the documents are copied when read or written, so
+    changing a document doesn't change the stored one until it's updated.
+
+    the documents queried (task flows by status, pending tasks by class, etc.)
+    are kept in sorted lists of (create time, id), or (due time, id) for the
+    timers and the hook events, like the indexes of the other backends, so a
+    query reads only its entries, by pages
+    """
+
+    def __init__(self):
+        self._docs = {}
+        self._task_ids = {}
+        self._task_flow_task_ids = {}
+        self._indexes = {}
+        self._revs = count(1)
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._docs)
+
+    def get(self, id_):
+        with self._lock:
+            try:
+                return deepcopy(self._docs[id_])
+            except KeyError:
+                raise DocumentNotFound(id_)
+
+    def get_many(self, ids):
+        with self._lock:
+            return dict((id_, deepcopy(self._docs[id_])) for id_ in ids if id_ in self._docs)
+
+    def get_task(self, task_flow_id, tag):
+        with self._lock:
+            try:
+                return deepcopy(self._docs[self._task_ids[(task_flow_id, tag)]])
+            except KeyError:
+                raise DocumentNotFound((task_flow_id, tag))
+
+    def get_tasks(self, keys):
+        with self._lock:
+            return dict((key, deepcopy(self._docs[self._task_ids[key]])) for key in keys
+                        if key in self._task_ids)
+
+    def get_task_flow_tasks(self, task_flow_id):
+        with self._lock:
+            return [deepcopy(self._docs[id_]) for id_ in self._task_flow_task_ids.get(task_flow_id, ())]
+
+    def iter_task_flow_ids(self, status=None, failed=None, root_task_cls=None, batch_size=100,
+                           keyed=False):
+        if status is None:
+            statuses = sorted([constants.TASK_FLOW_APPROVED, constants.TASK_FLOW_REFUSED,
+                               constants.TASK_FLOW_PROCESSING, constants.TASK_FLOW_EXECUTED])
+        else:
+            statuses = [status]
+        faileds = [False, True] if failed is None else [failed]
+        match = None
+        if root_task_cls is not None:
+            match = lambda doc: doc.get('root_task_cls') == root_task_cls
+        for status in statuses:
+            for failed in faileds:
+                for id_ in self._iter_ids((constants.TASK_FLOW_TYPE_CODE, status, failed), batch_size,
+                                          keyed, match):
+                    yield id_
+
+    def iter_pending_task_ids(self, task_cls, batch_size=100, keyed=False):
+        return self._iter_ids(('pending', task_cls), batch_size, keyed)
+
+    def iter_queue_item_ids(self, status, batch_size=100, keyed=False):
+        return self._iter_ids((constants.QUEUE_ITEM_TYPE_CODE, status), batch_size, keyed)
+
+    def iter_hook_event_ids(self, status, batch_size=100, keyed=False):
+        return self._iter_ids((constants.HOOK_EVENT_TYPE_CODE, status), batch_size, keyed)
+
+    def iter_timer_ids(self, status, batch_size=100, keyed=False):
+        return self._iter_ids((constants.TIMER_TYPE_CODE, status), batch_size, keyed)
+
+    def _iter_ids(self, index_key, batch_size, keyed=False, match=None):
+        """
+        iterate over the ids (or the entries if keyed) of the index's entries,
+        by pages of 'batch_size' entries, each page starts after the last entry
+        of the previous page
+
+        :param match: if provided, only the ids of the documents matched
+        """
+        last = ()
+        while True:
+            with self._lock:
+                entries = self._indexes.get(index_key, [])
+                start = bisect_right(entries, last)
+                page = entries[start:start + batch_size]
+                entries = [entry for entry in page if match is None or match(self._docs[entry[1]])]
+            for entry in entries:
+                yield entry if keyed else entry[1]
+            if len(page) < batch_size:
+                break
+            last = page[-1]
+
+    def _index_keys(self, doc):
+        """
+        :return: the keys of the indexes the document is in
+        """
+        t = doc['t']
+        if t == constants.TASK_FLOW_TYPE_CODE:
+            return [(t, doc['status'], bool(doc['failed']))]
+        if t == constants.TASK_TYPE_CODE:
+            if not doc['approved'] and not doc.get('refused'):
+                return [('pending', doc['cls'])]
+            return []
+        if t in (constants.QUEUE_ITEM_TYPE_CODE, constants.HOOK_EVENT_TYPE_CODE,
+                 constants.TIMER_TYPE_CODE):
+            return [(t, doc['status'])]
+        return []
+
+    def _index_entry(self, doc):
+        time = None
+        if doc['t'] in (constants.TIMER_TYPE_CODE, constants.HOOK_EVENT_TYPE_CODE):
+            time = doc.get('due_time')
+        return time or doc.get('create_time') or '', doc['_id']
+
+    def _index(self, doc):
+        entry = self._index_entry(doc)
+        for index_key in self._index_keys(doc):
+            insort(self._indexes.setdefault(index_key, []), entry)
+
+    def _unindex(self, doc):
+        entry = self._index_entry(doc)
+        for index_key in self._index_keys(doc):
+            entries = self._indexes[index_key]
+            del entries[bisect_left(entries, entry)]
+
+    def _new_rev(self):
+        return '%08x' % next(self._revs)
+
+    def insert(self, doc):
+        with self._lock:
+            if '_id' not in doc:
+                doc['_id'] = uuid4().hex
+            doc['_rev'] = self._new_rev()
+            self._docs[doc['_id']] = deepcopy(doc)
+            self._index(doc)
+            if doc['t'] == constants.TASK_TYPE_CODE:
+                self._task_ids[(doc['task_flow_id'], doc['tag'])] = doc['_id']
+                self._task_flow_task_ids.setdefault(doc['task_flow_id'], []).append(doc['_id'])
+        return {'_id': doc['_id'], '_rev': doc['_rev']}
+
+    def insert_many(self, docs, defer_indexes=False):
+        with self._lock:
+            return [self.insert(doc) for doc in docs]
+
+    def _check(self, doc):
+        stored = self._docs.get(doc['_id'])
+        if stored is None:
+            raise DocumentNotFound(doc['_id'])
+        if stored['_rev'] != doc.get('_rev'):
+            raise DocumentConflict(doc['_id'])
+
+    def _write(self, doc):
+        doc['_rev'] = self._new_rev()
+        self._unindex(self._docs[doc['_id']])
+        self._docs[doc['_id']] = deepcopy(doc)
+        self._index(doc)
+
+    def update(self, doc):
+        with self._lock:
+            self._check(doc)
+            self._write(doc)
+        return {'_id': doc['_id'], '_rev': doc['_rev']}
+
+    def update_many(self, docs, inserts=()):
+        """
+        update the documents and insert 'inserts' atomically, nothing is
+        written if any one conflicts
+        """
+        with self._lock:
+            for doc in docs:
+                self._check(doc)
+            for doc in docs:
+                self._write(doc)
+            for doc in inserts:
+                self.insert(doc)
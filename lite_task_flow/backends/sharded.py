@@ -0,0 +1,167 @@
+# -*- coding: UTF-8 -*-
+import heapq
+from contextlib import contextmanager
+from hashlib import md5
+from uuid import uuid4
+
+from lite_task_flow import constants
+from lite_task_flow.backends import Backend
+
+
+def shard_index(id_, n):
+    """
+    :return: the index of the shard (of 'n' shards) the document belongs to
+    """
+    return int(md5(id_).hexdigest()[:8], 16) % n
+
+
+class ShardedBackend(Backend):
+    """
+    the backend spreads task flows over several backends (shards) by the hash
+    of the task flow's id. a task flow's tasks (and the other documents of it,
+    e.g. the items of the execution queue) are stored in the shard of the task
+    flow, and their ids are chosen to hash to the same shard, so any document
+    could be found by its id.
+
+    the queries are performed on all the shards, and their results are merged
+    (by create time, read from the shards' indexes) as a stream. note, a batch of updates is atomic only if
+    its documents are in the same shard, it's the case for the operations on a
+    task flow
+    """
+
+    def __init__(self, backends):
+        """
+        :param backends: the shards, the order matters, since the documents are
+            routed by their index
+        :type backends: list of lite_task_flow.backends.Backend
+        """
+        self.backends = list(backends)
+
+    def shard(self, id_):
+        """
+        :return: the shard the document (or the task flow) belongs to
+        """
+        return self.backends[shard_index(id_, len(self.backends))]
+
+    def _new_id(self, task_flow_id=None):
+        """
+        :return: a new id hashed to the shard of the task flow if provided
+        """
+        id_ = uuid4().hex
+        if task_flow_id is not None:
+            n = len(self.backends)
+            index = shard_index(task_flow_id, n)
+            while shard_index(id_, n) != index:
+                id_ = uuid4().hex
+        return id_
+
+    def _group(self, ids, key=lambda id_: id_):
+        groups = {}
+        for id_ in ids:
+            groups.setdefault(shard_index(key(id_), len(self.backends)), []).append(id_)
+        return [(self.backends[index], group) for index, group in groups.items()]
+
+    def get(self, id_):
+        return self.shard(id_).get(id_)
+
+    def get_many(self, ids):
+        ret = {}
+        for backend, group in self._group(set(ids)):
+            ret.update(backend.get_many(group))
+        return ret
+
+    def get_task(self, task_flow_id, tag):
+        return self.shard(task_flow_id).get_task(task_flow_id, tag)
+
+    def get_tasks(self, keys):
+        ret = {}
+        for backend, group in self._group(set(keys), key=lambda key: key[0]):
+            ret.update(backend.get_tasks(group))
+        return ret
+
+    def get_task_flow_tasks(self, task_flow_id):
+        return self.shard(task_flow_id).get_task_flow_tasks(task_flow_id)
+
+    def iter_task_flow_ids(self, status=None, failed=None, root_task_cls=None, batch_size=100,
+                           keyed=False):
+        if status is None:
+            statuses = sorted([constants.TASK_FLOW_APPROVED, constants.TASK_FLOW_REFUSED,
+                               constants.TASK_FLOW_PROCESSING, constants.TASK_FLOW_EXECUTED])
+        else:
+            statuses = [status]
+        faileds = [False, True] if failed is None else [failed]
+        for status in statuses:
+            for failed in faileds:
+                for entry in self._merge(lambda backend: backend.iter_task_flow_ids(
+                        status, failed, root_task_cls, batch_size, keyed=True), keyed):
+                    yield entry
+
+    def iter_pending_task_ids(self, task_cls, batch_size=100, keyed=False):
+        return self._merge(lambda backend: backend.iter_pending_task_ids(task_cls, batch_size,
+                                                                         keyed=True), keyed)
+
+    def iter_queue_item_ids(self, status, batch_size=100, keyed=False):
+        return self._merge(lambda backend: backend.iter_queue_item_ids(status, batch_size,
+                                                                       keyed=True), keyed)
+
+    def iter_hook_event_ids(self, status, batch_size=100, keyed=False):
+        return self._merge(lambda backend: backend.iter_hook_event_ids(status, batch_size,
+                                                                       keyed=True), keyed)
+
+    def iter_timer_ids(self, status, batch_size=100, keyed=False):
+        return self._merge(lambda backend: backend.iter_timer_ids(status, batch_size, keyed=True),
+                           keyed)
+
+    def _merge(self, query, keyed):
+        """
+        merge the entries queried from the shards by their keys (the time
+        ordered by)
+
+        :param query: query(backend) returns the (key, id) of the entries
+            ordered by key
+        :param keyed: if True, return the entries, else the ids
+        """
+        entries = heapq.merge(*[query(backend) for backend in self.backends])
+        if keyed:
+            return entries
+        return (id_ for key, id_ in entries)
+
+    def insert(self, doc):
+        if '_id' not in doc:
+            doc['_id'] = self._new_id(doc.get('task_flow_id'))
+        return self.shard(doc['_id']).insert(doc)
+
+    def insert_many(self, docs, defer_indexes=False):
+        for doc in docs:
+            if '_id' not in doc:
+                doc['_id'] = self._new_id(doc.get('task_flow_id'))
+        for backend, group in self._group(docs, key=lambda doc: doc['_id']):
+            backend.insert_many(group, defer_indexes)
+        return [{'_id': doc['_id'], '_rev': doc['_rev']} for doc in docs]
+
+    @contextmanager
+    def deferred_indexes(self):
+        contexts = []
+        try:
+            for backend in self.backends:
+                context = backend.deferred_indexes()
+                context.__enter__()
+                contexts.append(context)
+            yield
+        finally:
+            for context in reversed(contexts):
+                context.__exit__(None, None, None)
+
+    def update(self, doc):
+        return self.shard(doc['_id']).update(doc)
+
+    def update_many(self, docs, inserts=()):
+        for doc in inserts:
+            if '_id' not in doc:
+                doc['_id'] = self._new_id(doc.get('task_flow_id'))
+        groups = {}
+        for i, group in enumerate([docs, inserts]):
+            for backend, shard_docs in self._group(group, key=lambda doc: doc['_id']):
+                groups.setdefault(backend, ([], []))[i].extend(shard_docs)
+        for backend, (shard_docs, shard_inserts) in groups.items():
+            backend.update_many(shard_docs, shard_inserts)
@@ -0,0 +1,299 @@
+# -*- coding: UTF-8 -*-
+import json
+import sqlite3
+import threading
+from contextlib import contextmanager
+from uuid import uuid4
+
+from lite_task_flow import constants
+from lite_task_flow.backends import Backend
+from lite_task_flow.exceptions import DocumentNotFound, DocumentConflict
+
+_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS documents (
+        id TEXT PRIMARY KEY,
+        rev TEXT NOT NULL,
+        t INTEGER NOT NULL,
+        task_flow_id TEXT,
+        tag TEXT,
+        cls TEXT,
+        status INTEGER,
+        failed INTEGER,
+        pending INTEGER NOT NULL DEFAULT 0,
+        create_time TEXT NOT NULL DEFAULT '',
+        body TEXT NOT NULL
+    )""",
+]
+
+_INDEXES = [
+    ("task_index", "documents (task_flow_id, tag)"),
+    ("task_flow_status_index", "documents (t, status, failed, create_time, id)"),
+    ("pending_task_index", "documents (pending, cls, create_time, id)"),
+    # the items of the execution queue, the hook events and the timers (whose
+    # create time column holds the due time of the latter two) are queried by
+    # type and status
+    ("queue_index", "documents (t, status, create_time, id)"),
+]
+
+_SCHEMA += ["CREATE INDEX IF NOT EXISTS %s ON %s" % index for index in _INDEXES]
+
+_COLUMNS = "id, rev, t, task_flow_id, tag, cls, status, failed, pending, create_time, body"
+
+# the max number of variables in a statement is 999 by default
+_CHUNK_SIZE = 400
+
+
+def _str_keys(obj):
+    return dict((str(k), v) for k, v in obj.items())
+
+
+class SQLiteBackend(Backend):
+    """
+    the backend stores documents in a SQLite database in WAL mode, so readers
+    don't block the writer. the fields queried (task flow id, tag, status, etc.)
+    are stored in indexed columns, the whole document is stored as JSON.
+
+    each thread has its own connection, so 'path' should be a file rather than
+    ':memory:'
+    """
+
+    def __init__(self, path, timeout=30):
+        """
+        :param path: path of the database file
+        :param timeout: seconds to wait for the lock of the database
+        """
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+        with self._transaction() as connection:
+            for statement in _SCHEMA:
+                connection.execute(statement)
+
+    @property
+    def connection(self):
+        """
+        the connection of the calling thread
+        """
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+    @contextmanager
+    def _transaction(self):
+        """
+        a write transaction, the nested ones are merged into the outermost one
+        """
+        connection = self.connection
+        if getattr(self._local, 'in_transaction', False):
+            yield connection
+            return
+        connection.execute('BEGIN IMMEDIATE')
+        self._local.in_transaction = True
+        try:
+            yield connection
+        except:
+            connection.execute('ROLLBACK')
+            raise
+        else:
+            connection.execute('COMMIT')
+        finally:
+            self._local.in_transaction = False
+
+    def _doc(self, row):
+        doc = json.loads(row[2], object_hook=_str_keys)
+        doc['_id'] = str(row[0])
+        doc['_rev'] = str(row[1])
+        return doc
+
+    def _row(self, doc, rev):
+        body = json.dumps(dict((k, v) for k, v in doc.items() if k not in ('_id', '_rev')))
+        t = doc['t']
+        if t == constants.TASK_TYPE_CODE:
+            cls = doc.get('cls')
+            pending = not doc.get('approved') and not doc.get('refused')
+        else:
+            cls = doc.get('root_task_cls')
+            pending = False
+        # the timers and the hook events are ordered by due time
+        order_time = None
+        if t in (constants.TIMER_TYPE_CODE, constants.HOOK_EVENT_TYPE_CODE):
+            order_time = doc.get('due_time')
+        order_time = order_time or doc.get('create_time')
+        return (doc['_id'], rev, t, doc.get('task_flow_id'), doc.get('tag'), cls, doc.get('status'),
+                doc.get('failed'), pending, order_time or '', body)
+
+    def get(self, id_):
+        row = self.connection.execute('SELECT id, rev, body FROM documents WHERE id = ?',
+                                      (id_,)).fetchone()
+        if row is None:
+            raise DocumentNotFound(id_)
+        return self._doc(row)
+
+    def get_many(self, ids):
+        ids = list(set(ids))
+        ret = {}
+        for i in xrange(0, len(ids), _CHUNK_SIZE):
+            chunk = ids[i:i + _CHUNK_SIZE]
+            for row in self.connection.execute(
+                    'SELECT id, rev, body FROM documents WHERE id IN (%s)' % ', '.join('?' * len(chunk)),
+                    chunk):
+                doc = self._doc(row)
+                ret[doc['_id']] = doc
+        return ret
+
+    def get_task(self, task_flow_id, tag):
+        row = self.connection.execute(
+            'SELECT id, rev, body FROM documents WHERE task_flow_id = ? AND tag = ? AND t = ?',
+            (task_flow_id, tag, constants.TASK_TYPE_CODE)).fetchone()
+        if row is None:
+            raise DocumentNotFound((task_flow_id, tag))
+        return self._doc(row)
+
+    def get_tasks(self, keys):
+        keys = list(set(keys))
+        ret = {}
+        for i in xrange(0, len(keys), _CHUNK_SIZE):
+            chunk = keys[i:i + _CHUNK_SIZE]
+            args = []
+            for key in chunk:
+                args.extend(key)
+            for row in self.connection.execute(
+                    'SELECT id, rev, body FROM documents WHERE t = ? AND (%s)' %
+                    ' OR '.join(['(task_flow_id = ? AND tag = ?)'] * len(chunk)),
+                    [constants.TASK_TYPE_CODE] + args):
+                doc = self._doc(row)
+                ret[(doc['task_flow_id'], doc['tag'])] = doc
+        return ret
+
+    def get_task_flow_tasks(self, task_flow_id):
+        return [self._doc(row) for row in self.connection.execute(
+            'SELECT id, rev, body FROM documents WHERE task_flow_id = ? AND t = ?',
+            (task_flow_id, constants.TASK_TYPE_CODE))]
+
+    def iter_task_flow_ids(self, status=None, failed=None, root_task_cls=None, batch_size=100,
+                           keyed=False):
+        if status is None:
+            statuses = sorted([constants.TASK_FLOW_APPROVED, constants.TASK_FLOW_REFUSED,
+                               constants.TASK_FLOW_PROCESSING, constants.TASK_FLOW_EXECUTED])
+        else:
+            statuses = [status]
+        faileds = [False, True] if failed is None else [failed]
+        for status in statuses:
+            for failed in faileds:
+                where = 't = ? AND status = ? AND failed = ?'
+                args = [constants.TASK_FLOW_TYPE_CODE, status, failed]
+                if root_task_cls is not None:
+                    where += ' AND cls = ?'
+                    args.append(root_task_cls)
+                for id_ in self._iter_ids(where, args, batch_size, keyed):
+                    yield id_
+
+    def iter_pending_task_ids(self, task_cls, batch_size=100, keyed=False):
+        return self._iter_ids('pending = 1 AND cls = ?', [task_cls], batch_size, keyed)
+
+    def iter_queue_item_ids(self, status, batch_size=100, keyed=False):
+        return self._iter_ids('t = ? AND status = ?', [constants.QUEUE_ITEM_TYPE_CODE, status],
+                              batch_size, keyed)
+
+    def iter_hook_event_ids(self, status, batch_size=100, keyed=False):
+        return self._iter_ids('t = ? AND status = ?', [constants.HOOK_EVENT_TYPE_CODE, status],
+                              batch_size, keyed)
+
+    def iter_timer_ids(self, status, batch_size=100, keyed=False):
+        return self._iter_ids('t = ? AND status = ?', [constants.TIMER_TYPE_CODE, status],
+                              batch_size, keyed)
+
+    def _iter_ids(self, where, args, batch_size, keyed=False):
+        """
+        iterate over the ids (or (create time, id) if keyed) of the documents
+        ordered by create time and id, by pages of 'batch_size' rows, each page
+        starts after the last row of the previous page
+        """
+        rows = self.connection.execute(
+            'SELECT id, create_time FROM documents WHERE %s ORDER BY create_time, id LIMIT ?' % where,
+            args + [batch_size]).fetchall()
+        while rows:
+            for row in rows:
+                yield (row[1], str(row[0])) if keyed else str(row[0])
+            if len(rows) < batch_size:
+                break
+            last_id, last_create_time = rows[-1]
+            rows = self.connection.execute(
+                'SELECT id, create_time FROM documents WHERE %s AND '
+                '(create_time > ? OR (create_time = ? AND id > ?)) ORDER BY create_time, id LIMIT ?' % where,
+                args + [last_create_time, last_create_time, last_id, batch_size]).fetchall()
+
+    def _new_rev(self):
+        return uuid4().hex[:8]
+
+    def insert(self, doc):
+        if '_id' not in doc:
+            doc['_id'] = uuid4().hex
+        rev = self._new_rev()
+        with self._transaction() as connection:
+            connection.execute('INSERT INTO documents (%s) VALUES (%s)' % (_COLUMNS, ', '.join('?' * 11)),
+                               self._row(doc, rev))
+        doc['_rev'] = rev
+        return {'_id': doc['_id'], '_rev': rev}
+
+    def insert_many(self, docs, defer_indexes=False):
+        """
+        insert the documents in one transaction, 'defer_indexes' is ignored,
+        since the indexes are updated in the transaction as well, and it'd
+        block the writers of the other connections to build them again
+        """
+        with self._transaction() as connection:
+            rows = self._insert_many(connection, docs)
+        for doc, row in zip(docs, rows):
+            doc['_rev'] = row[1]
+        return [{'_id': doc['_id'], '_rev': doc['_rev']} for doc in docs]
+
+    def _insert_many(self, connection, docs):
+        """
+        :return: the rows inserted
+        """
+        rows = []
+        for doc in docs:
+            if '_id' not in doc:
+                doc['_id'] = uuid4().hex
+            rows.append(self._row(doc, self._new_rev()))
+        connection.executemany('INSERT INTO documents (%s) VALUES (%s)' % (_COLUMNS, ', '.join('?' * 11)),
+                               rows)
+        return rows
+
+    def _update(self, connection, doc):
+        """
+        :return: the new revision
+        """
+        rev = self._new_rev()
+        row = self._row(doc, rev)
+        cursor = connection.execute(
+            'UPDATE documents SET rev = ?, t = ?, task_flow_id = ?, tag = ?, cls = ?, status = ?, '
+            'failed = ?, pending = ?, create_time = ?, body = ? WHERE id = ? AND rev = ?',
+            row[1:] + (doc['_id'], doc['_rev']))
+        if cursor.rowcount != 1:
+            raise DocumentConflict(doc['_id'])
+        return rev
+
+    def update(self, doc):
+        with self._transaction() as connection:
+            rev = self._update(connection, doc)
+        doc['_rev'] = rev
+        return {'_id': doc['_id'], '_rev': rev}
+
+    def update_many(self, docs, inserts=()):
+        """
+        update the documents and insert 'inserts' in one transaction, nothing
+        is written if any one conflicts
+        """
+        with self._transaction() as connection:
+            revs = [self._update(connection, doc) for doc in docs]
+            rows = self._insert_many(connection, inserts) if inserts else []
+        for doc, rev in zip(docs, revs):
+            doc['_rev'] = rev
+        for doc, row in zip(inserts, rows):
+            doc['_rev'] = row[1]
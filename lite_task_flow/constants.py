@@ -7,4 +7,31 @@ TASK_FLOW_EXECUTED = 4
 
 TASK_FLOW_TYPE_CODE = 100
 TASK_TYPE_CODE = 101
+QUEUE_ITEM_TYPE_CODE = 102
+HOOK_EVENT_TYPE_CODE = 103
+TIMER_TYPE_CODE = 104
 
+QUEUE_ITEM_QUEUED = 1
+QUEUE_ITEM_CLAIMED = 2
+QUEUE_ITEM_DONE = 3
+QUEUE_ITEM_FAILED = 4
+
+HOOK_EVENT_QUEUED = 2
+HOOK_EVENT_CLAIMED = 3
+HOOK_EVENT_DELIVERED = 4
+HOOK_EVENT_FAILED = 5
+
+TIMER_PENDING = 1
+TIMER_FIRED = 2
+# the task has been approved (or refused) when the timer is due
+TIMER_DISCARDED = 3
+
+
+# the outcomes of approving a task in a batch, APPROVAL_EXECUTED means the task
+# flow is executed, or enqueued if the engine executes in background
+APPROVAL_EXECUTED = 1
+APPROVAL_DELAYED = 2
+APPROVAL_REFUSED = 3
+APPROVAL_ALREADY_APPROVED = 4
+APPROVAL_UNSUBMITTED = 5
+APPROVAL_FAILED = 6
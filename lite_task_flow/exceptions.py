@@ -17,3 +17,25 @@ class TaskAlreadyApproved(Exception):
 
 class TaskUnsubmitted(Exception):
     pass
+
+class DocumentNotFound(Exception):
+    pass
+
+class DocumentConflict(Exception):
+    """
+    raised when a document is written with a revision which is not the latest
+    """
+    pass
+
+class DependencyCycle(Exception):
+    """
+    raised when a task depends on itself (directly or not)
+    """
+
+    def __init__(self, tags):
+        """
+        :param tags: the tags of the tasks on the cycle, the first one depends
+            on the second one, and so on, the last one is the same as the first one
+        """
+        super(DependencyCycle, self).__init__('dependency cycle: ' + ' -> '.join(str(tag) for tag in tags))
+        self.tags = tags
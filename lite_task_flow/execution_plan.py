@@ -0,0 +1,338 @@
+# -*- coding: UTF-8 -*-
+import json
+import pickle
+import threading
+from collections import OrderedDict
+from copy import deepcopy
+
+from lite_task_flow.exceptions import DependencyCycle
+
+ENTER = 'enter'
+EXIT = 'exit'
+
+
+def walk(root_task):
+    """
+    walk the task tree rooted by 'root_task' depth first, without recursion.
+    a task shared by several tasks is walked only once (by tag). the
+    dependencies of a task are got only after its ENTER event is consumed, so
+    the task could be initialized (e.g. checked out) beforehand.
+
+    if the class of the root task declares 'static_dependencies', the tree is
+    walked through its graph template (see GraphTemplate) instead
+
+    :type root_task: lite_task_flow.Task
+    :return: a generator of (ENTER, task, None) in pre-order and
+        (EXIT, task, tags of its dependencies) in post-order
+    :raise DependencyCycle: if a task depends on itself (directly or not)
+    """
+    if root_task.static_dependencies:
+        return GraphTemplate.of(root_task).walk(root_task)
+    return _walk(root_task)
+
+
+def _walk(root_task):
+    yield ENTER, root_task, None
+    visited = set([root_task.tag])
+    # the tasks being walked, the path from the root to the current task
+    path = [root_task.tag]
+    on_path = set(path)
+    stack = [(root_task, iter(root_task.dependencies), [])]
+    while stack:
+        task, dependencies, dep_tags = stack[-1]
+        for dep_task in dependencies:
+            dep_tags.append(dep_task.tag)
+            if dep_task.tag in on_path:
+                raise DependencyCycle(path[path.index(dep_task.tag):] + [dep_task.tag])
+            if dep_task.tag in visited:
+                continue
+            visited.add(dep_task.tag)
+            yield ENTER, dep_task, None
+            path.append(dep_task.tag)
+            on_path.add(dep_task.tag)
+            stack.append((dep_task, iter(dep_task.dependencies), []))
+            break
+        else:
+            stack.pop()
+            on_path.discard(path.pop())
+            yield EXIT, task, dep_tags
+
+
+def fingerprint(extra_params):
+    """
+    :return: a string identifies the extra params, the equal extra params have
+        the same fingerprint
+    """
+    return json.dumps(extra_params, sort_keys=True, default=repr)
+
+
+def perform_task(task_cls, task_flow_id, extra_params):
+    """
+    perform the body of a task out of its task flow, it's what is submitted to
+    a ProcessPoolExecutor, since the task itself (a bound method of it rather)
+    can't be pickled. so the task class must be defined at module level, and
+    the body mustn't touch the storage, nor the task flow except for its id
+
+    :return: what the body returns
+    """
+    from lite_task_flow.task_flow import TaskFlow
+    return task_cls(TaskFlow(task_flow_id, None), **extra_params)()
+
+
+def submit_task(executor, task):
+    """
+    submit the body of the task to the executor, if it's a ProcessPoolExecutor,
+    'perform_task' is submitted with the class, the task flow's id and the
+    extra params of the task instead
+
+    :return: a future of what the body returns, if the arguments can't be
+        pickled, it's resolved with the error
+    """
+    from concurrent.futures import Future, ProcessPoolExecutor
+
+    if not isinstance(executor, ProcessPoolExecutor):
+        return executor.submit(task.perform)
+    args = task.__class__, task.task_flow.id_, task.extra_params
+    try:
+        # the backport of concurrent.futures hangs if the arguments can't be
+        # pickled, so they're pickled beforehand
+        pickle.dumps(args, pickle.HIGHEST_PROTOCOL)
+    except Exception as e:
+        ret = Future()
+        ret.set_exception(e)
+        return ret
+    return executor.submit(perform_task, *args)
+
+
+class GraphTemplate(object):
+    """
+    the compiled shape of the task tree rooted by a task whose class declares
+    'static_dependencies': the class, extra params, tag and the tags of the
+    dependencies of each task, in flat lists indexed by the order the tasks are
+    walked.
+
+    the templates are cached by the class and the fingerprint of the extra
+    params of the root task, the least recently used one is discarded when
+    there are more than 'cache_size' templates. so the 'dependencies' of the
+    tasks are got once for all the task flows of the same shape
+    """
+
+    cache_size = 1024
+    _cache = OrderedDict()
+    _lock = threading.Lock()
+
+    def __init__(self, root_task):
+        """
+        compile the task tree rooted by 'root_task'
+
+        :raise DependencyCycle: if a task depends on itself (directly or not)
+        """
+        self.classes = []
+        self.extra_params = []
+        self.tags = []
+        self.dependencies = []
+        # i for entering the ith task, ~i for exiting it
+        self.events = []
+        indexes = {}
+        for event, task, dep_tags in _walk(root_task):
+            if event == ENTER:
+                indexes[task.tag] = len(self.tags)
+                self.events.append(len(self.tags))
+                self.classes.append(task.__class__)
+                self.extra_params.append(deepcopy(task.extra_params))
+                self.tags.append(task.tag)
+                self.dependencies.append(())
+            else:
+                index = indexes[task.tag]
+                self.dependencies[index] = tuple(dep_tags)
+                self.events.append(~index)
+
+    def __len__(self):
+        return len(self.tags)
+
+    @classmethod
+    def of(cls, root_task):
+        """
+        :return: the template of the task tree rooted by 'root_task', it's
+            compiled if it isn't cached
+        """
+        key = root_task.__class__, fingerprint(root_task.extra_params)
+        with cls._lock:
+            template = cls._cache.pop(key, None)
+            if template is not None:
+                cls._cache[key] = template
+                return template
+        # the dependencies are got out of the lock, since they are user code
+        template = cls(root_task)
+        with cls._lock:
+            cls._cache[key] = template
+            while len(cls._cache) > cls.cache_size:
+                cls._cache.popitem(last=False)
+        return template
+
+    @classmethod
+    def clear(cls):
+        """
+        discard the cached templates, e.g. after the task classes are changed
+        """
+        with cls._lock:
+            cls._cache.clear()
+
+    def walk(self, root_task):
+        """
+        instantiate the tasks of the template in the task flow of 'root_task',
+        see 'walk' of the module
+        """
+        tasks = [root_task] + [None] * (len(self.tags) - 1)
+        task_flow = root_task.task_flow
+        for event in self.events:
+            if event > 0:
+                tasks[event] = self.classes[event](task_flow, **deepcopy(self.extra_params[event]))
+            if event >= 0:
+                yield ENTER, tasks[event], None
+            else:
+                yield EXIT, tasks[~event], list(self.dependencies[~event])
+
+
+class ExecutionPlan(object):
+    """
+    the dependency DAG of a task tree, keyed by task tag, a task shared by several
+    tasks appears (and is executed) only once
+    """
+
+    def __init__(self, root_task):
+        """
+        :param root_task: the root of the task tree
+        :type root_task: lite_task_flow.Task
+        """
+        self.root_task = root_task
+        self.tasks = {}
+        self.dependencies = {}
+        self.order = []
+        # the tags of the tasks performed by this plan
+        self.performed = set()
+        for event, task, dep_tags in walk(root_task):
+            if event == ENTER:
+                self.tasks[task.tag] = task
+            else:
+                self.dependencies[task.tag] = dep_tags
+                self.order.append(task.tag)
+
+    def checkout(self, task_docs):
+        """
+        checkout the status (approved, failed, executed) of the tasks
+
+        :param task_docs: the task documents of the task flow (indexed by tag)
+        """
+        for task in self.tasks.values():
+            task.checkout(task_docs)
+        return self
+
+    def should_perform(self, task):
+        """
+        if the task should be performed, namely it hasn't been executed
+        successfully, or any of its dependencies is performed again
+        """
+        return task.executable or any(tag in self.performed for tag in self.dependencies[task.tag])
+
+    def perform(self, task, run):
+        """
+        save the result of the task's body
+
+        :param run: see Task.record_execution
+        """
+        task.record_execution(run)
+        self.performed.add(task.tag)
+
+    def execute(self, executor=None):
+        """
+        execute the tasks in topological order (from LEAF to ROOT), each task
+        is executed at most once. the tasks executed successfully are skipped,
+        unless any of their dependencies is performed again
+
+        :param executor: if provided, all the tasks whose dependencies have been
+            executed are performed concurrently in it (see 'submit_task'),
+            otherwise the tasks are performed one by one in the calling thread
+        :type executor: concurrent.futures.Executor
+        :raise Exception: any exceptions raised when executing tasks
+        """
+        if executor is None:
+            for tag in self.order:
+                task = self.tasks[tag]
+                if self.should_perform(task):
+                    self.perform(task, task.perform)
+        else:
+            self._execute_concurrently(executor)
+
+    def _execute_concurrently(self, executor):
+        """
+        perform the tasks' bodies in the executor, the result of each task is
+        saved in the calling thread. when a task fails, no more tasks will be
+        submitted, and the first exception is raised after the running tasks
+        finish
+        """
+        from concurrent.futures import wait, FIRST_COMPLETED
+
+        progress = ExecutionProgress(self)
+        ready = progress.ready()
+        running = {}
+        error = None
+        while ready or running:
+            while ready and error is None:
+                task = self.tasks[ready.pop(0)]
+                if self.should_perform(task):
+                    running[submit_task(executor, task)] = task.tag
+                else:
+                    ready.extend(progress.release(task.tag))
+            if not running:
+                break
+            done = wait(running.keys(), return_when=FIRST_COMPLETED)[0]
+            for future in done:
+                task = self.tasks[running.pop(future)]
+                try:
+                    self.perform(task, future.result)
+                except Exception as e:
+                    if error is None:
+                        error = e
+                    continue
+                ready.extend(progress.release(task.tag))
+        if error is not None:
+            raise error
+
+
+class ExecutionProgress(object):
+    """
+    track which tasks of an execution plan are ready to execute, namely all of
+    their dependencies have been executed
+    """
+
+    def __init__(self, plan):
+        """
+        :type plan: ExecutionPlan
+        """
+        self.plan = plan
+        self.unmet_dependencies = dict((tag, set(dependencies)) for tag, dependencies in
+                                       plan.dependencies.items())
+        self.dependents = dict((tag, []) for tag in plan.order)
+        for tag in plan.order:
+            for dep_tag in self.unmet_dependencies[tag]:
+                self.dependents[dep_tag].append(tag)
+
+    def ready(self):
+        """
+        :return: the tags of the tasks that have no dependencies
+        """
+        return [tag for tag in self.plan.order if not self.unmet_dependencies[tag]]
+
+    def release(self, tag):
+        """
+        mark the task as executed
+
+        :return: the tags of the tasks become ready to execute
+        """
+        ret = []
+        for dependent_tag in self.dependents[tag]:
+            self.unmet_dependencies[dependent_tag].discard(tag)
+            if not self.unmet_dependencies[dependent_tag]:
+                ret.append(dependent_tag)
+        return ret
@@ -0,0 +1,154 @@
+# -*- coding: UTF-8 -*-
+"""
+the durable execution queue, it's stored in the engine's backend. when the
+engine executes in background, a task flow is enqueued once all of its tasks
+are approved, and the workers (see lite_task_flow.worker) claim and execute
+them.
+
+an item is claimed by compare-and-swap on its revision, so each item is
+claimed by exactly one worker, even if the workers are in different processes.
+a task flow is enqueued in the transaction which approves it, if the backend
+supports (see Backend.update_many), else right after it.
+an item is queued again if its claimer doesn't complete it in 'lease' seconds
+(e.g. the worker process dies), then its task flow is executed again from the
+tasks unexecuted, so the lease should be longer than the executions
+"""
+import logging
+import os
+import socket
+from datetime import datetime, timedelta
+
+from lite_task_flow.task_flow_engine import TaskFlowEngine
+from lite_task_flow import constants
+from lite_task_flow.exceptions import DocumentNotFound, DocumentConflict
+
+logger = logging.getLogger(__name__)
+
+
+def _format(time):
+    return time.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def _now():
+    return _format(datetime.now())
+
+
+def worker_id():
+    """
+    :return: the id of the calling process, e.g. 'host:1234'
+    """
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+
+def enqueue(task_flow):
+    """
+    enqueue the task flow to be executed by the workers, if there's a session,
+    the item is inserted along with the changes of the session
+
+    :return: the document of the queue item, its id is set once it's written
+    """
+    doc = dict(t=constants.QUEUE_ITEM_TYPE_CODE, status=constants.QUEUE_ITEM_QUEUED,
+               task_flow_id=task_flow.id_, create_time=_now())
+    TaskFlowEngine.instance.add_doc(doc)
+    return doc
+
+
+def claim(worker=None, batch_size=10, lease=300):
+    """
+    claim the oldest queued item, the items whose lease has expired are queued
+    again before
+
+    :param worker: the id of the claimer, default to the calling process's
+    :param lease: the seconds an item is reserved for its claimer
+    :return: the document of the item claimed, None if nothing is queued
+    """
+    engine = TaskFlowEngine.instance
+    reclaim(lease, batch_size)
+    for item_id in engine.iter_queue_item_ids(constants.QUEUE_ITEM_QUEUED, batch_size):
+        try:
+            doc = engine.backend.get(item_id)
+        except DocumentNotFound:
+            continue
+        if doc['status'] != constants.QUEUE_ITEM_QUEUED:
+            continue
+        doc['status'] = constants.QUEUE_ITEM_CLAIMED
+        doc['worker'] = worker or worker_id()
+        doc['claim_time'] = _now()
+        try:
+            engine.backend.update(doc)
+        except DocumentConflict:
+            # claimed by another worker
+            continue
+        return doc
+    return None
+
+
+def reclaim(lease=300, batch_size=10):
+    """
+    queue the claimed items whose lease has expired again
+
+    :return: the number of the items queued again
+    """
+    engine = TaskFlowEngine.instance
+    deadline = _format(datetime.now() - timedelta(seconds=lease))
+    reclaimed = 0
+    for item_id in engine.iter_queue_item_ids(constants.QUEUE_ITEM_CLAIMED, batch_size):
+        try:
+            doc = engine.backend.get(item_id)
+        except DocumentNotFound:
+            continue
+        if doc['status'] != constants.QUEUE_ITEM_CLAIMED or doc['claim_time'] >= deadline:
+            continue
+        logger.warning('the lease of task flow %s claimed by %s has expired', doc['task_flow_id'],
+                       doc['worker'])
+        doc['status'] = constants.QUEUE_ITEM_QUEUED
+        try:
+            engine.backend.update(doc)
+        except DocumentConflict:
+            # completed or queued again by others
+            continue
+        reclaimed += 1
+    return reclaimed
+
+
+def complete(doc, error=None):
+    """
+    record the result of the execution of the item claimed
+
+    :param error: the exception raised by the execution if it failed
+    """
+    if error is None:
+        doc['status'] = constants.QUEUE_ITEM_DONE
+    else:
+        doc['status'] = constants.QUEUE_ITEM_FAILED
+        doc['error'] = repr(error)
+    doc['finish_time'] = _now()
+    TaskFlowEngine.instance.backend.update(doc)
+
+
+def execute_next(worker=None, lease=300):
+    """
+    claim the oldest queued item and execute its task flow
+
+    :param lease: see 'claim'
+    :return: the document of the item executed, None if nothing is queued
+    """
+    from lite_task_flow.functions import get_task_flow
+
+    doc = claim(worker, lease=lease)
+    if doc is None:
+        return None
+    error = None
+    try:
+        task_flow = get_task_flow(doc['task_flow_id'])
+        if task_flow is None:
+            raise DocumentNotFound(doc['task_flow_id'])
+        task_flow.execute()
+    except Exception as e:
+        error = e
+    try:
+        complete(doc, error)
+    except DocumentConflict:
+        # the lease has expired, and the item is queued again
+        logger.warning('the lease of task flow %s has expired before completed', doc['task_flow_id'])
+    return doc
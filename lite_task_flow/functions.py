@@ -1,38 +1,223 @@
 # -*- coding: UTF-8 -*-
+from datetime import datetime
+from itertools import islice
+
 from lite_task_flow.task_flow_engine import TaskFlowEngine
 from lite_task_flow.task_flow import TaskFlow
 from lite_task_flow.task import Task
-from CodernityDB.database import RecordNotFound
 from lite_task_flow import constants
+from lite_task_flow.scheduler import timer_doc
+from lite_task_flow import transition_log
+
+def _task_flow_doc(task_cls, annotation, kwargs):
+    return dict(t=constants.TASK_FLOW_TYPE_CODE, status=constants.TASK_FLOW_PROCESSING, annotation=annotation,
+                root_task_cls=task_cls.__name__, root_extra_params=kwargs, failed=False,
+                create_time=datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
 
 def new_task_flow(task_cls, annotation="", **kwargs):
     """
     create a task flow, it's root task's class is 'task_cls', it's annotation is
     """
 
-    d = dict(t=constants.TASK_FLOW_TYPE_CODE, status=constants.TASK_FLOW_PROCESSING, annotation=annotation,
-             root_task_cls=task_cls.__name__, root_extra_params=kwargs, failed=False)
-    id_ = TaskFlowEngine.instance.db.insert(d)['_id']
-    task_flow = TaskFlow(id_, annotation)
+    ret = TaskFlowEngine.instance.insert_doc(_task_flow_doc(task_cls, annotation, kwargs))
+    task_flow = TaskFlow(ret['_id'], annotation, rev=ret['_rev'])
     task_flow.set_root_task(task_cls(task_flow, **kwargs))
     task_flow.root_task.save()
     return task_flow
 
+class TaskFlowHandle(object):
+    """
+    a lightweight reference to a task flow created in bulk (see
+    new_task_flows), the task flow is loaded when needed
+    """
+
+    __slots__ = ('id_', 'root_task_id')
+
+    def __init__(self, id_, root_task_id):
+        self.id_ = id_
+        self.root_task_id = root_task_id
+
+    def load(self):
+        """
+        :rtype: lite_task_flow.task_flow.TaskFlow
+        """
+        return get_task_flow(self.id_)
+
+def new_task_flows(task_cls, params_iterable, annotation="", chunk_size=1000, defer_indexes=False):
+    """
+    create task flows in bulk, like 'new_task_flow' for each extra params. the
+    params are consumed as a stream, and the documents are inserted by chunks,
+    a chunk of task flows and a chunk of their root tasks in one pass each
+
+    :param params_iterable: an iterable of the extra params (dict) of the root
+        tasks, one task flow is created for each
+    :param chunk_size: the number of task flows inserted in a chunk
+    :param defer_indexes: if True, the task flows are indexed in one pass after
+        all of them are inserted (see TaskFlowEngine.deferred_indexes), it's
+        faster to create a large number of task flows, but the queries may miss
+        them until it returns
+    :return: the handles of the task flows, in the same order
+    :rtype: list of TaskFlowHandle
+    """
+    engine = TaskFlowEngine.instance
+    if defer_indexes:
+        with engine.deferred_indexes():
+            return _new_task_flows(task_cls, params_iterable, annotation, chunk_size, True)
+    return _new_task_flows(task_cls, params_iterable, annotation, chunk_size, False)
+
+def _new_task_flows(task_cls, params_iterable, annotation, chunk_size, defer_indexes):
+    engine = TaskFlowEngine.instance
+    ret = []
+    params_iterable = iter(params_iterable)
+    while True:
+        chunk = list(islice(params_iterable, chunk_size))
+        if not chunk:
+            return ret
+        task_flow_docs = [_task_flow_doc(task_cls, annotation, params) for params in chunk]
+        engine.insert_docs(task_flow_docs, defer_indexes)
+        root_tasks = [task_cls(TaskFlow(doc['_id'], annotation), **params)
+                      for doc, params in zip(task_flow_docs, chunk)]
+        root_task_docs = [root_task.as_doc() for root_task in root_tasks]
+        engine.insert_docs(root_task_docs, defer_indexes)
+        for root_task in root_tasks:
+            engine.log_transition(transition_log.TASK_SAVED, root_task.task_flow.id_, tag=root_task.tag)
+        if task_cls.timeout is not None:
+            engine.insert_docs([timer_doc(root_task) for root_task in root_tasks], defer_indexes)
+        ret.extend(TaskFlowHandle(task_flow_doc['_id'], root_task_doc['_id'])
+                   for task_flow_doc, root_task_doc in zip(task_flow_docs, root_task_docs))
+
+def approve_many(tasks, executor=None):
+    """
+    approve the tasks in bulk, the tasks are grouped by their task flows, the
+    approvals of a task flow are written in one batch, and each task flow is
+    retried once (see TaskFlow.approve_many). the exceptions are not raised but
+    reported as the outcomes
+
+    :param executor: if provided, the task flows are approved concurrently in
+        it, otherwise one by one in the calling thread
+    :type executor: concurrent.futures.Executor
+    :return: the outcomes of the tasks, in the same order
+    :rtype: list of lite_task_flow.task_flow.ApprovalOutcome
+    """
+    tasks = list(tasks)
+    groups = {}
+    for index, task in enumerate(tasks):
+        groups.setdefault(task.task_flow.id_, []).append(index)
+    groups = groups.values()
+
+    def _approve(indexes):
+        return tasks[indexes[0]].task_flow.approve_many([tasks[index] for index in indexes])
+
+    if executor is None:
+        results = [_approve(indexes) for indexes in groups]
+    else:
+        futures = [executor.submit(_approve, indexes) for indexes in groups]
+        results = [future.result() for future in futures]
+    ret = [None] * len(tasks)
+    for indexes, outcomes in zip(groups, results):
+        for index, outcome in zip(indexes, outcomes):
+            ret[index] = outcome
+    return ret
+
 def get_task_flow(task_flow_id):
     """
-    get task flow from disk
+    get task flow from disk, if the engine has an identity map, it's served
+    from the identity map when possible
 
     :return: the task flow with given id, else None
     """
-    try:
-        doc = TaskFlowEngine.instance.db.get('id', task_flow_id)
-    except RecordNotFound:
-        return None
-    ret = TaskFlow(task_flow_id, doc['annotation'], doc['status'], doc['failed'])
-    ret.set_root_task(TaskFlowEngine.instance.registered_task_cls_map[doc['root_task_cls']](ret, **doc['root_extra_params']))
-    ret.root_task.checkout()
+    return get_task_flows([task_flow_id]).get(task_flow_id)
+
+def get_task_flows(task_flow_ids):
+    """
+    get task flows from disk, the documents are fetched in one pass, and
+    duplicated ids are fetched once. if the engine has an identity map, they're
+    served from the identity map if they're built from the documents' current
+    revisions, so their root tasks needn't be fetched
+
+    :return: a dict of task flows indexed by id, the ids not found are absent
+    """
+    engine = TaskFlowEngine.instance
+    identity_map = engine.identity_map
+    ret = {}
+    docs = engine.get_docs(set(task_flow_ids))
+    task_flows = {}
+    for task_flow_id, doc in docs.items():
+        if identity_map is not None:
+            task_flow = identity_map.get(task_flow_id, doc['_rev'])
+            if task_flow is not None:
+                ret[task_flow_id] = task_flow
+                continue
+        task_flow = TaskFlow(task_flow_id, doc['annotation'], doc['status'], doc['failed'],
+                             doc['_rev'])
+        task_flow.set_root_task(engine.registered_task_cls_map[doc['root_task_cls']](task_flow, **doc['root_extra_params']))
+        task_flows[task_flow_id] = task_flow
+    root_task_docs = engine.get_task_docs_by_keys((task_flow_id, task_flow.root_task.tag) for
+                                                  task_flow_id, task_flow in task_flows.items())
+    for task_flow_id, task_flow in task_flows.items():
+        ret[task_flow_id] = task_flow
+        root_task_doc = root_task_docs.get((task_flow_id, task_flow.root_task.tag))
+        if root_task_doc is None:
+            continue
+        task_flow.root_task.checkout({task_flow.root_task.tag: root_task_doc})
+        if identity_map is not None:
+            identity_map.put(task_flow_id, docs[task_flow_id]['_rev'], task_flow)
+            identity_map.put(root_task_doc['_id'], root_task_doc['_rev'], task_flow.root_task, task_flow_id)
     return ret
 
+def list_task_flows(status=None, failed=None, root_task_cls=None, batch_size=100):
+    """
+    a generator of task flows ordered by status, failed and create time, the task flows
+    are loaded by batches, so the memory is bounded no matter how many task
+    flows there are
+
+    :param status: only the task flows of this status if provided
+    :param failed: only the task flows (not) failed if provided
+    :param root_task_cls: only the task flows of this root task's class if
+        provided
+    :param batch_size: the number of task flows loaded in a batch
+    """
+    if root_task_cls is not None:
+        root_task_cls = root_task_cls.__name__
+    batch = []
+    for task_flow_id in TaskFlowEngine.instance.iter_task_flow_ids(status, failed, root_task_cls,
+                                                                    batch_size):
+        batch.append(task_flow_id)
+        if len(batch) == batch_size:
+            for task_flow in _load_task_flow_batch(batch):
+                yield task_flow
+            batch = []
+    for task_flow in _load_task_flow_batch(batch):
+        yield task_flow
+
+def pending_tasks(task_cls, batch_size=100):
+    """
+    a generator of the tasks of class 'task_cls' submitted but neither approved
+    nor refused (e.g. the inbox of the handlers of the tasks), ordered by create
+    time. the tasks are loaded by batches, so the memory is bounded no matter
+    how many tasks are waiting
+
+    :param task_cls: the class of the tasks, it should be registered
+    :param batch_size: the number of tasks loaded in a batch
+    """
+    batch = []
+    for task_id in TaskFlowEngine.instance.iter_pending_task_ids(task_cls.__name__, batch_size):
+        batch.append(task_id)
+        if len(batch) == batch_size:
+            for task in _load_task_batch(batch):
+                yield task
+            batch = []
+    for task in _load_task_batch(batch):
+        yield task
+
+def _load_task_batch(task_ids):
+    tasks = get_tasks(task_ids)
+    return [tasks[task_id] for task_id in task_ids if task_id in tasks]
+
+def _load_task_flow_batch(task_flow_ids):
+    task_flows = get_task_flows(task_flow_ids)
+    return [task_flows[task_flow_id] for task_flow_id in task_flow_ids if task_flow_id in task_flows]
+
 def register_task_cls(task_cls):
     """
     register the task class, all the root tasks' class should be registered
@@ -40,14 +225,44 @@ def register_task_cls(task_cls):
     TaskFlowEngine.instance.registered_task_cls_map[task_cls.__name__] = task_cls
 
 def get_task(task_id):
-    try:
-        doc = TaskFlowEngine.instance.db.get('id', task_id)
-    except RecordNotFound:
-        return None
-    return get_task_from_doc(doc)
-
-def get_task_from_doc(doc):
-    task_flow = get_task_flow(doc['task_flow_id'])
+    """
+    get task from disk, if the engine has an identity map, it's served from the
+    identity map when possible
+
+    :return: the task with given id, else None
+    """
+    return get_tasks([task_id]).get(task_id)
+
+def get_tasks(task_ids):
+    """
+    get tasks from disk, the documents of the tasks and their task flows are
+    fetched in one pass each, and duplicated ids are fetched once. if the engine
+    has an identity map, they're served from the identity map if they're built
+    from the documents' current revisions
+
+    :return: a dict of tasks indexed by id, the ids not found are absent
+    """
+    ret = {}
+    docs = TaskFlowEngine.instance.get_docs(set(task_ids))
+    # the task flows are validated first, the tasks of the stale ones are
+    # invalidated along with them
+    task_flows = get_task_flows(doc['task_flow_id'] for doc in docs.values())
+    for task_id, doc in docs.items():
+        ret[task_id] = get_task_from_doc(doc, task_flows.get(doc['task_flow_id']))
+    return ret
+
+def get_task_from_doc(doc, task_flow=None):
+    """
+    :param task_flow: the task flow of the task, it's got from disk if not
+        provided
+    """
+    identity_map = TaskFlowEngine.instance.identity_map
+    if identity_map is not None:
+        ret = identity_map.get(doc['_id'], doc['_rev'])
+        if ret is not None:
+            return ret
+    if task_flow is None:
+        task_flow = get_task_flow(doc['task_flow_id'])
     task_cls = TaskFlowEngine.instance.registered_task_cls_map[doc['cls']]
     ret = task_cls(task_flow, **doc['extra_params'])
     ret.approved = doc['approved']
@@ -55,4 +270,7 @@ def get_task_from_doc(doc):
     ret.create_time = doc['create_time']
     ret.approved_time = doc.get('approved_time')
     ret.id_ = doc['_id']
+    ret.rev = doc.get('_rev')
+    if identity_map is not None:
+        identity_map.put(doc['_id'], doc['_rev'], ret, doc['task_flow_id'])
     return ret
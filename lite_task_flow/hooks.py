@@ -0,0 +1,335 @@
+# -*- coding: UTF-8 -*-
+"""
+the durable dispatcher of the hooks of the tasks ('on_delayed', 'on_approved',
+'on_refused' and 'after_executed'). when the engine has a dispatcher, invoking
+a hook records a hook event in the engine's backend instead, and the event is
+delivered (namely the hook is invoked) later in background, so the operations
+don't wait for the hooks (e.g. sending mails).
+
+an event recorded in a session is inserted along with the changes of the
+session, so the hooks of the changes failed to write (e.g. by the attempts
+conflicted) are never delivered. the event and the changes are written in one
+transaction by the backends support (the SQLite and the in-memory ones), the
+others insert the event right after the changes, so it's lost if the process
+dies in between.
+
+an event is claimed by compare-and-swap before delivered, and it's queued
+again if its claimer doesn't finish it in 'lease' seconds (e.g. the process
+dies), or the hook raises, then it waits for 'retry_delay' seconds (doubled by
+each failure) before delivered again. so an event is delivered AT LEAST once,
+the hooks should be idempotent. the events are indexed by the time they're due
+(namely 'due_time', which is the create time until it's postponed by a
+failure), so the events waiting for retry aren't read before they're due.
+
+the tasks are built from their class and extra params when delivered, so the
+classes should be registered (see register_task_cls)
+"""
+import logging
+import threading
+from datetime import datetime, timedelta
+from itertools import islice
+
+from concurrent.futures import Future, wait, FIRST_COMPLETED
+
+from lite_task_flow.task_flow_engine import TaskFlowEngine
+from lite_task_flow.task import Task
+from lite_task_flow.functions import get_task_flows
+from lite_task_flow.execution_queue import worker_id
+from lite_task_flow import constants
+from lite_task_flow.exceptions import DocumentNotFound, DocumentConflict
+
+logger = logging.getLogger(__name__)
+
+HOOKS = ('on_delayed', 'on_approved', 'on_refused', 'after_executed')
+
+
+def _format(time):
+    return time.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def _task_ref(task):
+    return dict(cls=task.__class__.__name__, extra_params=task.extra_params)
+
+
+def _dump_arg(arg):
+    if isinstance(arg, Task):
+        return dict(task=_task_ref(arg))
+    return dict(value=arg)
+
+
+class HookDispatcher(object):
+    """
+    record the invocations of the hooks as events, and deliver them in
+    background (see the module's doc)
+    """
+
+    def __init__(self, hooks=HOOKS, max_workers=4, concurrency=None, batch_size=100,
+                 max_attempts=5, lease=300, retry_delay=10):
+        """
+        :param hooks: the names of the hooks dispatched, the others are invoked
+            inline
+        :param max_workers: the number of the threads where the hooks are
+            invoked
+        :param concurrency: the max number of the events of a hook delivered
+            concurrently (a dict indexed by hook name), default to 'max_workers'
+        :param batch_size: the max number of the events delivered in a batch
+        :param max_attempts: an event is marked as failed and never delivered
+            again if its hook raises this number of times
+        :param lease: the seconds an event is reserved for its claimer
+        :param retry_delay: the seconds an event waits after its hook raises
+            for the first time, it's doubled by each failure
+        """
+        self.hooks = frozenset(hooks)
+        self.max_workers = max_workers
+        self.concurrency = dict(concurrency or {})
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.lease = lease
+        self.retry_delay = retry_delay
+        self._semaphores = {}
+        self._lock = threading.Lock()
+        # the events being delivered, indexed by the futures of their hooks
+        self._delivering = {}
+        self._executor = None
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def dispatches(self, hook):
+        """
+        :return: if the invocations of the hook are dispatched
+        """
+        return hook in self.hooks
+
+    def record(self, task, hook, *args):
+        """
+        record the invocation of the task's hook as an event, if there's a
+        session, the event is inserted along with the changes of the session
+        """
+        engine = TaskFlowEngine.instance
+        now = _format(datetime.now())
+        doc = dict(t=constants.HOOK_EVENT_TYPE_CODE, status=constants.HOOK_EVENT_QUEUED,
+                   task_flow_id=task.task_flow.id_, task=_task_ref(task), hook=hook,
+                   args=[_dump_arg(arg) for arg in args], attempts=0,
+                   create_time=now, due_time=now)
+        engine.add_doc(doc)
+
+    @property
+    def executor(self):
+        """
+        the executor where the hooks are invoked
+        """
+        with self._lock:
+            if self._executor is None:
+                from concurrent.futures import ThreadPoolExecutor
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        return self._executor
+
+    def _semaphore(self, hook):
+        with self._lock:
+            if hook not in self._semaphores:
+                self._semaphores[hook] = threading.BoundedSemaphore(
+                    self.concurrency.get(hook, self.max_workers))
+            return self._semaphores[hook]
+
+    def deliver(self, worker=None, wait=True):
+        """
+        claim a batch of the queued events due and deliver them concurrently,
+        an event is skipped (until the next batch) if its hook has reached the
+        concurrency limit. the result of an event is written as soon as its
+        hook returns (along with the others returned by then), so a slow hook
+        doesn't hold back the results of the others
+
+        :param worker: the id of the claimer, default to the calling process's
+        :param wait: if the events being delivered are waited for, else the
+            results of the hooks returned are written by the next invocation
+            (or 'wait')
+        :return: the number of the events claimed
+        """
+        engine = TaskFlowEngine.instance
+        self._finish([future for future in self._delivering.keys() if future.done()])
+        self._reclaim()
+        claimed = []
+        for doc in self._iter_due(_format(datetime.now())):
+            semaphore = self._semaphore(doc['hook'])
+            if not semaphore.acquire(False):
+                continue
+            doc['status'] = constants.HOOK_EVENT_CLAIMED
+            doc['worker'] = worker or worker_id()
+            doc['claim_time'] = _format(datetime.now())
+            try:
+                engine.backend.update(doc)
+            except DocumentConflict:
+                # claimed by another dispatcher
+                semaphore.release()
+                continue
+            claimed.append(doc)
+            if len(claimed) == self.batch_size:
+                break
+        if claimed:
+            task_flows = get_task_flows(doc['task_flow_id'] for doc in claimed)
+            for doc in claimed:
+                future = self.executor.submit(self._invoke, doc, task_flows.get(doc['task_flow_id']))
+                self._delivering[future] = doc
+        if wait:
+            self.wait()
+        return len(claimed)
+
+    def wait(self, timeout=None):
+        """
+        wait for the events being delivered, the results are written as the
+        hooks return
+
+        :param timeout: the max seconds to wait, None for no limit
+        :return: if all the events being delivered are finished
+        """
+        while self._delivering:
+            done = wait(self._delivering.keys(), timeout, FIRST_COMPLETED)[0]
+            if not done:
+                return False
+            self._finish(done)
+        return True
+
+    def _finish(self, futures):
+        """
+        write the results of the events whose hooks have returned in one batch
+        """
+        if not futures:
+            return
+        engine = TaskFlowEngine.instance
+        finished = []
+        for future in futures:
+            doc = self._delivering.pop(future)
+            finished.append(doc)
+            error = future.exception()
+            self._semaphore(doc['hook']).release()
+            doc['attempts'] += 1
+            now = datetime.now()
+            doc['finish_time'] = _format(now)
+            if error is None:
+                doc['status'] = constants.HOOK_EVENT_DELIVERED
+                continue
+            logger.warning('hook %s of task flow %s failed: %r', doc['hook'], doc['task_flow_id'],
+                           error)
+            doc['error'] = repr(error)
+            if doc['attempts'] >= self.max_attempts:
+                doc['status'] = constants.HOOK_EVENT_FAILED
+            else:
+                doc['status'] = constants.HOOK_EVENT_QUEUED
+                delay = self.retry_delay * 2 ** (doc['attempts'] - 1)
+                doc['due_time'] = _format(now + timedelta(seconds=delay))
+        try:
+            engine.backend.update_many(finished)
+        except DocumentConflict:
+            # some events are claimed by others since their lease expired,
+            # they'll be delivered again
+            for doc in finished:
+                try:
+                    engine.backend.update(doc)
+                except DocumentConflict:
+                    pass
+
+    def _iter_due(self, now):
+        """
+        iterate over the queued events due by 'now', from the earliest one, the
+        events are read by pages of 'batch_size'
+        """
+        engine = TaskFlowEngine.instance
+        entries = engine.backend.iter_hook_event_ids(constants.HOOK_EVENT_QUEUED, self.batch_size,
+                                                     keyed=True)
+        while True:
+            page = list(islice(entries, self.batch_size))
+            due = [id_ for time, id_ in page if time <= now]
+            if not due:
+                return
+            docs = engine.backend.get_many(due)
+            for id_ in due:
+                doc = docs.get(id_)
+                if doc is not None and doc['status'] == constants.HOOK_EVENT_QUEUED and \
+                        doc.get('due_time', '') <= now:
+                    yield doc
+            if len(due) < len(page):
+                return
+
+    def _load_task(self, task_flow, ref):
+        task_cls = TaskFlowEngine.instance.registered_task_cls_map[ref['cls']]
+        return task_cls(task_flow, **ref['extra_params']).checkout()
+
+    def _invoke(self, doc, task_flow):
+        if task_flow is None:
+            raise DocumentNotFound(doc['task_flow_id'])
+        task = self._load_task(task_flow, doc['task'])
+        args = [self._load_task(task_flow, arg['task']) if 'task' in arg else arg['value']
+                for arg in doc['args']]
+        ret = getattr(task, doc['hook'])(*args)
+        # the hooks of AsyncTask could be asynchronous
+        if isinstance(ret, Future):
+            ret.result()
+
+    def _reclaim(self):
+        """
+        queue the events whose lease has expired again
+        """
+        engine = TaskFlowEngine.instance
+        deadline = _format(datetime.now() - timedelta(seconds=self.lease))
+        for id_ in engine.iter_hook_event_ids(constants.HOOK_EVENT_CLAIMED, self.batch_size):
+            try:
+                doc = engine.backend.get(id_)
+            except DocumentNotFound:
+                continue
+            if doc['status'] != constants.HOOK_EVENT_CLAIMED or doc['claim_time'] >= deadline:
+                continue
+            doc['status'] = constants.HOOK_EVENT_QUEUED
+            try:
+                engine.backend.update(doc)
+            except DocumentConflict:
+                pass
+
+    def run(self, poll_interval=1.0, drain=False):
+        """
+        deliver the events batch by batch until 'stop' is invoked, the next
+        batch is claimed without waiting for the slow hooks of the previous
+        ones (unless 'drain'), the concurrency limits still hold
+
+        :param poll_interval: the seconds to wait when nothing is queued
+        :param drain: if True, return when nothing is queued
+        :return: the number of the events claimed
+        """
+        claimed = 0
+        while not self._stopped.is_set():
+            try:
+                n = self.deliver(wait=drain)
+            except Exception:
+                logger.exception('failed to deliver the hook events')
+                n = 0
+            claimed += n
+            if not n:
+                if drain:
+                    break
+                if self._delivering:
+                    # the next invocation writes the results of the hooks returned
+                    wait(self._delivering.keys(), poll_interval, FIRST_COMPLETED)
+                else:
+                    self._stopped.wait(poll_interval)
+        try:
+            self.wait()
+        except Exception:
+            logger.exception('failed to deliver the hook events')
+        return claimed
+
+    def start(self, poll_interval=1.0):
+        """
+        deliver the events in a daemon thread of the calling process
+        """
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self.run, args=(poll_interval,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        stop delivering, the events being delivered are finished
+        """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
@@ -0,0 +1,94 @@
+# -*- coding: UTF-8 -*-
+import threading
+from collections import OrderedDict
+
+
+class IdentityMap(object):
+    """
+    a bounded LRU map of the objects (task flows and tasks) built from documents,
+    keyed by document id. each entry remembers the revision of its document, so
+    it could be invalidated when a different revision is seen. an entry could
+    belong to another entry (e.g. a task belongs to its task flow), it's
+    invalidated along with the owner
+    """
+
+    def __init__(self, capacity):
+        """
+        :param capacity: the max number of entries, the least recently used
+            entry is discarded when it's exceeded
+        """
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._members = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, id_, rev=None):
+        """
+        :param rev: if provided, the entry is hit only if it's built from this
+            revision of the document, else it's discarded
+        :return: the object of the document, None if it's not in the map
+        """
+        with self._lock:
+            try:
+                entry = self._entries.pop(id_)
+            except KeyError:
+                self.misses += 1
+                return None
+            if rev is not None and entry[0] != rev:
+                self._entries[id_] = entry
+                self._discard(id_)
+                self.misses += 1
+                return None
+            self._entries[id_] = entry
+            self.hits += 1
+            return entry[1]
+
+    def put(self, id_, rev, obj, owner_id=None):
+        """
+        :param rev: the revision of the document 'obj' is built from
+        :param owner_id: the id of the entry it belongs to
+        """
+        with self._lock:
+            self._discard(id_, cascade=False)
+            self._entries[id_] = rev, obj, owner_id
+            if owner_id is not None:
+                self._members.setdefault(owner_id, set()).add(id_)
+            while len(self._entries) > self.capacity:
+                self._discard(next(iter(self._entries)))
+
+    def _discard(self, id_, cascade=True):
+        entry = self._entries.pop(id_, None)
+        if entry is not None and entry[2] is not None:
+            members = self._members.get(entry[2])
+            if members is not None:
+                members.discard(id_)
+                if not members:
+                    del self._members[entry[2]]
+        if cascade:
+            for member_id in self._members.pop(id_, ()):
+                self._discard(member_id)
+
+    def rev(self, id_):
+        """
+        :return: the revision of the document the entry is built from, None if
+            it's not in the map
+        """
+        entry = self._entries.get(id_)
+        return entry and entry[0]
+
+    def invalidate(self, id_):
+        """
+        discard the entry and the entries belong to it
+        """
+        with self._lock:
+            self._discard(id_)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._members.clear()
@@ -3,6 +3,7 @@
 from hashlib import md5
 
 from CodernityDB.hash_index import HashIndex
+from CodernityDB.tree_index import TreeBasedIndex
 
 from lite_task_flow import constants
 
@@ -23,5 +24,161 @@ class TaskIndex(HashIndex):
     def make_key(self, key):
         return md5(key['task_flow_id'] + key['tag']).digest()
 
+class TaskFlowTasksIndex(HashIndex):
+    """
+    an index indexed by task flow id, each entry carries the task document, so
+    all the tasks of a task flow could be loaded in one scan
+    """
+    custom_header = "from lite_task_flow import constants"
+
+    def __init__(self, *args, **kwargs):
+        kwargs['key_format'] = '16s'
+        super(TaskFlowTasksIndex, self).__init__(*args, **kwargs)
+
+    def make_key_value(self, data):
+        if data['t'] == constants.TASK_TYPE_CODE:
+            value = dict((k, v) for k, v in data.items() if k not in ('_id', '_rev'))
+            return md5(data.get('task_flow_id')).digest(), value
+
+    def make_key(self, key):
+        return md5(key).digest()
+
+class UniqueKeyTreeIndex(TreeBasedIndex):
+    """
+    a tree based index whose keys are unique, the document's id is appended to
+    the key made by 'make_key_value' (which isn't given the id), so the entries
+    of the same key are ordered by id, and a range could be read by pages, each
+    page starts right after the last key of the previous one. note, 'key_format'
+    should count the 32 characters of the id
+    """
+
+    def insert(self, doc_id, key, start, size, status='o'):
+        return super(UniqueKeyTreeIndex, self).insert(doc_id, key + doc_id, start, size, status)
+
+    def update(self, doc_id, key, u_start=0, u_size=0, u_status='o'):
+        return super(UniqueKeyTreeIndex, self).update(doc_id, key + doc_id, u_start, u_size, u_status)
+
+    def delete(self, doc_id, key, start=0, size=0):
+        return super(UniqueKeyTreeIndex, self).delete(doc_id, key + doc_id, start, size)
+
+class TaskFlowStatusIndex(UniqueKeyTreeIndex):
+    """
+    an index of task flows ordered by status, failed, create time and id, each
+    entry carries the root task's class of the task flow
+    """
+    custom_header = """from lite_task_flow.indexes import UniqueKeyTreeIndex
+from lite_task_flow import constants"""
+
+    def __init__(self, *args, **kwargs):
+        kwargs['key_format'] = '53s'
+        super(TaskFlowStatusIndex, self).__init__(*args, **kwargs)
+
+    def make_key_value(self, data):
+        if data['t'] == constants.TASK_FLOW_TYPE_CODE:
+            return ('%d%d%s' % (data['status'], data['failed'], data.get('create_time', '')),
+                    {'root_task_cls': data['root_task_cls']})
+
+    def make_key(self, key):
+        return key
+
+class PendingTaskIndex(UniqueKeyTreeIndex):
+    """
+    an index of the tasks submitted but neither approved nor refused, ordered
+    by the task's class, create time and id
+    """
+    custom_header = """from hashlib import md5
+from lite_task_flow.indexes import UniqueKeyTreeIndex
+from lite_task_flow import constants"""
+
+    def __init__(self, *args, **kwargs):
+        kwargs['key_format'] = '83s'
+        super(PendingTaskIndex, self).__init__(*args, **kwargs)
+
+    def make_key_value(self, data):
+        if (data['t'] == constants.TASK_TYPE_CODE and not data['approved'] and
+                not data.get('refused')):
+            return md5(data['cls']).hexdigest() + data['create_time'], None
+
+    def make_key(self, key):
+        return key
+
+class QueueItemIndex(UniqueKeyTreeIndex):
+    """
+    an index of the items of the execution queue ordered by status, create
+    time and id
+    """
+    custom_header = """from lite_task_flow.indexes import UniqueKeyTreeIndex
+from lite_task_flow import constants"""
+
+    def __init__(self, *args, **kwargs):
+        kwargs['key_format'] = '52s'
+        super(QueueItemIndex, self).__init__(*args, **kwargs)
+
+    def make_key_value(self, data):
+        if data['t'] == constants.QUEUE_ITEM_TYPE_CODE:
+            return '%d%s' % (data['status'], data['create_time']), None
+
+    def make_key(self, key):
+        return key
+
+class HookEventIndex(UniqueKeyTreeIndex):
+    """
+    an index of the hook events ordered by status, due time and id, the events
+    recorded before 'due_time' was added are due when created
+    """
+    custom_header = """from lite_task_flow.indexes import UniqueKeyTreeIndex
+from lite_task_flow import constants"""
+
+    def __init__(self, *args, **kwargs):
+        kwargs['key_format'] = '52s'
+        super(HookEventIndex, self).__init__(*args, **kwargs)
+
+    def make_key_value(self, data):
+        if data['t'] == constants.HOOK_EVENT_TYPE_CODE:
+            return '%d%s' % (data['status'], data.get('due_time') or data['create_time']), None
+
+    def make_key(self, key):
+        return key
+
+class TimerIndex(UniqueKeyTreeIndex):
+    """
+    an index of the timers ordered by status, due time and id
+    """
+    custom_header = """from lite_task_flow.indexes import UniqueKeyTreeIndex
+from lite_task_flow import constants"""
+
+    def __init__(self, *args, **kwargs):
+        kwargs['key_format'] = '52s'
+        super(TimerIndex, self).__init__(*args, **kwargs)
+
+    def make_key_value(self, data):
+        if data['t'] == constants.TIMER_TYPE_CODE:
+            return '%d%s' % (data['status'], data['due_time']), None
+
+    def make_key(self, key):
+        return key
+
+_INDEXES = [
+    (TaskIndex, 'task'),
+    (TaskFlowTasksIndex, 'task_flow_tasks'),
+    (TaskFlowStatusIndex, 'task_flow_status'),
+    (PendingTaskIndex, 'pending_task'),
+    (QueueItemIndex, 'queue_item'),
+    # it was 'hook_event' ordered by create time, which is left unused in the
+    # databases upgraded
+    (HookEventIndex, 'due_hook_event'),
+    (TimerIndex, 'timer'),
+]
+
 def add_index(db):
-    db.add_index(TaskIndex(db.path, 'task'))
+    """
+    add the indexes the engine needs to the (opened) database, the ones it has
+    already are skipped, and the ones added are built from the documents
+    stored. so it's also how a database created by an older version is
+    upgraded: open it and invoke this before the engine uses it
+    """
+    for index_cls, name in _INDEXES:
+        if name in db.indexes_names:
+            continue
+        db.add_index(index_cls(db.path, name))
+        db.reindex_index(name)
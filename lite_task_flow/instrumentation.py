@@ -0,0 +1,284 @@
+# -*- coding: UTF-8 -*-
+"""
+the instrumentation of the engine, it reports the storage operations (by
+operation and index) and the time spent in the steps of the task flows (spans)
+to the subscribers, e.g.
+
+    exporter = PrometheusTextExporter('/var/lib/node_exporter/task_flow.prom')
+    TaskFlowEngine(db, instrumentation=Instrumentation([exporter]))
+
+the spans are:
+
+    * 'retry': TaskFlow.retry, namely approving a task and executing the task
+      flow if all the tasks are approved
+    * 'find_next_unmet_task': searching for the next task to be approved
+    * 'execute': executing a task flow (or Task.execute), labeled by the
+      class of the (root) task
+    * 'call': the body ('__call__') of a task, labeled by the task's class
+
+if the engine isn't instrumented (by default), nothing but a check is performed
+"""
+import os
+import threading
+from functools import wraps
+from timeit import default_timer
+
+from lite_task_flow.task_flow_engine import TaskFlowEngine
+from lite_task_flow.backends import Backend
+
+
+class Subscriber(object):
+    """
+    the subscriber of the instrumentation, it does nothing by default. note,
+    the methods may be invoked from several threads
+    """
+
+    def on_storage(self, operation, index):
+        """
+        invoked when the storage is accessed
+
+        :param operation: 'get', 'insert', 'update' or 'query'
+        :param index: the index accessed, namely 'id', 'task', 'task_flow_tasks',
+            'task_flow_status', 'pending_task' or 'queue_item'
+        """
+        pass
+
+    def on_span(self, name, seconds, labels):
+        """
+        invoked when a span ends
+
+        :param seconds: the time spent in the span
+        :param labels: a dict describes the span, e.g. {'task': 'FooTask'}
+        """
+        pass
+
+
+class Instrumentation(object):
+    """
+    dispatch the storage operations and the spans to the subscribers
+    """
+
+    def __init__(self, subscribers=None):
+        self.subscribers = list(subscribers or [])
+
+    def subscribe(self, subscriber):
+        """
+        :type subscriber: Subscriber
+        """
+        self.subscribers.append(subscriber)
+
+    def storage(self, operation, index):
+        for subscriber in self.subscribers:
+            subscriber.on_storage(operation, index)
+
+    def span(self, name, **labels):
+        """
+        :return: a context manager times the block
+        """
+        return _Span(self, name, labels)
+
+    def end_span(self, name, seconds, labels):
+        for subscriber in self.subscribers:
+            subscriber.on_span(name, seconds, labels)
+
+
+class _Span(object):
+
+    def __init__(self, instrumentation, name, labels):
+        self.instrumentation = instrumentation
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = default_timer()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.instrumentation.end_span(self.name, default_timer() - self.start, self.labels)
+
+
+class _NullSpan(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+# a context manager does nothing, e.g. when the engine isn't instrumented
+NULL_SPAN = _NullSpan()
+
+
+def span(name, **labels):
+    """
+    :return: a context manager times the block if the engine is instrumented,
+        else one does nothing
+    """
+    instrumentation = TaskFlowEngine.instance.instrumentation
+    if instrumentation is None:
+        return NULL_SPAN
+    return instrumentation.span(name, **labels)
+
+
+def instrumented(name):
+    """
+    a decorator times the method as span 'name' if the engine is instrumented
+    """
+    def _decorator(method):
+        @wraps(method)
+        def _wrapper(*args, **kwargs):
+            instrumentation = TaskFlowEngine.instance.instrumentation
+            if instrumentation is None:
+                return method(*args, **kwargs)
+            with instrumentation.span(name):
+                return method(*args, **kwargs)
+        return _wrapper
+    return _decorator
+
+
+class InstrumentedBackend(Backend):
+    """
+    a backend reports each access to the backend it wraps, the engine wraps its
+    backend with it if it's instrumented
+    """
+
+    def __init__(self, backend, instrumentation):
+        self.backend = backend
+        self.instrumentation = instrumentation
+
+    def get(self, id_):
+        self.instrumentation.storage('get', 'id')
+        return self.backend.get(id_)
+
+    def get_many(self, ids):
+        self.instrumentation.storage('get', 'id')
+        return self.backend.get_many(ids)
+
+    def get_task(self, task_flow_id, tag):
+        self.instrumentation.storage('get', 'task')
+        return self.backend.get_task(task_flow_id, tag)
+
+    def get_tasks(self, keys):
+        self.instrumentation.storage('get', 'task')
+        return self.backend.get_tasks(keys)
+
+    def get_task_flow_tasks(self, task_flow_id):
+        self.instrumentation.storage('get', 'task_flow_tasks')
+        return self.backend.get_task_flow_tasks(task_flow_id)
+
+    def iter_task_flow_ids(self, status=None, failed=None, root_task_cls=None, batch_size=100,
+                           keyed=False):
+        self.instrumentation.storage('query', 'task_flow_status')
+        return self.backend.iter_task_flow_ids(status, failed, root_task_cls, batch_size, keyed)
+
+    def iter_pending_task_ids(self, task_cls, batch_size=100, keyed=False):
+        self.instrumentation.storage('query', 'pending_task')
+        return self.backend.iter_pending_task_ids(task_cls, batch_size, keyed)
+
+    def iter_queue_item_ids(self, status, batch_size=100, keyed=False):
+        self.instrumentation.storage('query', 'queue_item')
+        return self.backend.iter_queue_item_ids(status, batch_size, keyed)
+
+    def iter_hook_event_ids(self, status, batch_size=100, keyed=False):
+        self.instrumentation.storage('query', 'hook_event')
+        return self.backend.iter_hook_event_ids(status, batch_size, keyed)
+
+    def iter_timer_ids(self, status, batch_size=100, keyed=False):
+        self.instrumentation.storage('query', 'timer')
+        return self.backend.iter_timer_ids(status, batch_size, keyed)
+
+    def insert(self, doc):
+        self.instrumentation.storage('insert', 'id')
+        return self.backend.insert(doc)
+
+    def insert_many(self, docs, defer_indexes=False):
+        for doc in docs:
+            self.instrumentation.storage('insert', 'id')
+        return self.backend.insert_many(docs, defer_indexes)
+
+    def deferred_indexes(self):
+        return self.backend.deferred_indexes()
+
+    def update(self, doc):
+        self.instrumentation.storage('update', 'id')
+        return self.backend.update(doc)
+
+    def update_many(self, docs, inserts=()):
+        for doc in docs:
+            self.instrumentation.storage('update', 'id')
+        for doc in inserts:
+            self.instrumentation.storage('insert', 'id')
+        return self.backend.update_many(docs, inserts)
+
+
+def _labels(labels):
+    return ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                    for k, v in sorted(labels))
+
+
+class PrometheusTextExporter(Subscriber):
+    """
+    aggregate the storage operations and the spans, and write them to a file
+    in the Prometheus text format (e.g. for the textfile collector of
+    node_exporter). the file is written by 'write', or at most every 'interval'
+    seconds when something is reported
+    """
+
+    def __init__(self, path, interval=None):
+        """
+        :param path: the path of the file
+        :param interval: if provided, the file is written automatically
+        """
+        self.path = path
+        self.interval = interval
+        self.storage_operations = {}
+        self.spans = {}
+        self._last_written = default_timer()
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+
+    def on_storage(self, operation, index):
+        key = (('index', index), ('operation', operation))
+        with self._lock:
+            self.storage_operations[key] = self.storage_operations.get(key, 0) + 1
+        self._write_if_due()
+
+    def on_span(self, name, seconds, labels):
+        key = (('span', name),) + tuple(sorted(labels.items()))
+        with self._lock:
+            count, total = self.spans.get(key, (0, 0.0))
+            self.spans[key] = count + 1, total + seconds
+        self._write_if_due()
+
+    def _write_if_due(self):
+        if self.interval is not None and default_timer() - self._last_written >= self.interval:
+            self.write()
+
+    def render(self):
+        """
+        :return: the metrics in the Prometheus text format
+        """
+        with self._lock:
+            storage_operations = sorted(self.storage_operations.items())
+            spans = sorted(self.spans.items())
+        lines = ['# HELP lite_task_flow_storage_operations_total the storage operations by index',
+                 '# TYPE lite_task_flow_storage_operations_total counter']
+        for key, count in storage_operations:
+            lines.append('lite_task_flow_storage_operations_total{%s} %d' % (_labels(key), count))
+        lines.extend(['# HELP lite_task_flow_span_seconds the time spent in the steps of task flows',
+                      '# TYPE lite_task_flow_span_seconds summary'])
+        for key, (count, total) in spans:
+            lines.append('lite_task_flow_span_seconds_count{%s} %d' % (_labels(key), count))
+            lines.append('lite_task_flow_span_seconds_sum{%s} %.6f' % (_labels(key), total))
+        return '\n'.join(lines) + '\n'
+
+    def write(self):
+        """
+        write the metrics to the file, the file is replaced atomically
+        """
+        with self._write_lock:
+            self._last_written = default_timer()
+            tmp_path = '%s.%d.tmp' % (self.path, os.getpid())
+            with open(tmp_path, 'w') as f:
+                f.write(self.render())
+            os.rename(tmp_path, self.path)
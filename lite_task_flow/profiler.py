@@ -0,0 +1,197 @@
+# -*- coding: UTF-8 -*-
+"""
+an opt-in profiler of the execution of a task flow, e.g.
+
+    with profile(task_flow) as report:
+        task_flow.approve(task)
+    print report.render()
+
+it records the wall time and the CPU time of each task's body ('__call__') and
+'after_executed', and finds the critical path, namely the chain of dependent
+tasks which takes the longest time.
+
+note, the CPU time is the calling thread's where it's supported (namely
+time.thread_time), otherwise it's the process's, which counts the other
+threads, so it's only accurate when the tasks are executed serially. the
+bodies performed in a ProcessPoolExecutor aren't measured, since they're
+performed out of the task flow (see execution_plan.perform_task)
+"""
+import threading
+import time
+from contextlib import contextmanager
+from timeit import default_timer
+
+from lite_task_flow.task_flow_engine import TaskFlowEngine
+from lite_task_flow.execution_plan import ExecutionPlan
+from lite_task_flow.instrumentation import NULL_SPAN
+
+# the CPU time of the calling thread if it's supported, else the process's
+_cpu_time = getattr(time, 'thread_time', time.clock)
+
+
+class TaskProfile(object):
+    """
+    the time spent on a task, the times are accumulated if the task is executed
+    several times
+    """
+
+    def __init__(self, tag, cls):
+        self.tag = tag
+        self.cls = cls
+        self.calls = 0
+        self.call_wall = 0.0
+        self.call_cpu = 0.0
+        self.after_executed_wall = 0.0
+        self.after_executed_cpu = 0.0
+
+    @property
+    def wall(self):
+        return self.call_wall + self.after_executed_wall
+
+    @property
+    def cpu(self):
+        return self.call_cpu + self.after_executed_cpu
+
+    def as_dict(self):
+        return dict(tag=self.tag, cls=self.cls, calls=self.calls, call_wall=self.call_wall,
+                    call_cpu=self.call_cpu, after_executed_wall=self.after_executed_wall,
+                    after_executed_cpu=self.after_executed_cpu)
+
+
+class ExecutionProfile(object):
+    """
+    the profile of the execution of a task flow
+    """
+
+    def __init__(self, task_flow):
+        """
+        :type task_flow: lite_task_flow.task_flow.TaskFlow
+        """
+        self.task_flow = task_flow
+        self.tasks = {}
+        self.wall = 0.0
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # the lock can't be pickled
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def measure(self, task, phase):
+        """
+        measure the block as the 'phase' ('call' or 'after_executed') of the task
+        """
+        wall, cpu = default_timer(), _cpu_time()
+        try:
+            yield
+        finally:
+            wall, cpu = default_timer() - wall, _cpu_time() - cpu
+            with self._lock:
+                task_profile = self.tasks.get(task.tag)
+                if task_profile is None:
+                    task_profile = self.tasks[task.tag] = TaskProfile(task.tag, task.__class__.__name__)
+                if phase == 'call':
+                    task_profile.calls += 1
+                    task_profile.call_wall += wall
+                    task_profile.call_cpu += cpu
+                else:
+                    task_profile.after_executed_wall += wall
+                    task_profile.after_executed_cpu += cpu
+
+    def critical_path(self):
+        """
+        :return: the tags of the chain of dependent tasks which takes the longest
+            (wall) time, from LEAF to ROOT, and the time it takes
+        """
+        plan = ExecutionPlan(self.task_flow.root_task)
+        finish = {}
+        previous = {}
+        for tag in plan.order:
+            task_profile = self.tasks.get(tag)
+            start = 0.0
+            for dep_tag in plan.dependencies[tag]:
+                if finish[dep_tag] > start:
+                    start, previous[tag] = finish[dep_tag], dep_tag
+            finish[tag] = start + (task_profile.wall if task_profile else 0.0)
+        path = []
+        tag = plan.root_task.tag
+        while tag is not None:
+            path.append(tag)
+            tag = previous.get(tag)
+        path.reverse()
+        return path, finish[plan.root_task.tag]
+
+    def slowest(self, n=5):
+        """
+        :return: the profiles of the 'n' tasks which take the longest (wall) time
+        :rtype: list of TaskProfile
+        """
+        return sorted(self.tasks.values(), key=lambda task_profile: -task_profile.wall)[:n]
+
+    def as_dict(self):
+        path, seconds = self.critical_path()
+        return dict(wall=self.wall,
+                    tasks=dict((tag, task_profile.as_dict()) for tag, task_profile in self.tasks.items()),
+                    critical_path=path,
+                    critical_path_wall=seconds)
+
+    def render(self):
+        """
+        :return: a human readable report
+        """
+        path, seconds = self.critical_path()
+        lines = ['task flow %s: %.3f s, critical path %.3f s: %s' % (
+            self.task_flow.id_, self.wall, seconds, ' -> '.join(path))]
+        lines.append('%-20s %-20s %6s %10s %10s %10s' % ('tag', 'class', 'calls', 'wall s', 'cpu s',
+                                                         'hook s'))
+        for task_profile in self.slowest(len(self.tasks)):
+            lines.append('%-20s %-20s %6d %10.4f %10.4f %10.4f' % (
+                task_profile.tag, task_profile.cls, task_profile.calls, task_profile.call_wall,
+                task_profile.call_cpu, task_profile.after_executed_wall))
+        return '\n'.join(lines)
+
+
+def measure(task, phase):
+    """
+    :return: a context manager measures the block as the 'phase' of the task if
+        its task flow is being profiled, else one does nothing
+    """
+    execution_profile = getattr(task.task_flow, 'profile', None)
+    if execution_profile is None:
+        return NULL_SPAN
+    return execution_profile.measure(task, phase)
+
+
+@contextmanager
+def profile(task_flow, persist=False):
+    """
+    profile the execution of the task flow in the block
+
+    :param persist: if the profile is saved in the task flow's document (as
+        'profile') after the block
+    :return: a context manager returns an ExecutionProfile
+    """
+    execution_profile = ExecutionProfile(task_flow)
+    task_flow.profile = execution_profile
+    start = default_timer()
+    try:
+        yield execution_profile
+    finally:
+        execution_profile.wall = default_timer() - start
+        task_flow.profile = None
+        if persist:
+            engine = TaskFlowEngine.instance
+            doc = engine.get_doc(task_flow.id_)
+            doc['profile'] = execution_profile.as_dict()
+            # the revision of the task flow is moved along, unless it's stale
+            # already, then it still conflicts
+            stale = task_flow.rev != doc['_rev']
+            engine.update_doc(doc)
+            if not stale:
+                engine.after_written(lambda: setattr(task_flow, 'rev', doc['_rev']))
@@ -0,0 +1,180 @@
+# -*- coding: UTF-8 -*-
+"""
+the deadlines of the approvals. when a task whose class declares 'timeout' is
+submitted (saved), a timer due in 'timeout' seconds is stored in the engine's
+backend. the timers are indexed by due time, so the earliest one is found
+without scanning, like the top of a min heap, and registering or firing a
+timer costs O(log n) no matter how many approvals are open.
+
+the scheduler (TimeoutScheduler) fires the due timers: if the task still waits
+for approval, its 'on_timeout' hook is invoked, and the task flow is refused if
+the task's class declares 'refuse_on_timeout'. the timers of the tasks approved
+(or refused) are not removed when approved, they're discarded when due.
+
+a timer is claimed by compare-and-swap before fired, so it's fired at most once
+even if there're several schedulers
+"""
+import logging
+import threading
+from datetime import datetime, timedelta
+
+from lite_task_flow.task_flow_engine import TaskFlowEngine
+from lite_task_flow import constants
+from lite_task_flow.exceptions import DocumentNotFound, DocumentConflict
+
+logger = logging.getLogger(__name__)
+
+
+def _format(time):
+    return time.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def timer_doc(task, now=None):
+    """
+    :return: the document of the timer of the task, None if the task has no
+        deadline
+    """
+    if task.timeout is None or task.approved:
+        return None
+    now = now or datetime.now()
+    return dict(t=constants.TIMER_TYPE_CODE, status=constants.TIMER_PENDING,
+                task_flow_id=task.task_flow.id_, cls=task.__class__.__name__,
+                extra_params=task.extra_params, create_time=_format(now),
+                due_time=_format(now + timedelta(seconds=task.timeout)))
+
+
+def schedule(task):
+    """
+    store the timer of the task if it has a deadline
+
+    :return: the id of the timer, None if the task has no deadline
+    """
+    doc = timer_doc(task)
+    if doc is None:
+        return None
+    return TaskFlowEngine.instance.insert_doc(doc)['_id']
+
+
+class TimeoutScheduler(object):
+    """
+    fire the due timers (see the module's doc)
+    """
+
+    def __init__(self, batch_size=100):
+        """
+        :param batch_size: the number of the timers read in a page
+        """
+        self.batch_size = batch_size
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def _iter_pending(self):
+        engine = TaskFlowEngine.instance
+        for timer_id in engine.iter_timer_ids(constants.TIMER_PENDING, self.batch_size):
+            try:
+                doc = engine.backend.get(timer_id)
+            except DocumentNotFound:
+                continue
+            if doc['status'] == constants.TIMER_PENDING:
+                yield doc
+
+    def next_due_time(self):
+        """
+        :return: the due time of the earliest pending timer, None if there's no
+            pending timer
+        """
+        for doc in self._iter_pending():
+            return datetime.strptime(doc['due_time'], "%Y-%m-%d %H:%M:%S")
+        return None
+
+    def fire_due(self, now=None):
+        """
+        fire the timers due by now, from the earliest one
+
+        :return: the number of the timers claimed
+        """
+        now = _format(now or datetime.now())
+        claimed = 0
+        for doc in self._iter_pending():
+            if doc['due_time'] > now:
+                break
+            doc['status'] = constants.TIMER_FIRED
+            doc['fire_time'] = now
+            try:
+                TaskFlowEngine.instance.backend.update(doc)
+            except DocumentConflict:
+                # claimed by another scheduler
+                continue
+            claimed += 1
+            try:
+                self.fire(doc)
+            except Exception:
+                logger.exception('failed to fire the timer of task flow %s', doc['task_flow_id'])
+        return claimed
+
+    def fire(self, doc):
+        """
+        invoke the 'on_timeout' hook of the timer's task if it's still waiting
+        for approval, else discard the timer
+        """
+        from lite_task_flow.functions import get_task_flow
+
+        engine = TaskFlowEngine.instance
+        task_flow = get_task_flow(doc['task_flow_id'])
+        task = None
+        if task_flow is not None and task_flow.status == constants.TASK_FLOW_PROCESSING:
+            task_cls = engine.registered_task_cls_map[doc['cls']]
+            task = task_cls(task_flow, **doc['extra_params']).checkout()
+        if task is None or task.approved:
+            doc['status'] = constants.TIMER_DISCARDED
+            engine.backend.update(doc)
+            return
+        task.invoke_hook('on_timeout')
+        if task.refuse_on_timeout:
+            task_flow.refuse(task)
+
+    def run(self, poll_interval=1.0, drain=False):
+        """
+        fire the timers when they're due until 'stop' is invoked
+
+        :param poll_interval: the max seconds to wait for the next due timer,
+            the timers stored by others are found in this time
+        :param drain: if True, return when nothing is due
+        :return: the number of the timers claimed
+        """
+        claimed = 0
+        while not self._stopped.is_set():
+            try:
+                n = self.fire_due()
+                next_due_time = self.next_due_time()
+            except Exception:
+                logger.exception('failed to fire the timers')
+                n, next_due_time = 0, None
+            claimed += n
+            if n:
+                continue
+            if drain:
+                break
+            timeout = poll_interval
+            if next_due_time is not None:
+                timeout = min(timeout, max((next_due_time - datetime.now()).total_seconds(), 0))
+            self._stopped.wait(timeout)
+        return claimed
+
+    def start(self, poll_interval=1.0):
+        """
+        fire the timers in a daemon thread of the calling process
+        """
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self.run, args=(poll_interval,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        stop firing the timers, the timer being fired is finished
+        """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
@@ -0,0 +1,103 @@
+# -*- coding: UTF-8 -*-
+from lite_task_flow.constants import TASK_TYPE_CODE
+
+
+class Session(object):
+    """
+    a unit of work, it keeps the documents loaded (with their revisions) and
+    tracks the documents changed, the changes are written back in one batch
+    when the session is flushed. each document is written at most once per
+    flush, no matter how many times it's changed
+    """
+
+    def __init__(self, backend):
+        """
+        :type backend: lite_task_flow.backends.Backend
+        """
+        self.backend = backend
+        self.docs = {}
+        self.task_doc_ids = {}
+        self.dirty_ids = []
+        self.inserts = []
+        self.callbacks = []
+
+    def track(self, doc):
+        """
+        keep the document in the session, so it will be reused
+        """
+        self.docs[doc['_id']] = doc
+        if doc.get('t') == TASK_TYPE_CODE:
+            self.task_doc_ids[(doc['task_flow_id'], doc['tag'])] = doc['_id']
+        return doc
+
+    def get(self, id_):
+        """
+        get the document by id
+
+        :raise DocumentNotFound: if there's no such document
+        """
+        try:
+            return self.docs[id_]
+        except KeyError:
+            return self.track(self.backend.get(id_))
+
+    def get_task_doc(self, task_flow_id, tag):
+        """
+        get the document of the task by task flow id and tag
+
+        :raise DocumentNotFound: if there's no such document
+        """
+        try:
+            return self.docs[self.task_doc_ids[(task_flow_id, tag)]]
+        except KeyError:
+            return self.track(self.backend.get_task(task_flow_id, tag))
+
+    def task_docs(self, task_flow_id):
+        """
+        :return: the documents of the task flow's tasks loaded in this session
+        """
+        return [self.docs[id_] for (task_flow_id_, tag), id_ in self.task_doc_ids.items()
+                if task_flow_id_ == task_flow_id]
+
+    def insert(self, doc):
+        """
+        insert the document, it's written immediately, since its id is needed
+        """
+        ret = self.backend.insert(doc)
+        self.track(doc)
+        return ret
+
+    def add(self, doc):
+        """
+        add the new document, it will be inserted along with the changes when
+        flushed
+        """
+        self.inserts.append(doc)
+
+    def update(self, doc):
+        """
+        mark the document as changed, it will be written when flushed
+        """
+        self.track(doc)
+        if doc['_id'] not in self.dirty_ids:
+            self.dirty_ids.append(doc['_id'])
+
+    def flush(self):
+        """
+        write all the changed documents and the new ones, in one transaction if
+        the backend supports
+        """
+        dirty_ids, self.dirty_ids = self.dirty_ids, []
+        inserts, self.inserts = self.inserts, []
+        callbacks, self.callbacks = self.callbacks, []
+        if dirty_ids or inserts:
+            self.backend.update_many([self.docs[id_] for id_ in dirty_ids], inserts)
+        for callback in callbacks:
+            callback()
+
+    def after_flush(self, callback):
+        """
+        invoke the callback after the changes are written by the next flush, it's
+        discarded if the flush fails
+        """
+        self.callbacks.append(callback)
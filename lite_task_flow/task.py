@@ -2,15 +2,32 @@
 from datetime import datetime
 
 from lite_task_flow.task_flow_engine import TaskFlowEngine
-from lite_task_flow.exceptions import TaskUnsubmitted, TaskAlreadyApproved
+from lite_task_flow.exceptions import (TaskUnsubmitted, TaskAlreadyApproved, DocumentNotFound,
+                                       DocumentConflict)
 from lite_task_flow.constants import TASK_TYPE_CODE, TASK_FLOW_EXECUTED
-from CodernityDB.database import RecordNotFound
+from lite_task_flow.execution_plan import ExecutionPlan
+from lite_task_flow.instrumentation import span
+from lite_task_flow.profiler import measure
+from lite_task_flow.scheduler import schedule
+from lite_task_flow import transition_log
 
 class Task(object):
     """
     represent a node in the flow
     """
 
+    # declare it if the task tree rooted by the task depends only on the class
+    # and 'extra_params' of the task, then the tree is compiled once into a
+    # template and the tasks are instantiated from it, instead of getting
+    # 'dependencies' each time it's walked (see execution_plan.GraphTemplate)
+    static_dependencies = False
+    # the seconds the task waits for approval after it's submitted, then it
+    # times out (see 'on_timeout' and lite_task_flow.scheduler), None for no
+    # deadline
+    timeout = None
+    # if the task flow is refused when the task times out
+    refuse_on_timeout = False
+
     def __init__(self, task_flow, **kwargs):
         """
         :param task_flow: the task flow to attach
@@ -19,8 +36,16 @@ class Task(object):
         self.extra_params = kwargs
         self.approved = False
         self.failed = False
+        self.executed = False
         self.approved_time = None
         self.create_time = None
+        # the revision of the document the task is checked out from, the task
+        # is updated only if its document is still of this revision, None to
+        # update whatever the revision is
+        self.rev = None
+        # the document of the approval being written, kept until it's written
+        # successfully
+        self._approval_doc = None
 
     @property
     def tag(self):
@@ -30,20 +55,29 @@ class Task(object):
         """
         return NotImplemented
 
-    def checkout(self):
+    def checkout(self, task_docs=None):
         """
         checkout the status from disk
+
+        :param task_docs: the task documents of the task flow (indexed by tag), if
+            provided, the status is checked out from it instead of disk
+        :type task_docs: DictType
         """
-        try:
-            task_doc = TaskFlowEngine.instance.db.get('task', {'task_flow_id': self.task_flow.id_,
-                                                       'tag': self.tag},
-                                              with_doc=True)['doc']
-            self.id_ = task_doc['_id']
-            self.approved = task_doc['approved']
-            self.failed = task_doc['failed']
-            self.extra_params = task_doc['extra_params']
-        except RecordNotFound:
-            pass
+        if task_docs is None:
+            try:
+                task_doc = TaskFlowEngine.instance.get_task_doc(self.task_flow.id_, self.tag)
+            except DocumentNotFound:
+                return self
+        else:
+            task_doc = task_docs.get(self.tag)
+            if task_doc is None:
+                return self
+        self.id_ = task_doc['_id']
+        self.approved = task_doc['approved']
+        self.failed = task_doc['failed']
+        self.executed = task_doc.get('executed', False)
+        self.extra_params = task_doc['extra_params']
+        self.rev = task_doc.get('_rev')
         return self
 
     def init_from_doc(self, doc):
@@ -52,19 +86,27 @@ class Task(object):
         """
         self.approved = doc['approved']
         self.failed = doc['failed']
+        self.executed = doc.get('executed', False)
         self.create_time = doc['create_time']
         self.approved_time = doc.get('approved_time')
         self.id_ = doc['_id']
+        self.rev = doc.get('_rev')
 
-    def update(self, attr):
+    def update(self, *attrs):
         '''
         the opposite operation of checkout
+
+        :raise DocumentConflict: if the task has been changed by others since
+            it's checked out (see 'rev')
         '''
-        task_doc = TaskFlowEngine.instance.db.get('task', {'task_flow_id': self.task_flow.id_,
-                                                   'tag': self.tag},
-                                          with_doc=True)['doc']
-        task_doc[attr] = getattr(self, attr)
-        TaskFlowEngine.instance.db.update(task_doc)
+        engine = TaskFlowEngine.instance
+        task_doc = engine.get_task_doc(self.task_flow.id_, self.tag)
+        if self.rev is not None and task_doc['_rev'] != self.rev:
+            raise DocumentConflict(task_doc['_id'])
+        for attr in attrs:
+            task_doc[attr] = getattr(self, attr)
+        engine.update_doc(task_doc)
+        engine.after_written(lambda: setattr(self, 'rev', task_doc['_rev']))
 
     def __call__(self):
         """
@@ -88,42 +130,102 @@ class Task(object):
 
     def execute(self):
         """
-        execute the task, all the dependent tasks will be executed at first
+        execute the task, all the dependent tasks will be executed at first, the
+        tasks executed successfully are skipped
         """
-        for task in self.dependencies:
-            task.execute()
-        if not self.task_flow.status == TASK_FLOW_EXECUTED or self.failed:
-            try:
-                self()
-                self.failed = False
-                self.update('failed')
-                self.after_executed()
-            except:
-                self.failed = True
-                self.update('failed')
-                raise
+        with span('execute', task=self.__class__.__name__):
+            ExecutionPlan(self).checkout(self.task_flow.load_task_docs()).execute()
+
+    def execute_alone(self):
+        """
+        execute the task only, the dependent tasks are supposed to be executed
+        """
+        if self.executable:
+            self.record_execution(self.perform)
+
+    def perform(self):
+        """
+        perform the body of the task ('__call__')
+
+        :return: what the body returns
+        """
+        with span('call', task=self.__class__.__name__):
+            with measure(self, 'call'):
+                return self()
+
+    @property
+    def executable(self):
+        """
+        if the task should be executed, namely it hasn't been executed
+        successfully
+        """
+        if self.failed:
+            return True
+        # the tasks executed before 'executed' was saved have no checkpoint
+        return not (self.executed or self.task_flow.status == TASK_FLOW_EXECUTED)
+
+    def record_execution(self, run):
+        """
+        run the body of the task, and save the result of the execution
+
+        :param run: a callable performs the task's body, it may be the task
+            itself, or something collects the result of the body performed
+            elsewhere (e.g. Future.result)
+        """
+        try:
+            run()
+            self.failed = False
+            self.executed = True
+            self.update('failed', 'executed')
+            with measure(self, 'after_executed'):
+                self.invoke_hook('after_executed')
+            # the checkpoint (along with the hook's event if it's dispatched)
+            # is written at once, so it isn't discarded with the session if
+            # the task flow conflicts afterwards
+            TaskFlowEngine.instance.flush()
+        except:
+            self.failed = True
+            self.update('failed')
+            raise
 
     def approve(self):
         """
-        approve the task, this method will save the task's status
+        approve the task, this method will save the task's status. if the
+        approval is written by a failed attempt of the same approval (e.g. the
+        backend writes a batch one by one, and conflicts in the middle), it's
+        approved already, and nothing is done
         :raise TaskAlreadyApproved: if the task has been approved already
         :raise TaskUnsubmitted: if the task hasn't been submitted (because the task
             is NOT the NEXT task in task flow to be handled)
         """
+        engine = TaskFlowEngine.instance
         try:
-            doc = TaskFlowEngine.instance.db.get('task', dict(task_flow_id=self.task_flow.id_, tag=self.tag), with_doc=True)['doc']
-        except RecordNotFound:
+            doc = engine.get_task_doc(self.task_flow.id_, self.tag)
+        except DocumentNotFound:
             raise TaskUnsubmitted()
         if doc['approved']:
+            # the backends set the revision written on the document, so it's of
+            # the revision stored if it's written by a failed attempt
+            approval_doc = self._approval_doc
+            if approval_doc is not None and approval_doc is not doc and \
+                    approval_doc['_rev'] == doc['_rev']:
+                return
             raise TaskAlreadyApproved()
 
         self.approved = True
         self.approved_time = datetime.now()
         doc['approved'] = True
         doc['approved_time'] = self.approved_time.strftime("%Y-%m-%d %H:%M:%S")
-        TaskFlowEngine.instance.db.update(doc)
-        self.on_approved()
+        engine.update_doc(doc)
+        self._approval_doc = doc
+        engine.after_written(lambda: self._approval_written(doc))
+        engine.log_transition(transition_log.TASK_APPROVED, self.task_flow.id_, tag=self.tag)
+        self.invoke_hook('on_approved')
  
+    def _approval_written(self, doc):
+        self.rev = doc['_rev']
+        self._approval_doc = None
+
     def on_refused(self, caused_by_me):
         """
         invoked when the task flow is refused, and the task is submitted and wait for
@@ -138,19 +240,44 @@ class Task(object):
         """
         save the task on disk
         """
-        self.create_time = datetime.now()
-        d = dict(t=TASK_TYPE_CODE,
-                 task_flow_id=self.task_flow.id_,
-                 tag=self.tag,
-                 approved=self.approved,
-                 failed=self.failed,
-                 extra_params=self.extra_params,
-                 create_time=self.create_time.strftime("%Y-%m-%d %H:%M:%S"),
-                 cls=self.__class__.__name__)
-        ret = TaskFlowEngine.instance.db.insert(d)
+        ret = TaskFlowEngine.instance.insert_doc(self.as_doc())
         self.id_ = ret['_id']
+        self.rev = ret['_rev']
+        schedule(self)
+        TaskFlowEngine.instance.log_transition(transition_log.TASK_SAVED, self.task_flow.id_,
+                                               tag=self.tag)
         return ret
 
+    def as_doc(self):
+        """
+        :return: the document of the task to save, the create time is set to now
+        """
+        self.create_time = datetime.now()
+        return dict(t=TASK_TYPE_CODE,
+                    task_flow_id=self.task_flow.id_,
+                    tag=self.tag,
+                    approved=self.approved,
+                    failed=self.failed,
+                    executed=self.executed,
+                    extra_params=self.extra_params,
+                    create_time=self.create_time.strftime("%Y-%m-%d %H:%M:%S"),
+                    cls=self.__class__.__name__)
+
+    def invoke_hook(self, hook, *args):
+        """
+        invoke the hook (e.g. 'on_approved', 'on_delayed', 'on_refused',
+        'after_executed') of the task, if the engine has a hook dispatcher, the
+        invocation is recorded and delivered in background instead
+
+        :param hook: name of the hook
+        :return: what the hook returns, None if it's dispatched
+        """
+        dispatcher = TaskFlowEngine.instance.hook_dispatcher
+        if dispatcher is not None and dispatcher.dispatches(hook):
+            dispatcher.record(self, hook, *args)
+            return None
+        return getattr(self, hook)(*args)
+
     def on_delayed(self, unmet_task):
         """
         invoked when the task flow is delayed due to a task that hasn't been approved,
@@ -166,3 +293,10 @@ class Task(object):
         invoked when the task is approved
         """
         pass
+
+    def on_timeout(self):
+        """
+        invoked when the task isn't approved in 'timeout' seconds after it's
+        submitted, it's a good place to escalate the task
+        """
+        pass
@@ -1,12 +1,38 @@
 # -*- coding: UTF-8 -*-
-from CodernityDB.database import RecordNotFound
 from lite_task_flow.task_flow_engine import TaskFlowEngine
 from lite_task_flow import constants
-from lite_task_flow.exceptions import TaskFlowRefused, TaskFlowDelayed, TaskFlowProcessing
+from lite_task_flow.execution_plan import ExecutionPlan, walk, ENTER
+from lite_task_flow.exceptions import (TaskFlowRefused, TaskFlowDelayed, TaskFlowProcessing,
+                                       DocumentConflict, TaskAlreadyApproved, TaskUnsubmitted)
+from lite_task_flow.instrumentation import span, instrumented
+from lite_task_flow.execution_queue import enqueue
+from lite_task_flow import transition_log
+
+class ApprovalOutcome(object):
+    """
+    the outcome of approving a task in a batch (see TaskFlow.approve_many)
+    """
+
+    def __init__(self, task, status, unmet_task=None, error=None):
+        """
+        :param status: one of constants.APPROVAL_*
+        :param unmet_task: the next task waiting for approval if the task flow
+            is delayed
+        :param error: the exception raised if the status is APPROVAL_FAILED
+        """
+        self.task = task
+        self.status = status
+        self.unmet_task = unmet_task
+        self.error = error
+
+    def __repr__(self):
+        return '<ApprovalOutcome %s: %d>' % (self.task.tag, self.status)
+
 
 class TaskFlow(object):
 
-    def __init__(self, id_, annotation, status=constants.TASK_FLOW_PROCESSING, failed=False):
+    def __init__(self, id_, annotation, status=constants.TASK_FLOW_PROCESSING, failed=False,
+                 rev=None):
         """
         :param id_: id of the task flow
         :type id_: StringType
@@ -14,12 +40,18 @@ class TaskFlow(object):
         :type annotaion: StringType
         :param status: status of the task flow
         :param failed: if the task flow's execution failed
+        :param rev: the revision of the document the task flow is loaded from,
+            the task flow is updated only if its document is still of this
+            revision, None to update whatever the revision is
         """
         self.id_ = id_
         self.annotation = annotation
         self.status = status
         self.failed = failed
+        self.rev = rev
         self.root_task = None
+        # the profile of the execution if it's being profiled, see lite_task_flow.profiler
+        self.profile = None
 
     def set_root_task(self, root_task):
         """
@@ -27,29 +59,25 @@ class TaskFlow(object):
         """
         self.root_task = root_task
 
+    @instrumented('retry')
     def retry(self, last_operated_task):
         """
         test if all the tasks are approved, if they are, execute the tasks from
-        LEAF to ROOT
+        LEAF to ROOT, or enqueue the task flow if the engine executes in
+        background
 
         :raise: TaskFlowRefused when the task flow has been refused
         :raise: TaskFlowDelayed when there exists task that hasn't been approved
         """
-        if self.status == constants.TASK_FLOW_REFUSED:
-            raise TaskFlowRefused()
-        # then we test if all the (indirect) depenecies of ROOT are met
-        unmet_task = self._find_next_unmet_task(self.root_task)
-        if unmet_task:
-            unmet_task.save()
-            last_operated_task.on_delayed(unmet_task)
-            raise TaskFlowDelayed(unmet_task, "task %s is not met" % unicode(unmet_task))
-
-        self.status = constants.TASK_FLOW_APPROVED
-        self.update()
+        task_docs = self._check_all_approved(last_operated_task)
+        if TaskFlowEngine.instance.background_execution:
+            # enqueued along with the approval
+            return
 
         # execute all the tasks
         try:
-            self.root_task.execute()
+            with span('execute', task=self.root_task.__class__.__name__):
+                self.execution_plan(task_docs).execute(TaskFlowEngine.instance.executor)
             self.failed = False
             self.status = constants.TASK_FLOW_EXECUTED
             self.update()
@@ -59,91 +87,277 @@ class TaskFlow(object):
             raise
 
 
-    def execute(self):
+    def _check_all_approved(self, last_operated_task):
+        """
+        test if all the tasks are approved, if they are, the task flow is approved
+        (and enqueued if the engine executes in background)
+
+        :raise: TaskFlowRefused when the task flow has been refused
+        :raise: TaskFlowDelayed when there exists task that hasn't been approved
+        :return: the task documents of the task flow (indexed by tag)
+        """
+        # the task flow may be refused by others since it's loaded, then 'update'
+        # below raises DocumentConflict, and it's checked again after refreshed
+        if self.status == constants.TASK_FLOW_REFUSED:
+            raise TaskFlowRefused()
+        # then we test if all the (indirect) depenecies of ROOT are met
+        task_docs = self.load_task_docs()
+        with span('find_next_unmet_task'):
+            unmet_task = self._find_next_unmet_task(self.root_task, task_docs)
+        if unmet_task:
+            # the task flow's revision is changed by each approval, so the
+            # concurrent approvals of the task flow conflict
+            self.update()
+            TaskFlowEngine.instance.flush()
+            if unmet_task.tag in task_docs:
+                unmet_task.checkout(task_docs)
+            else:
+                unmet_task.save()
+            last_operated_task.invoke_hook('on_delayed', unmet_task)
+            raise TaskFlowDelayed(unmet_task, "task %s is not met" % unicode(unmet_task))
+
+        self.status = constants.TASK_FLOW_APPROVED
+        self.update()
+        if TaskFlowEngine.instance.background_execution:
+            # the item is written along with the approval, so an approved task
+            # flow is never left unqueued, and it's never claimed before approved
+            enqueue(self)
+        # the approval is written before the execution, so the task flow is
+        # executed only by the one wins
+        TaskFlowEngine.instance.flush()
+        return task_docs
+
+    def execute(self, executor=None):
         """
-        execute the task flow
+        execute the task flow, the tasks executed successfully are skipped, so
+        a failed execution resumes from the failed tasks (and the tasks depend
+        on them)
         you must guarantee each task is a transaction
 
+        :param executor: if provided, the independent tasks are executed
+            concurrently in it, default to the engine's executor
+        :type executor: concurrent.futures.Executor
         :raise TaskFlowRefused: if task flow is refused
         :raise TaskFlowProcessing: if task flow is processing
+        :raise DocumentConflict: if the task flow is changed by others
+            concurrently, and it still conflicts after retried
         :raise Exception: any exceptions raised when executing tasks
         """
+        self._transact(self._execute, executor)
+
+    def _execute(self, executor):
         if self.status == constants.TASK_FLOW_REFUSED:
             raise TaskFlowRefused()
         elif self.status == constants.TASK_FLOW_PROCESSING:
             raise TaskFlowProcessing()
+        # the revision is claimed before any task is performed, so a stale task
+        # flow is refreshed (and checked again) instead of executing the tasks
+        self.update()
+        TaskFlowEngine.instance.flush()
         try:
-            self.root_task.execute()
+            with span('execute', task=self.root_task.__class__.__name__):
+                self.execution_plan().execute(executor or TaskFlowEngine.instance.executor)
             self.failed = False
-            self.status == constants.TASK_FLOW_EXECUTED
+            self.status = constants.TASK_FLOW_EXECUTED
             self.update()
         except:
             self.failed = True
             self.update()
             raise
 
+    def execution_plan(self, task_docs=None):
+        """
+        build the execution plan of the task flow, namely the dependency DAG of
+        the root task, the status of the tasks is checked out
+
+        :param task_docs: the task documents of the task flow (indexed by tag),
+            loaded by 'load_task_docs' if not provided
+        :rtype: lite_task_flow.execution_plan.ExecutionPlan
+        """
+        if task_docs is None:
+            task_docs = self.load_task_docs()
+        return ExecutionPlan(self.root_task).checkout(task_docs)
+
     def approve(self, task):
         """
-        approve the task
+        approve the task, the changes of the approval are written in one batch
+        before the task flow is executed
+
+        :raise DocumentConflict: if the task flow is changed by others
+            concurrently, and it still conflicts after retried
         """
+        self._transact(self._approve, task)
+
+    def _approve(self, task):
         task.approve()
         self.retry(task)
 
+    def approve_many(self, tasks):
+        """
+        approve the tasks of this task flow, all the approvals are written in
+        one batch, and the task flow is retried once after all of them. the
+        exceptions are not raised but reported as the outcomes
+
+        :return: the outcomes of the tasks, in the same order
+        :rtype: list of ApprovalOutcome
+        """
+        try:
+            return self._transact(self._approve_many, tasks)
+        except DocumentConflict as e:
+            return [ApprovalOutcome(task, constants.APPROVAL_FAILED, error=e) for task in tasks]
+
+    def _approve_many(self, tasks):
+        outcomes = []
+        approved = []
+        for task in tasks:
+            try:
+                task.approve()
+            except TaskAlreadyApproved:
+                outcomes.append(ApprovalOutcome(task, constants.APPROVAL_ALREADY_APPROVED))
+                continue
+            except TaskUnsubmitted:
+                outcomes.append(ApprovalOutcome(task, constants.APPROVAL_UNSUBMITTED))
+                continue
+            outcome = ApprovalOutcome(task, constants.APPROVAL_EXECUTED)
+            outcomes.append(outcome)
+            approved.append(outcome)
+        if not approved:
+            return outcomes
+        try:
+            self.retry(approved[-1].task)
+        except TaskFlowDelayed as e:
+            for outcome in approved:
+                outcome.status = constants.APPROVAL_DELAYED
+                outcome.unmet_task = e.task
+        except TaskFlowRefused:
+            for outcome in approved:
+                outcome.status = constants.APPROVAL_REFUSED
+        except DocumentConflict:
+            raise
+        except Exception as e:
+            for outcome in approved:
+                outcome.status = constants.APPROVAL_FAILED
+                outcome.error = e
+        return outcomes
+
+    def _transact(self, operation, *args):
+        """
+        perform the operation in a session, if its changes conflict with others',
+        the task flow is reloaded, and the operation is performed again (at most
+        'conflict_retries' times of the engine). note, the hooks invoked by the
+        failed attempts are not undone
+        """
+        engine = TaskFlowEngine.instance
+        if engine.current_session is not None:
+            return operation(*args)
+        attempts = 0
+        while True:
+            try:
+                with engine.session():
+                    return operation(*args)
+            except DocumentConflict:
+                attempts += 1
+                if attempts > engine.conflict_retries:
+                    raise
+                self.refresh()
+
+    def refresh(self):
+        """
+        reload the status of the task flow from disk
+        """
+        doc = TaskFlowEngine.instance.get_doc(self.id_)
+        self.status = doc['status']
+        self.failed = doc['failed']
+        self.rev = doc['_rev']
+        return self
+
     def update(self):
         """
         update task flow's status on disk
+
+        :raise DocumentConflict: if the task flow has been changed by others
+            since it's loaded (see 'rev')
         """
-        doc = TaskFlowEngine.instance.db.get('id', self.id_, with_doc=True)
+        engine = TaskFlowEngine.instance
+        doc = engine.get_doc(self.id_)
+        if self.rev is not None and doc['_rev'] != self.rev:
+            raise DocumentConflict(self.id_)
+        changed = (doc['status'], doc['failed']) != (self.status, self.failed)
         doc['status'] = self.status
         doc['failed'] = self.failed
-        TaskFlowEngine.instance.db.update(doc)
+        engine.update_doc(doc)
+        engine.after_written(lambda: setattr(self, 'rev', doc['_rev']))
+        event = transition_log.task_flow_event(self.status, self.failed)
+        if changed and event is not None:
+            engine.log_transition(event, self.id_)
 
-    def _find_next_unmet_task(self, task):
+    def load_task_docs(self):
+        """
+        load all the task documents of this task flow in one scan
+
+        :return: a dict of task documents, indexed by task tag
+        """
+        return TaskFlowEngine.instance.get_task_docs(self.id_)
+
+    def _find_next_unmet_task(self, task, task_docs=None):
         """
         find the next unapproved task (note, if the task is waiting for approvement, it will not be returned)
 
         :param task: search from it
         :type task: request_flow.Task
+        :param task_docs: the task documents of the task flow (indexed by tag),
+            loaded by 'load_task_docs' if not provided
+        :raise DependencyCycle: if a task depends on itself
         """
-        if not task.approved:
-            return task
-
-        for dep_task in task.dependencies:
-            try:
-                dep_task_data = TaskFlowEngine.instance.db.get('task', dict(task_flow_id=dep_task.task_flow.id_,
-                                                                    tag=dep_task.tag), with_doc=True)
-                dep_task.init_from_doc(dep_task_data['doc'])
-            except RecordNotFound:
-                pass
-            unmet_task = self._find_next_unmet_task(dep_task)
-            if unmet_task:
-                return unmet_task
+        if task_docs is None:
+            task_docs = self.load_task_docs()
+        for event, task_, _ in walk(task):
+            if event != ENTER:
+                continue
+            if task_ is not task:
+                task_doc = task_docs.get(task_.tag)
+                if task_doc:
+                    task_.init_from_doc(task_doc)
+            if not task_.approved:
+                return task_
 
     def start(self):
         """
-        start this task flow
+        start this task flow, the changes of the approval are written in one
+        batch before the task flow is executed
         """
-        self.root_task.approve()
-        self.retry(self.root_task)
+        self._transact(self._approve, self.root_task)
 
     def refuse(self, task):
         """
-        refuse the task flow
+        refuse the task flow, the changes are written in one batch at last
         :param task: the task refused DIRECTLY
         """
-        doc = TaskFlowEngine.instance.db.get('id', self.id_)
-        self.status = doc['status'] = constants.TASK_FLOW_REFUSED
-        TaskFlowEngine.instance.db.update(doc)
-        self._refuse_task_tree(self.root_task, task)
+        self._transact(self._refuse, task)
+
+    def _refuse(self, task):
+        self.status = constants.TASK_FLOW_REFUSED
+        self.update()
+        task_docs = self.load_task_docs()
+        # withdraw the tasks waiting for approving from the pending tasks
+        for tag, task_doc in task_docs.items():
+            if not task_doc['approved']:
+                task_doc = TaskFlowEngine.instance.get_task_doc(self.id_, tag)
+                task_doc['refused'] = True
+                TaskFlowEngine.instance.update_doc(task_doc)
+        self._refuse_task_tree(self.root_task, task, task_docs)
 
-    def _refuse_task_tree(self, task, cause_task):
+    def _refuse_task_tree(self, task, cause_task, task_docs):
         """
-        refuse the task tree roote by 'task'
+        refuse the task tree roote by 'task', each task is refused once even if
+        it's shared by several tasks
 
         :param task: the task tree's root
         :param cause_task: the task refused directly
+        :param task_docs: the task documents of the task flow (indexed by tag)
+        :raise DependencyCycle: if a task depends on itself
         """
-        task.checkout()
-        task.on_refused(task.tag == cause_task.tag)
-        for t in task.dependencies:
-            self._refuse_task_tree(t, cause_task)
+        for event, task_, _ in walk(task):
+            if event == ENTER:
+                task_.checkout(task_docs)
+                task_.invoke_hook('on_refused', task_.tag == cause_task.tag)
@@ -1,13 +1,366 @@
 # -*- coding: UTF-8 -*-
+import logging
+import sys
+import threading
+from contextlib import contextmanager
 
-from lite_task_flow.indexes import TaskIndex
+from lite_task_flow.backends import Backend
+from lite_task_flow.session import Session
+from lite_task_flow.identity_map import IdentityMap
+from lite_task_flow.constants import TASK_TYPE_CODE
+from lite_task_flow.exceptions import DocumentConflict
+
+logger = logging.getLogger(__name__)
 
 class TaskFlowEngine(object):
 
     instance = None
 
-    def __init__(self, db):
+    def __init__(self, db, executor=None, identity_map_size=0, instrumentation=None,
+                 background_execution=False, conflict_retries=3, hook_dispatcher=None,
+                 transition_log=None):
+        """
+        :param db: the database where task flows are stored, either a backend
+            (see lite_task_flow.backends) or a CodernityDB database
+        :param executor: if provided, the independent tasks of a task flow are
+            executed concurrently in it, if it's a ProcessPoolExecutor, see
+            execution_plan.perform_task for what the tasks must be
+        :type executor: concurrent.futures.Executor
+        :param identity_map_size: if positive, at most this number of task flows
+            and tasks are kept in the identity map (see 'get_task_flow' and
+            'get_task'). the entries are invalidated by the changes written by
+            this engine, and validated against the revisions of the documents
+            when they're hit, so the changes made by other processes (e.g. the
+            workers) are seen. note, a task flow's entry is validated against
+            the task flow's document, which is changed by each operation on the
+            task flow, rather than the documents of its tasks
+        :param instrumentation: if provided, the storage operations and the
+            steps of the task flows are reported to it
+        :type instrumentation: lite_task_flow.instrumentation.Instrumentation
+        :param background_execution: if True, a task flow is enqueued instead of
+            being executed when all of its tasks are approved, and it's executed
+            by the workers (see lite_task_flow.worker)
+        :param conflict_retries: the max times an operation (start, approve or
+            refuse) is performed again when its changes conflict with others'
+        :param hook_dispatcher: if provided, the hooks of the tasks are recorded
+            and delivered by it in background instead of being invoked inline
+        :type hook_dispatcher: lite_task_flow.hooks.HookDispatcher
+        :param transition_log: if provided, the state transitions of the task
+            flows and tasks are appended to it
+        :type transition_log: lite_task_flow.transition_log.TransitionLog
+        """
         self.db = db
+        if isinstance(db, Backend):
+            self.backend = db
+        else:
+            from lite_task_flow.backends.codernity import CodernityBackend
+            self.backend = CodernityBackend(db)
+        self.instrumentation = instrumentation
+        if instrumentation is not None:
+            from lite_task_flow.instrumentation import InstrumentedBackend
+            self.backend = InstrumentedBackend(self.backend, instrumentation)
+        self.executor = executor
+        self.background_execution = background_execution
+        self.conflict_retries = conflict_retries
+        self.hook_dispatcher = hook_dispatcher
+        self.transition_log = transition_log
+        self.identity_map = IdentityMap(identity_map_size) if identity_map_size > 0 else None
+        self._storage_executor = None
+        self._storage_executor_lock = threading.Lock()
+        self._local = threading.local()
         self.registered_task_cls_map = {}
         TaskFlowEngine.instance = self
 
+    @property
+    def storage_executor(self):
+        """
+        the single thread executor where the asynchronous api
+        (lite_task_flow.async_task_flow) accesses the storage and invokes hooks,
+        it's shared by all the task flows
+        """
+        with self._storage_executor_lock:
+            if self._storage_executor is None:
+                from concurrent.futures import ThreadPoolExecutor
+                self._storage_executor = ThreadPoolExecutor(max_workers=1)
+        return self._storage_executor
+
+    @property
+    def current_session(self):
+        """
+        the session of the calling thread, None if there's no session
+        """
+        return getattr(self._local, 'session', None)
+
+    @contextmanager
+    def session(self):
+        """
+        a context manager of unit of work, all the documents changed in it are
+        written in one batch when it exits, even if an exception is raised (the
+        exception is re-raised, not the one raised when writing), except
+        DocumentConflict, then the changes are discarded, since they may be
+        based on stale documents. if there's a session already, it's reused,
+        and the changes are written when the outermost one exits.
+
+        note, the documents changed are invisible to the database's queries
+        before written
+        """
+        session = self.current_session
+        if session is not None:
+            yield session
+            return
+        session = self._local.session = Session(self.backend)
+        try:
+            yield session
+        except DocumentConflict:
+            self._local.session = None
+            raise
+        except:
+            self._local.session = None
+            exc_info = sys.exc_info()
+            try:
+                session.flush()
+            except Exception:
+                logger.exception('failed to write the changes of the session')
+            raise exc_info[0], exc_info[1], exc_info[2]
+        self._local.session = None
+        session.flush()
+
+    def flush(self):
+        """
+        write the changes of the session now if there's a session
+
+        :raise DocumentConflict: if any document changed has been changed by
+            others since read
+        """
+        session = self.current_session
+        if session is not None:
+            session.flush()
+
+    def get_doc(self, id_):
+        """
+        :raise DocumentNotFound: if there's no such document
+        """
+        session = self.current_session
+        if session is not None:
+            return self._seen(session.get(id_))
+        return self._seen(self.backend.get(id_))
+
+    def get_task_doc(self, task_flow_id, tag):
+        """
+        get the document of the task by task flow id and tag
+
+        :raise DocumentNotFound: if there's no such document
+        """
+        session = self.current_session
+        if session is not None:
+            return self._seen(session.get_task_doc(task_flow_id, tag))
+        return self._seen(self.backend.get_task(task_flow_id, tag))
+
+    def get_docs(self, ids):
+        """
+        get the documents by ids in one pass, each id is read once
+
+        :return: a dict of documents indexed by id, the ids not found are absent
+        """
+        ret = {}
+        session = self.current_session
+        if session is not None:
+            ret.update((id_, session.docs[id_]) for id_ in ids if id_ in session.docs)
+        missing = [id_ for id_ in set(ids) if id_ not in ret]
+        if missing:
+            docs = self.backend.get_many(missing)
+            if session is not None:
+                for doc in docs.values():
+                    session.track(doc)
+            ret.update(docs)
+        for doc in ret.values():
+            self._seen(doc)
+        return ret
+
+    def get_task_docs_by_keys(self, keys):
+        """
+        get the task documents by (task flow id, tag) pairs in one pass, each
+        pair is read once
+
+        :return: a dict of task documents indexed by (task flow id, tag), the
+            pairs not found are absent
+        """
+        ret = {}
+        session = self.current_session
+        if session is not None:
+            for key in keys:
+                if key in session.task_doc_ids:
+                    ret[key] = session.docs[session.task_doc_ids[key]]
+        missing = [key for key in set(keys) if key not in ret]
+        if missing:
+            docs = self.backend.get_tasks(missing)
+            if session is not None:
+                for doc in docs.values():
+                    session.track(doc)
+            ret.update(docs)
+        for doc in ret.values():
+            self._seen(doc)
+        return ret
+
+    def get_task_docs(self, task_flow_id):
+        """
+        get all the task documents of the task flow in one scan
+
+        :return: a dict of task documents, indexed by task tag
+        """
+        ret = dict((doc['tag'], doc) for doc in self.backend.get_task_flow_tasks(task_flow_id))
+        session = self.current_session
+        if session is not None:
+            for doc in session.task_docs(task_flow_id):
+                ret[doc['tag']] = doc
+        return ret
+
+    def iter_task_flow_ids(self, status=None, failed=None, root_task_cls=None, batch_size=100):
+        """
+        iterate over the ids of the task flows ordered by status, failed and
+        create time, by pages of 'batch_size' entries
+
+        :param status: only the task flows of this status if provided
+        :param failed: only the task flows (not) failed if provided
+        :param root_task_cls: only the task flows of this root task's class
+            (name) if provided
+        """
+        return self.backend.iter_task_flow_ids(status, failed, root_task_cls, batch_size)
+
+    def iter_pending_task_ids(self, task_cls, batch_size=100):
+        """
+        iterate over the ids of the tasks submitted but neither approved nor
+        refused, ordered by create time, by pages of 'batch_size' entries
+
+        :param task_cls: the tasks' class (name)
+        """
+        return self.backend.iter_pending_task_ids(task_cls, batch_size)
+
+    def iter_queue_item_ids(self, status, batch_size=100):
+        """
+        iterate over the ids of the items of the execution queue of the status,
+        ordered by create time, by pages of 'batch_size' entries
+        """
+        return self.backend.iter_queue_item_ids(status, batch_size)
+
+    def iter_hook_event_ids(self, status, batch_size=100):
+        """
+        iterate over the ids of the hook events of the status, ordered by
+        due time, by pages of 'batch_size' entries
+        """
+        return self.backend.iter_hook_event_ids(status, batch_size)
+
+    def iter_timer_ids(self, status, batch_size=100):
+        """
+        iterate over the ids of the timers of the status, ordered by due time,
+        by pages of 'batch_size' entries
+        """
+        return self.backend.iter_timer_ids(status, batch_size)
+
+    def insert_doc(self, doc):
+        """
+        :return: a dict contains '_id' and '_rev' of the document
+        """
+        session = self.current_session
+        if session is not None:
+            ret = session.insert(doc)
+        else:
+            ret = self.backend.insert(doc)
+        self._changed(doc)
+        return ret
+
+    def add_doc(self, doc):
+        """
+        insert the document along with the changes of the session when it's
+        flushed (in one transaction if the backend supports), or at once if
+        there's no session. note, it's invisible before written
+        """
+        session = self.current_session
+        if session is not None:
+            session.add(doc)
+            session.after_flush(lambda: self._changed(doc))
+        else:
+            self.backend.insert(doc)
+            self._changed(doc)
+
+    def insert_docs(self, docs, defer_indexes=False):
+        """
+        insert the documents in one pass, they're written immediately even if
+        there's a session
+
+        :param defer_indexes: if True, the documents may be indexed when the
+            enclosing 'deferred_indexes' exits
+        :return: a list of dicts contain '_id' and '_rev' of the documents
+        """
+        ret = self.backend.insert_many(docs, defer_indexes)
+        session = self.current_session
+        for doc in docs:
+            if session is not None:
+                session.track(doc)
+            self._changed(doc)
+        return ret
+
+    def deferred_indexes(self):
+        """
+        a context manager for bulk loading, the indexes of the documents inserted
+        with 'defer_indexes' in it are built when it exits, see
+        lite_task_flow.backends.Backend.deferred_indexes
+        """
+        return self.backend.deferred_indexes()
+
+    def log_transition(self, event, task_flow_id, **fields):
+        """
+        append the transition to the transition log if there's one, if there's
+        a session, it's appended after the changes are written
+        """
+        if self.transition_log is not None:
+            self.after_written(lambda: self.transition_log.log(event, task_flow_id, **fields))
+
+    def after_written(self, callback):
+        """
+        invoke the callback after the changes made so far are written, namely
+        at once if there's no session, else after the session is flushed (it's
+        discarded if the flush fails)
+        """
+        session = self.current_session
+        if session is not None:
+            session.after_flush(callback)
+        else:
+            callback()
+
+    def update_doc(self, doc):
+        """
+        write the document, if there's a session, it's written when the session
+        exits
+        """
+        session = self.current_session
+        if session is not None:
+            session.update(doc)
+            if self.identity_map is not None:
+                # the other threads may build the entries from the old revision
+                # before the document is written, invalidate them once it is
+                session.after_flush(lambda: self._changed(doc))
+        else:
+            self.backend.update(doc)
+        self._changed(doc)
+
+    def _seen(self, doc):
+        """
+        invalidate the identity map's entry if the document is of a different
+        revision
+        """
+        if self.identity_map is not None:
+            rev = self.identity_map.rev(doc['_id'])
+            if rev is not None and rev != doc['_rev']:
+                self._changed(doc)
+        return doc
+
+    def _changed(self, doc):
+        """
+        invalidate the identity map's entries built from the document, a task's
+        change invalidates its task flow too
+        """
+        if self.identity_map is not None:
+            self.identity_map.invalidate(doc['_id'])
+            if doc.get('t') == TASK_TYPE_CODE:
+                self.identity_map.invalidate(doc['task_flow_id'])
@@ -0,0 +1,209 @@
+# -*- coding: UTF-8 -*-
+"""
+the append-only log of the state transitions of the task flows and tasks, so
+the consumers could react to them by following (tailing) the log, instead of
+polling the database.
+
+the log is a directory of segments, each segment is a file of JSON lines named
+by the offset of its first record, a new segment is started when the current
+one reaches 'segment_size' bytes. an offset is the position of a record in the
+whole log, namely the offset of its segment plus its position in the segment,
+so it could be used as a cursor.
+
+the transitions made in a session are appended after the changes are written,
+the ones failed to write are never appended.
+
+a log could be appended by several processes (e.g. the workers executing the
+task flows), a record is appended by one write to the segment opened with
+O_APPEND, while the log's lock file is locked (by flock), so the records of
+the processes are never interleaved, and a segment is started by exactly one
+of them. flock isn't available on Windows, where a log should be appended by
+one process
+"""
+import json
+import os
+import threading
+import time
+from bisect import bisect_right
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from lite_task_flow import constants
+
+TASK_SAVED = 'task_saved'
+TASK_APPROVED = 'task_approved'
+TASK_FLOW_APPROVED = 'task_flow_approved'
+TASK_FLOW_EXECUTED = 'task_flow_executed'
+TASK_FLOW_FAILED = 'task_flow_failed'
+TASK_FLOW_REFUSED = 'task_flow_refused'
+
+_TASK_FLOW_EVENTS = {
+    constants.TASK_FLOW_APPROVED: TASK_FLOW_APPROVED,
+    constants.TASK_FLOW_EXECUTED: TASK_FLOW_EXECUTED,
+    constants.TASK_FLOW_REFUSED: TASK_FLOW_REFUSED,
+}
+
+
+def task_flow_event(status, failed):
+    """
+    :return: the event of a task flow becomes of the status, None if there's
+        no such event
+    """
+    if failed:
+        return TASK_FLOW_FAILED
+    return _TASK_FLOW_EVENTS.get(status)
+
+
+class TransitionLog(object):
+    """
+    a segmented append-only log of the transitions (see the module's doc)
+    """
+
+    def __init__(self, path, segment_size=64 * 1024 * 1024):
+        """
+        :param path: the directory of the segments, it's created if absent
+        :param segment_size: a new segment is started when the current one
+            reaches this number of bytes
+        """
+        self.path = path
+        self.segment_size = segment_size
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self._lock = threading.Lock()
+        self._lock_fd = self._fd = None
+        self._open_files()
+
+    def _open_files(self):
+        """
+        open the lock file and the last segment, they're opened again in a
+        forked process, since a lock on the descriptors inherited is shared
+        with the parent
+        """
+        self._pid = os.getpid()
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+        self._lock_fd = os.open(os.path.join(self.path, 'lock'), os.O_RDWR | os.O_CREAT)
+        bases = self._segment_bases()
+        self._open_segment(bases[-1] if bases else 0)
+
+    def _open_segment(self, base):
+        if self._fd is not None:
+            os.close(self._fd)
+        self._base = base
+        self._fd = os.open(self._segment_path(base), os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+
+    @contextmanager
+    def _locked(self):
+        """
+        lock the log against the other threads and processes
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                self._open_files()
+            if fcntl is not None:
+                fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+    def _size(self):
+        """
+        :return: the size of the current segment, the segments started by the
+            other processes are followed (should be invoked when locked)
+        """
+        size = os.fstat(self._fd).st_size
+        while size >= self.segment_size and os.path.exists(self._segment_path(self._base + size)):
+            self._open_segment(self._base + size)
+            size = os.fstat(self._fd).st_size
+        return size
+
+    def _segment_path(self, base):
+        return os.path.join(self.path, '%020d.log' % base)
+
+    def _segment_bases(self):
+        return sorted(int(name[:-4]) for name in os.listdir(self.path) if name.endswith('.log'))
+
+    @property
+    def end_offset(self):
+        """
+        the offset of the next record appended
+        """
+        with self._locked():
+            return self._base + self._size()
+
+    def append(self, record):
+        """
+        :param record: a dict could be dumped as JSON
+        :return: the offset of the record
+        """
+        line = json.dumps(record, sort_keys=True) + '\n'
+        with self._locked():
+            size = self._size()
+            if size >= self.segment_size:
+                self._open_segment(self._base + size)
+                size = 0
+            offset = self._base + size
+            while line:
+                line = line[os.write(self._fd, line):]
+        return offset
+
+    def log(self, event, task_flow_id, **fields):
+        """
+        append the transition of the task flow (or its task)
+
+        :param event: TASK_SAVED, TASK_APPROVED, etc.
+        :return: the offset of the record
+        """
+        fields.update(event=event, task_flow_id=task_flow_id,
+                      time=datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+        return self.append(fields)
+
+    def follow(self, from_offset=0, poll_interval=0.1, wait=True):
+        """
+        a generator of the records from 'from_offset', the segments are read
+        sequentially by file position
+
+        :param from_offset: 0, or an offset yielded before
+        :param poll_interval: the seconds to wait for the records to append
+        :param wait: if True, wait for the records to append at the end of the
+            log, else return
+        :return: a generator of (the offset after the record, record), namely
+            the offset to follow from to get the records after it
+        """
+        offset = from_offset
+        while True:
+            bases = self._segment_bases()
+            index = max(bisect_right(bases, offset) - 1, 0)
+            base = bases[index]
+            offset = max(offset, base)
+            with open(self._segment_path(base), 'rb') as f:
+                f.seek(offset - base)
+                # a segment is complete once the next one is started
+                complete = index + 1 < len(bases)
+                while True:
+                    position = f.tell()
+                    line = f.readline()
+                    if line.endswith('\n'):
+                        offset = base + position + len(line)
+                        yield offset, json.loads(line)
+                        continue
+                    f.seek(position)
+                    if complete:
+                        break
+                    # read the rest again, since the records may be appended
+                    # before the next segment is started
+                    complete = index + 1 < len(self._segment_bases())
+                    if complete:
+                        continue
+                    if not wait:
+                        return
+                    time.sleep(poll_interval)
+            # namely the offset of the next segment
+            offset = base + position
@@ -0,0 +1,129 @@
+# -*- coding: UTF-8 -*-
+"""
+the workers execute the task flows in the execution queue (see
+lite_task_flow.execution_queue), run:
+
+    python -m lite_task_flow.worker myapp.task_flows:setup --processes 4
+
+'setup' is invoked in each worker process, it should create the engine (with
+a backend shared by the processes, e.g. SQLiteBackend) and register the task
+classes.
+
+with '--hooks', the workers deliver the hook events instead (see
+lite_task_flow.hooks), the engine created by 'setup' should have a hook
+dispatcher. with '--timeouts', the workers fire the timers of the approvals
+(see lite_task_flow.scheduler)
+"""
+import argparse
+import importlib
+import logging
+import multiprocessing
+import time
+
+from lite_task_flow import execution_queue, constants
+
+logger = logging.getLogger(__name__)
+
+
+def load(path):
+    """
+    :param path: 'module:attribute'
+    """
+    module_name, _, attr = path.partition(':')
+    return getattr(importlib.import_module(module_name), attr)
+
+
+def work(setup=None, poll_interval=1.0, drain=False, lease=300):
+    """
+    execute the queued task flows one by one in the calling process
+
+    :param setup: a callable invoked before working, see the module's doc
+    :param poll_interval: the seconds to wait when nothing is queued
+    :param drain: if True, return when nothing is queued, else wait for more
+    :param lease: the seconds a task flow is reserved for the worker claims
+        it, see lite_task_flow.execution_queue
+    :return: the number of the task flows executed
+    """
+    if setup is not None:
+        setup()
+    worker = execution_queue.worker_id()
+    executed = 0
+    while True:
+        doc = execution_queue.execute_next(worker, lease)
+        if doc is None:
+            if drain:
+                return executed
+            time.sleep(poll_interval)
+            continue
+        executed += 1
+        if doc['status'] == constants.QUEUE_ITEM_FAILED:
+            logger.error('task flow %s failed: %s', doc['task_flow_id'], doc['error'])
+
+
+def deliver_hooks(setup=None, poll_interval=1.0, drain=False):
+    """
+    deliver the hook events batch by batch in the calling process, see 'work'
+
+    :return: the number of the hook events claimed
+    """
+    from lite_task_flow.task_flow_engine import TaskFlowEngine
+
+    if setup is not None:
+        setup()
+    dispatcher = TaskFlowEngine.instance.hook_dispatcher
+    if dispatcher is None:
+        raise ValueError('the engine has no hook dispatcher')
+    return dispatcher.run(poll_interval, drain)
+
+
+def fire_timeouts(setup=None, poll_interval=1.0, drain=False):
+    """
+    fire the timers of the approvals when they're due in the calling process,
+    see 'work'
+
+    :return: the number of the timers claimed
+    """
+    from lite_task_flow.scheduler import TimeoutScheduler
+
+    if setup is not None:
+        setup()
+    return TimeoutScheduler().run(poll_interval, drain)
+
+
+def _work(setup_path, poll_interval, drain, target=work):
+    target(load(setup_path), poll_interval, drain)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='execute the queued task flows (or deliver the '
+                                                 'hook events, or fire the timers)')
+    parser.add_argument('setup', help="'module:callable' invoked in each worker process to create "
+                                      "the engine and register the task classes")
+    parser.add_argument('-n', '--processes', type=int, default=multiprocessing.cpu_count(),
+                        help='the number of worker processes')
+    parser.add_argument('--poll-interval', type=float, default=1.0,
+                        help='the seconds to wait when nothing is queued')
+    parser.add_argument('--drain', action='store_true', help='exit when nothing is queued')
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--hooks', dest='target', action='store_const', const=deliver_hooks,
+                       default=work, help='deliver the hook events instead of executing the task flows')
+    group.add_argument('--timeouts', dest='target', action='store_const', const=fire_timeouts,
+                       help='fire the timers of the approvals instead of executing the task flows')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    processes = [multiprocessing.Process(target=_work, args=(args.setup, args.poll_interval, args.drain,
+                                                             args.target))
+                 for i in xrange(args.processes)]
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.terminate()
+
+
+if __name__ == '__main__':
+    main()
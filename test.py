@@ -1,20 +1,40 @@
 #! /usr/bin/env python
 # -*- coding: UTF-8 -*-
+import os
+import pickle
 import tempfile
 import shutil
 import types
+import threading
+import time
+from datetime import datetime, timedelta
 
 from py.test import raises
 from mock import patch
-from CodernityDB.database import Database
+from CodernityDB.database import Database, IndexNotFoundException
 
 from lite_task_flow import (TaskFlowEngine, Task,  new_task_flow, 
-                                constants, register_task_cls, get_task_flow)
+                                constants, register_task_cls, get_task_flow, get_task,
+                                get_task_from_doc, get_task_flows, get_tasks,
+                                list_task_flows, pending_tasks,
+                                AsyncTask, AsyncTaskFlow, approve_many, new_task_flows)
 
 from lite_task_flow.exceptions import (TaskFlowDelayed, TaskFlowRefused, 
-                                TaskAlreadyApproved, TaskUnsubmitted)
+                                TaskAlreadyApproved, TaskUnsubmitted, DocumentConflict,
+                                DocumentNotFound, DependencyCycle)
 
-from lite_task_flow.indexes import add_index
+from lite_task_flow.indexes import add_index, TaskIndex
+from lite_task_flow.backends.sqlite import SQLiteBackend
+from lite_task_flow.backends.memory import MemoryBackend
+from lite_task_flow.backends.sharded import ShardedBackend
+from lite_task_flow.instrumentation import Instrumentation, Subscriber, PrometheusTextExporter
+from lite_task_flow.profiler import profile
+from lite_task_flow.execution_plan import ExecutionPlan, GraphTemplate
+from lite_task_flow.task_flow import TaskFlow
+from lite_task_flow import execution_queue, worker
+from lite_task_flow.hooks import HookDispatcher
+from lite_task_flow.scheduler import TimeoutScheduler
+from lite_task_flow.transition_log import TransitionLog
 
 
 class BaseTest(object):
@@ -30,12 +50,26 @@ class BaseTest(object):
 
     def run_plainly(self, tests=None):
         self.setup()
-        for k, v in self.__class__.__dict__.items():
-            if k.startswith("test") and isinstance(v, types.FunctionType):
+        # the tests are inherited by the variants (e.g. the in-memory ones)
+        for k in dir(self.__class__):
+            v = getattr(self, k)
+            if k.startswith("test") and isinstance(v, types.MethodType):
                 if not tests or (k in tests):
-                    v(self)
+                    v()
         self.teardown()
 
+class MemoryTest(object):
+    """
+    run the tests against the in-memory backend instead of CodernityDB
+    """
+
+    def setup(self):
+        self.backend = MemoryBackend()
+        self.task_flow_engine = TaskFlowEngine(self.backend)
+
+    def teardown(self):
+        pass
+
 class TestSingleTask(BaseTest):
     def test(self):
 
@@ -251,9 +285,2160 @@ class TestExecution(BaseTest):
         task_flow.approve(B(task_flow))
         assert task_flow.status == constants.TASK_FLOW_EXECUTED
 
+class TestLoadTaskDocs(BaseTest):
 
-if __name__ == "__main__":
-    TestSingleTask().run_plainly()
-    TestMultipleTasks().run_plainly()
-    TestExecution().run_plainly()
+    def test(self):
+
+        class A(Task):
+
+            @property
+            def tag(self):
+                return 'A'
+
+            @property
+            def dependencies(self):
+                return [B(self.task_flow), C(self.task_flow)]
+
+        class B(Task):
+
+            @property
+            def tag(self):
+                return 'B'
+
+        class C(Task):
+
+            @property
+            def tag(self):
+                return 'C'
+
+        task_flow = new_task_flow(A)
+        raises(TaskFlowDelayed, task_flow.start)
+        task_docs = task_flow.load_task_docs()
+        assert set(task_docs.keys()) == {'A', 'B'}
+        assert task_docs['A']['approved']
+        assert not task_docs['B']['approved']
+        assert task_docs['B']['_id'] == B(task_flow).checkout().id_
+
+        b_task = B(task_flow).checkout(task_docs)
+        assert b_task.id_ == task_docs['B']['_id']
+        assert not b_task.approved
+
+        # only the task flow's tasks are loaded
+        other_task_flow = new_task_flow(A)
+        assert other_task_flow.load_task_docs().keys() == ['A']
+
+        with patch.object(self.db, 'get', wraps=self.db.get) as mock_get:
+            raises(TaskFlowDelayed, task_flow.approve, b_task)
+            assert not [call for call in mock_get.call_args_list if call[0][0] == 'task' and 
+                        call[0][1]['tag'] == 'A']
+        assert task_flow.load_task_docs()['B']['approved']
+
+class TestDiamondExecution(BaseTest):
+
+    def test(self):
+
+        class A(Task):
+
+            @property
+            def tag(self):
+                return 'A'
+
+            @property
+            def dependencies(self):
+                return [B(self.task_flow), C(self.task_flow)]
+
+        class B(Task):
+
+            @property
+            def tag(self):
+                return 'B'
+
+            @property
+            def dependencies(self):
+                return [D(self.task_flow)]
+
+        class C(Task):
+
+            @property
+            def tag(self):
+                return 'C'
+
+            @property
+            def dependencies(self):
+                return [D(self.task_flow)]
+
+        class D(Task):
+
+            @property
+            def tag(self):
+                return 'D'
+
+        task_flow = new_task_flow(A)
+        plan = task_flow.execution_plan()
+        assert sorted(plan.tasks.keys()) == ['A', 'B', 'C', 'D']
+        assert plan.dependencies == {'A': ['B', 'C'], 'B': ['D'], 'C': ['D'], 'D': []}
+        assert plan.order == ['D', 'B', 'C', 'A']
+
+        with patch.object(D, "__call__") as call_d:
+            with patch.object(D, "update", autospec=True) as update_d:
+                try:
+                    task_flow.start()
+                except TaskFlowDelayed:
+                    pass
+                for tag in ['B', 'D', 'C']:
+                    task = task_flow.execution_plan().tasks[tag]
+                    try:
+                        task_flow.approve(task)
+                    except TaskFlowDelayed:
+                        pass
+                assert task_flow.status == constants.TASK_FLOW_EXECUTED
+                call_d.assert_called_once_with()
+                assert update_d.call_count == 1
+
+class TestConcurrentExecution(BaseTest):
+
+    def test(self):
+        from concurrent.futures import ThreadPoolExecutor
+
+        c_started = threading.Event()
+        calls = []
+
+        class A(Task):
+
+            @property
+            def tag(self):
+                return 'A'
+
+            def __call__(self):
+                calls.append('A')
+
+            @property
+            def dependencies(self):
+                return [B(self.task_flow), C(self.task_flow)]
+
+        class B(Task):
+
+            @property
+            def tag(self):
+                return 'B'
+
+            def __call__(self):
+                # C is running at the same time
+                assert c_started.wait(5)
+                calls.append('B')
+
+        class C(Task):
+
+            @property
+            def tag(self):
+                return 'C'
+
+            def __call__(self):
+                c_started.set()
+                calls.append('C')
+
+        executor = ThreadPoolExecutor(max_workers=2)
+        self.task_flow_engine.executor = executor
+        task_flow = new_task_flow(A)
+        try:
+            task_flow.start()
+        except TaskFlowDelayed:
+            pass
+        try:
+            task_flow.approve(B(task_flow))
+        except TaskFlowDelayed:
+            pass
+        task_flow.approve(C(task_flow))
+        assert calls == ['C', 'B', 'A']
+        assert task_flow.status == constants.TASK_FLOW_EXECUTED
+        assert not task_flow.failed
+
+        class B_(B):
+
+            def __call__(self):
+                raise RuntimeError()
+
+        class A_(A):
+
+            @property
+            def dependencies(self):
+                return [B_(self.task_flow), C(self.task_flow)]
+
+        del calls[:]
+        task_flow = new_task_flow(A_)
+        try:
+            task_flow.start()
+        except TaskFlowDelayed:
+            pass
+        try:
+            task_flow.approve(B_(task_flow))
+        except TaskFlowDelayed:
+            pass
+        raises(RuntimeError, task_flow.approve, C(task_flow))
+        assert calls == ['C']
+        assert task_flow.failed
+        assert B_(task_flow).checkout().failed
+        assert not C(task_flow).checkout().failed
+        assert not A_(task_flow).checkout().failed
+
+        # C has been executed successfully, only B is performed again
+        raises(RuntimeError, task_flow.execute, executor)
+        assert calls == ['C']
+        executor.shutdown()
+
+# the tasks performed in a ProcessPoolExecutor are pickled by reference, so
+# they are defined at module level
+class ProcessTask(Task):
+
+    @property
+    def tag(self):
+        return self.extra_params['name']
+
+    def __call__(self):
+        with open(self.extra_params['path'], 'a') as f:
+            f.write('%s %d\n' % (self.tag, os.getpid()))
+
+    @property
+    def dependencies(self):
+        return [ProcessTask(self.task_flow, name=name, path=self.extra_params['path'])
+                for name in self.extra_params.get('dependencies', [])]
+
+
+class TestProcessPoolExecution(BaseTest):
+
+    def test(self):
+        from concurrent.futures import ProcessPoolExecutor
+
+        register_task_cls(ProcessTask)
+        path = os.path.join(tempfile.mkdtemp(), 'calls')
+        executor = ProcessPoolExecutor(max_workers=2)
+        self.task_flow_engine.executor = executor
+        try:
+            task_flow = new_task_flow(ProcessTask, name='A', path=path, dependencies=['B', 'C'])
+            try:
+                task_flow.start()
+            except TaskFlowDelayed:
+                pass
+            for tag in ['B', 'C']:
+                try:
+                    task_flow.approve(ProcessTask(task_flow, name=tag, path=path))
+                except TaskFlowDelayed:
+                    pass
+            assert task_flow.status == constants.TASK_FLOW_EXECUTED
+            with open(path) as f:
+                calls = [line.split() for line in f]
+            assert sorted(tag for tag, _ in calls) == ['A', 'B', 'C']
+            assert calls[-1][0] == 'A'
+            # the bodies are performed in the processes of the pool
+            assert str(os.getpid()) not in [pid for _, pid in calls]
+            assert all(task_doc['executed'] for task_doc in task_flow.load_task_docs().values())
+
+            # the tasks can't be pickled fail instead of hanging the pool
+            class B(Task):
+
+                @property
+                def tag(self):
+                    return 'B'
+
+            class A(Task):
+
+                @property
+                def tag(self):
+                    return 'A'
+
+                @property
+                def dependencies(self):
+                    return [B(self.task_flow)]
+            register_task_cls(A)
+            register_task_cls(B)
+
+            task_flow = new_task_flow(A)
+            try:
+                task_flow.start()
+            except TaskFlowDelayed:
+                pass
+            raises(pickle.PicklingError, task_flow.approve, B(task_flow))
+            assert task_flow.load_task_docs()['B']['failed']
+            assert task_flow.failed
+        finally:
+            executor.shutdown()
+            shutil.rmtree(os.path.dirname(path))
+
+class TestAsyncTaskFlow(BaseTest):
+
+    def test(self):
+        from concurrent.futures import Future
+
+        calls = []
+        b_futures = []
+        approved_futures = []
+
+        class A(AsyncTask):
+
+            @property
+            def tag(self):
+                return 'A'
+
+            def __call__(self):
+                calls.append('A')
+
+            @property
+            def dependencies(self):
+                return [B(self.task_flow), C(self.task_flow)]
+        register_task_cls(A)
+
+        class B(AsyncTask):
+
+            @property
+            def tag(self):
+                return 'B'
+
+            def __call__(self):
+                future = Future()
+                b_futures.append(future)
+                return future
+
+            def after_executed(self):
+                calls.append('B')
+
+            def on_approved(self):
+                future = Future()
+                approved_futures.append(future)
+                return future
+
+        class C(Task):
+
+            @property
+            def tag(self):
+                return 'C'
+
+            def __call__(self):
+                calls.append('C')
+
+        task_flow = AsyncTaskFlow(new_task_flow(A))
+        assert isinstance(task_flow.start().exception(5), TaskFlowDelayed)
+
+        future = task_flow.approve(B(task_flow.task_flow))
+        while not approved_futures:
+            time.sleep(0.01)
+        # waits for the future returned by 'on_approved'
+        assert not future.done()
+        approved_futures[0].set_result(None)
+        delayed = future.exception(5)
+        assert isinstance(delayed, TaskFlowDelayed)
+        assert delayed.task.tag == 'C'
+
+        future = task_flow.approve(delayed.task)
+        while not b_futures:
+            time.sleep(0.01)
+        # waits for B's body
+        time.sleep(0.05)
+        assert not future.done()
+        assert calls == ['C']
+        b_futures[0].set_result(None)
+        assert future.result(5) is None
+        assert calls == ['C', 'B', 'A']
+        assert task_flow.task_flow.status == constants.TASK_FLOW_EXECUTED
+        assert get_task_flow(task_flow.task_flow.id_).status == constants.TASK_FLOW_EXECUTED
+
+        # failure of asynchronous body
+        del b_futures[:]
+        task_flow = AsyncTaskFlow(new_task_flow(A))
+        task_flow.start().exception(5)
+        task_flow.approve(B(task_flow.task_flow))
+        while not approved_futures[1:]:
+            time.sleep(0.01)
+        approved_futures[1].set_result(None)
+        future = task_flow.approve(C(task_flow.task_flow))
+        while not b_futures:
+            time.sleep(0.01)
+        b_futures[0].set_exception(RuntimeError())
+        assert isinstance(future.exception(5), RuntimeError)
+        assert task_flow.task_flow.failed
+        assert B(task_flow.task_flow).checkout().failed
+        assert not A(task_flow.task_flow).checkout().failed
+
+        # the approval of a stale task flow is performed again after refreshed
+        fresh = new_task_flow(A)
+        raises(TaskFlowDelayed, fresh.start)
+        stale = AsyncTaskFlow(get_task_flow(fresh.id_))
+        raises(TaskFlowDelayed, fresh.approve, B(fresh))
+        approved_futures[2].set_result(None)
+        future = stale.approve(C(stale.task_flow))
+        while not b_futures[1:] and not future.done():
+            time.sleep(0.01)
+        assert not future.done(), future.exception()
+        b_futures[1].set_result(None)
+        assert future.result(5) is None
+        assert stale.task_flow.status == constants.TASK_FLOW_EXECUTED
+        assert get_task_flow(fresh.id_).status == constants.TASK_FLOW_EXECUTED
+
+        future = task_flow.refuse(B(task_flow.task_flow))
+        assert future.result(5) is None
+        assert get_task_flow(task_flow.task_flow.id_).status == constants.TASK_FLOW_REFUSED
+
+class TestSession(BaseTest):
+
+    def test(self):
+
+        class A(Task):
+
+            @property
+            def tag(self):
+                return 'A'
+
+            @property
+            def dependencies(self):
+                return [B(self.task_flow)]
+        register_task_cls(A)
+
+        class B(Task):
+
+            @property
+            def tag(self):
+                return 'B'
+
+        task_flow = new_task_flow(A)
+        raises(TaskFlowDelayed, task_flow.start)
+        with patch.object(self.db, 'update', wraps=self.db.update) as mock_update:
+            task_flow.approve(B(task_flow))
+            # task flow and B are written once when approved, then task flow,
+            # A and B are written once each when executed
+            assert mock_update.call_count == 5
+        assert get_task_flow(task_flow.id_).status == constants.TASK_FLOW_EXECUTED
+        assert B(task_flow).checkout().approved
+
+        task_flow = new_task_flow(A)
+        with self.task_flow_engine.session() as session:
+            with self.task_flow_engine.session() as session_:
+                assert session_ is session
+            task_flow.root_task.approve()
+            assert session.dirty_ids == [task_flow.root_task.id_]
+            # invisible to the database before written
+            assert not self.db.get('id', task_flow.root_task.id_)['approved']
+            assert A(task_flow).checkout().approved
+            assert task_flow.load_task_docs()['A']['approved']
+            raises(TaskAlreadyApproved, task_flow.approve, A(task_flow))
+        assert self.task_flow_engine.current_session is None
+        assert self.db.get('id', task_flow.root_task.id_)['approved']
+
+        # written even if an exception is raised
+        task_flow = new_task_flow(A)
+        try:
+            with self.task_flow_engine.session():
+                task_flow.root_task.approve()
+                raise RuntimeError()
+        except RuntimeError:
+            pass
+        assert self.db.get('id', task_flow.root_task.id_)['approved']
+
+        # the exception isn't replaced by the one raised when written
+        task_flow = new_task_flow(A)
+        with patch.object(self.task_flow_engine.backend, 'update_many',
+                          side_effect=DocumentConflict()):
+            try:
+                with self.task_flow_engine.session():
+                    task_flow.root_task.approve()
+                    raise RuntimeError()
+            except RuntimeError:
+                pass
+        assert self.task_flow_engine.current_session is None
+
+        # discarded if conflicts, since they may be based on stale documents
+        task_flow = new_task_flow(A)
+        try:
+            with self.task_flow_engine.session():
+                task_flow.root_task.approve()
+                raise DocumentConflict(task_flow.id_)
+        except DocumentConflict:
+            pass
+        assert not self.db.get('id', task_flow.root_task.id_)['approved']
+
+class TestIdentityMap(BaseTest):
+
+    def setup(self):
+        super(TestIdentityMap, self).setup()
+        self.task_flow_engine = TaskFlowEngine(self.db, identity_map_size=4)
+
+    def test(self):
+
+        class A(Task):
+
+            @property
+            def tag(self):
+                return 'A'
+
+            @property
+            def dependencies(self):
+                return [B(self.task_flow)]
+        register_task_cls(A)
+
+        class B(Task):
+
+            @property
+            def tag(self):
+                return 'B'
+        register_task_cls(B)
+
+        identity_map = self.task_flow_engine.identity_map
+        task_flow = new_task_flow(A)
+        task_flow_ = get_task_flow(task_flow.id_)
+        assert identity_map.misses == 1
+        with patch.object(self.db, 'get', wraps=self.db.get) as mock_get:
+            assert get_task_flow(task_flow.id_) is task_flow_
+            # only the task flow's document is read to validate the entry
+            assert mock_get.call_count == 1
+        assert identity_map.hits == 1
+        assert get_task(task_flow_.root_task.id_) is task_flow_.root_task
+
+        # invalidated by local writes
+        e_info = raises(TaskFlowDelayed, task_flow_.start)
+        task_flow__ = get_task_flow(task_flow.id_)
+        assert task_flow__ is not task_flow_
+        assert task_flow__.root_task.approved
+        b_task = get_task(e_info.value.task.id_)
+        assert get_task(b_task.id_) is b_task
+        assert b_task.task_flow is task_flow__
+
+        task_flow__.refuse(b_task)
+        assert get_task(b_task.id_) is not b_task
+        assert get_task_flow(task_flow.id_).status == constants.TASK_FLOW_REFUSED
+
+        # invalidated by revision
+        task_flow = new_task_flow(A)
+        task_flow_ = get_task_flow(task_flow.id_)
+        doc = self.db.get('id', task_flow_.root_task.id_)
+        doc['approved'] = True
+        self.db.update(doc)
+        assert get_task_flow(task_flow.id_) is task_flow_
+        assert get_task_from_doc(self.task_flow_engine.get_doc(doc['_id'])).approved
+        assert get_task_flow(task_flow.id_) is not task_flow_
+        assert get_task_flow(task_flow.id_).root_task.approved
+
+        # changed by another process
+        doc = self.db.get('id', task_flow.id_)
+        doc['status'] = constants.TASK_FLOW_REFUSED
+        self.db.update(doc)
+        assert get_task_flow(task_flow.id_).status == constants.TASK_FLOW_REFUSED
+
+        # invalidated when the changes are written, even if the entry is built
+        # by another thread before
+        task_flow = new_task_flow(A)
+        with self.task_flow_engine.session():
+            get_task_flow(task_flow.id_).root_task.approve()
+            thread = threading.Thread(target=get_task_flow, args=(task_flow.id_,))
+            thread.start()
+            thread.join()
+            assert not self.db.get('id', task_flow.root_task.id_)['approved']
+        assert get_task_flow(task_flow.id_).root_task.approved
+
+        # bounded
+        for i in xrange(3):
+            get_task_flow(new_task_flow(A).id_)
+        assert len(identity_map) == 4
+
+class TestBulkLoaders(BaseTest):
+
+    def test(self):
+
+        class A(Task):
+
+            @property
+            def tag(self):
+                return 'A'
+
+            @property
+            def dependencies(self):
+                return [B(self.task_flow)]
+        register_task_cls(A)
+
+        class B(Task):
+
+            @property
+            def tag(self):
+                return 'B'
+        register_task_cls(B)
+
+        task_flows = [new_task_flow(A) for i in xrange(3)]
+        b_tasks = []
+        for task_flow in task_flows:
+            try:
+                task_flow.start()
+            except TaskFlowDelayed, e:
+                b_tasks.append(e.task)
+
+        ids = [task_flow.id_ for task_flow in task_flows]
+        with patch.object(self.db, 'get', wraps=self.db.get) as mock_get:
+            task_flows_ = get_task_flows(ids + ids + ['0' * 32])
+            # each task flow and each root task is read once
+            for id_ in ids:
+                assert mock_get.call_args_list.count(((('id', id_), {}))) == 1
+            assert len([call for call in mock_get.call_args_list if call[0][0] == 'task']) == 3
+        assert sorted(task_flows_.keys()) == sorted(ids)
+        for task_flow in task_flows:
+            task_flow_ = task_flows_[task_flow.id_]
+            assert task_flow_.root_task.approved
+            assert task_flow_.root_task.id_ == task_flow.root_task.id_
+
+        tasks = get_tasks([task.id_ for task in b_tasks] + [task_flows[0].root_task.id_])
+        assert len(tasks) == 4
+        for task in b_tasks:
+            assert tasks[task.id_].tag == 'B'
+            assert not tasks[task.id_].approved
+            assert tasks[task.id_].task_flow.id_ == task.task_flow.id_
+        assert tasks[task_flows[0].root_task.id_].task_flow is tasks[b_tasks[0].id_].task_flow
+        assert get_tasks([]) == {}
+
+class TestListTaskFlows(BaseTest):
+
+    def test(self):
+
+        class A(Task):
+
+            @property
+            def tag(self):
+                return 'A'
+
+            def __call__(self):
+                if self.extra_params.get('fail'):
+                    raise RuntimeError()
+        register_task_cls(A)
+
+        class B(Task):
+
+            @property
+            def tag(self):
+                return 'B'
+        register_task_cls(B)
+
+        processing = [new_task_flow(A).id_ for i in xrange(5)]
+        processing_b = [new_task_flow(B).id_ for i in xrange(2)]
+        executed = []
+        for i in xrange(3):
+            task_flow = new_task_flow(A)
+            task_flow.start()
+            executed.append(task_flow.id_)
+        failed = []
+        for i in xrange(2):
+            task_flow = new_task_flow(A, fail=True)
+            raises(RuntimeError, task_flow.start)
+            failed.append(task_flow.id_)
+
+        def _ids(**kwargs):
+            return sorted(task_flow.id_ for task_flow in list_task_flows(**kwargs))
+
+        assert _ids(status=constants.TASK_FLOW_PROCESSING, batch_size=2) == sorted(processing + processing_b)
+        assert _ids(status=constants.TASK_FLOW_PROCESSING, root_task_cls=A, batch_size=2) == sorted(processing)
+        assert _ids(status=constants.TASK_FLOW_EXECUTED, failed=False) == sorted(executed)
+        assert _ids(status=constants.TASK_FLOW_APPROVED, failed=True, batch_size=1) == sorted(failed)
+        assert _ids(failed=True) == sorted(failed)
+        assert _ids(batch_size=3) == sorted(processing + processing_b + executed + failed)
+        assert _ids(status=constants.TASK_FLOW_REFUSED) == []
+        task_flow = list_task_flows(status=constants.TASK_FLOW_EXECUTED).next()
+        assert task_flow.root_task.approved
+
+        # the changes of status are indexed
+        task_flow = get_task_flow(processing[0])
+        task_flow.refuse(task_flow.root_task)
+        assert _ids(status=constants.TASK_FLOW_REFUSED) == [processing[0]]
+        assert processing[0] not in _ids(status=constants.TASK_FLOW_PROCESSING)
+
+        # the entries are iterated with the create time read from the index
+        backend = self.task_flow_engine.backend
+        entries = list(backend.iter_task_flow_ids(constants.TASK_FLOW_PROCESSING, batch_size=2,
+                                                  keyed=True))
+        assert entries == sorted(entries)
+        assert sorted(id_ for _, id_ in entries) == sorted(processing[1:] + processing_b)
+        docs = backend.get_many([id_ for _, id_ in entries])
+        assert all(docs[id_]['create_time'] == create_time for create_time, id_ in entries)
+
+        # the task flows created in the same second are paged by id
+        with patch('lite_task_flow.functions.datetime') as mock_datetime:
+            mock_datetime.now.return_value = datetime(2016, 1, 1)
+            same_second = [new_task_flow(B).id_ for i in xrange(7)]
+        if isinstance(self, MemoryTest):
+            assert _ids(root_task_cls=B, batch_size=2) == sorted(processing_b + same_second)
+            return
+        with patch.object(self.db, 'get_many', wraps=self.db.get_many) as mock_get_many:
+            assert _ids(root_task_cls=B, batch_size=2) == sorted(processing_b + same_second)
+            # each page reads 'batch_size' entries at most
+            assert all(kwargs['limit'] == 2 for args, kwargs in mock_get_many.call_args_list)
+
+class TestPendingTasks(BaseTest):
+
+    def test(self):
+
+        class A(Task):
+
+            @property
+            def tag(self):
+                return 'A'
+
+            @property
+            def dependencies(self):
+                return [B(self.task_flow)]
+        register_task_cls(A)
+
+        class B(Task):
+
+            @property
+            def tag(self):
+                return 'B'
+        register_task_cls(B)
+
+        task_flows = [new_task_flow(A) for i in xrange(5)]
+        assert len(list(pending_tasks(A))) == 5
+        b_tasks = []
+        for task_flow in task_flows:
+            try:
+                task_flow.start()
+            except TaskFlowDelayed, e:
+                b_tasks.append(e.task)
+        assert list(pending_tasks(A)) == []
+        pending = list(pending_tasks(B, batch_size=2))
+        assert sorted(task.id_ for task in pending) == sorted(task.id_ for task in b_tasks)
+        assert all(not task.approved for task in pending)
+
+        task_flows[0].approve(b_tasks[0])
+        task_flows[1].refuse(b_tasks[1])
+        pending = list(pending_tasks(B, batch_size=2))
+        assert sorted(task.id_ for task in pending) == sorted(task.id_ for task in b_tasks[2:])
+
+class TestSQLiteBackend(BaseTest):
+
+    def setup(self):
+        self.path = tempfile.mkdtemp()
+        self.backend = SQLiteBackend(self.path + '/task_flow.db')
+        self.task_flow_engine = TaskFlowEngine(self.backend)
+
+    def teardown(self):
+        shutil.rmtree(self.path)
+
+    def test(self):
+
+        class A(Task):
+
+            @property
+            def tag(self):
+                return 'A'
+
+            @property
+            def dependencies(self):
+                return [B(self.task_flow)]
+        register_task_cls(A)
+
+        class B(Task):
+
+            @property
+            def tag(self):
+                return 'B'
+        register_task_cls(B)
+
+        task_flows = [new_task_flow(A, annotation=u'\u6d4b\u8bd5', a=1) for i in xrange(3)]
+        b_tasks = []
+        for task_flow in task_flows:
+            try:
+                task_flow.start()
+            except TaskFlowDelayed, e:
+                b_tasks.append(e.task)
+        assert sorted(task.id_ for task in pending_tasks(B, batch_size=2)) == \
+            sorted(task.id_ for task in b_tasks)
+
+        task_flows[0].approve(b_tasks[0])
+        task_flows[1].refuse(b_tasks[1])
+        task_flow = get_task_flow(task_flows[0].id_)
+        assert task_flow.status == constants.TASK_FLOW_EXECUTED
+        assert task_flow.annotation == u'\u6d4b\u8bd5'
+        assert task_flow.root_task.extra_params == {'a': 1}
+        assert get_task_flow(task_flows[1].id_).status == constants.TASK_FLOW_REFUSED
+        assert [task.id_ for task in pending_tasks(B)] == [b_tasks[2].id_]
+        assert list(self.backend.iter_pending_task_ids('B', keyed=True)) == \
+            [(self.backend.get(b_tasks[2].id_)['create_time'], b_tasks[2].id_)]
+        assert [task_flow.id_ for task_flow in list_task_flows(status=constants.TASK_FLOW_EXECUTED)] == \
+            [task_flows[0].id_]
+        assert sorted(get_task_flows([task_flow.id_ for task_flow in task_flows])) == \
+            sorted(task_flow.id_ for task_flow in task_flows)
+
+        # a stale revision is refused, and none of a batch is written if one conflicts
+        doc = self.backend.get(task_flows[2].id_)
+        stale = dict(doc)
+        self.backend.update(doc)
+        raises(DocumentConflict, self.backend.update, stale)
+        task_doc = self.backend.get(b_tasks[2].id_)
+        task_doc['approved'] = True
+        event = dict(t=constants.HOOK_EVENT_TYPE_CODE, status=constants.HOOK_EVENT_QUEUED,
+                     create_time='2000-01-01 00:00:00')
+        raises(DocumentConflict, self.backend.update_many, [task_doc, stale], [event])
+        assert not self.backend.get(b_tasks[2].id_)['approved']
+        assert list(self.backend.iter_hook_event_ids(constants.HOOK_EVENT_QUEUED)) == []
+        # the documents inserted are written along with the updates
+        self.backend.update_many([task_doc], [event])
+        assert self.backend.get(b_tasks[2].id_)['approved']
+        assert list(self.backend.iter_hook_event_ids(constants.HOOK_EVENT_QUEUED)) == [event['_id']]
+
+class TestSingleTaskInMemory(MemoryTest, TestSingleTask):
+    pass
+
+class TestMultipleTasksInMemory(MemoryTest, TestMultipleTasks):
+    pass
+
+class TestExecutionInMemory(MemoryTest, TestExecution):
+    pass
+
+class TestDiamondExecutionInMemory(MemoryTest, TestDiamondExecution):
+    pass
+
+class TestConcurrentExecutionInMemory(MemoryTest, TestConcurrentExecution):
+    pass
+
+class TestAsyncTaskFlowInMemory(MemoryTest, TestAsyncTaskFlow):
+    pass
+
+class TestListTaskFlowsInMemory(MemoryTest, TestListTaskFlows):
+    pass
+
+class TestPendingTasksInMemory(MemoryTest, TestPendingTasks):
+    pass
+
+class TestMemoryBackend(MemoryTest, BaseTest):
+
+    def test(self):
+
+        class A(Task):
+
+            @property
+            def tag(self):
+                return 'A'
+        register_task_cls(A)
+
+        raises(DocumentNotFound, self.backend.get, 'foo')
+        raises(DocumentNotFound, self.backend.get_task, 'foo', 'A')
+        assert get_task_flow('foo') is None
+        assert get_task('foo') is None
+
+        task_flow = new_task_flow(A)
+        doc = self.backend.get(task_flow.id_)
+        # the stored document is a copy
+        doc['status'] = constants.TASK_FLOW_EXECUTED
+        assert self.backend.get(task_flow.id_)['status'] == constants.TASK_FLOW_PROCESSING
+        stale = dict(doc)
+        self.backend.update(doc)
+        assert self.backend.get(task_flow.id_)['status'] == constants.TASK_FLOW_EXECUTED
+        raises(DocumentConflict, self.backend.update, stale)
+        task_doc = self.backend.get_task(task_flow.id_, 'A')
+        task_doc['approved'] = True
+        event = dict(t=constants.HOOK_EVENT_TYPE_CODE, status=constants.HOOK_EVENT_QUEUED,
+                     create_time='2000-01-01 00:00:00')
+        raises(DocumentConflict, self.backend.update_many, [task_doc, stale], [event])
+        assert not self.backend.get(task_doc['_id'])['approved']
+        assert list(self.backend.iter_hook_event_ids(constants.HOOK_EVENT_QUEUED)) == []
+
+        # the queries read only their entries, which follow the updates
+        assert list(self.backend.iter_task_flow_ids(constants.TASK_FLOW_EXECUTED)) == [task_flow.id_]
+        assert list(self.backend.iter_task_flow_ids(constants.TASK_FLOW_PROCESSING)) == []
+        assert list(self.backend.iter_pending_task_ids('A')) == [task_doc['_id']]
+        self.backend.update(task_doc)
+        assert list(self.backend.iter_pending_task_ids('A')) == []
+        ids = [new_task_flow(A).id_ for i in xrange(5)]
+        assert sorted(self.backend.iter_task_flow_ids(constants.TASK_FLOW_PROCESSING, batch_size=2)) == sorted(ids)
+        assert sorted(self.backend.iter_pending_task_ids('A', batch_size=2)) == sorted(
+            self.backend.get_task(id_, 'A')['_id'] for id_ in ids)
+
+class TestBenchmark(BaseTest):
+
+    def test(self):
+        from benchmarks import lifecycle, shapes
+
+        for diamond in (False, True):
+            result = lifecycle.run(5, 3, 2, diamond)
+            tasks = shapes.size(3, 2, diamond)
+            assert result['shape']['tasks'] == tasks
+            operations = result['operations']
+            for operation in ('create', 'start', 'execute', 'refuse'):
+                assert operations[operation]['count'] == 5
+            # each task but the root is approved once
+            assert operations['approve']['count'] == 5 * (tasks - 1)
+            assert operations['create']['writes_per_op'] == 2
+
+class TestInstrumentation(BaseTest):
+
+    def setup(self):
+        super(TestInstrumentation, self).setup()
+        self.path = tempfile.mkdtemp()
+        self.exporter = PrometheusTextExporter(self.path + '/task_flow.prom')
+
+        class Recorder(Subscriber):
+
+            def __init__(self):
+                self.storage = []
+                self.spans = []
+
+            def on_storage(self, operation, index):
+                self.storage.append((operation, index))
+
+            def on_span(self, name, seconds, labels):
+                assert seconds >= 0
+                self.spans.append((name, labels))
+
+        self.recorder = Recorder()
+        self.task_flow_engine = TaskFlowEngine(self.db, instrumentation=Instrumentation(
+            [self.recorder, self.exporter]))
+
+    def teardown(self):
+        super(TestInstrumentation, self).teardown()
+        shutil.rmtree(self.path)
+
+    def test(self):
+
+        class A(Task):
+
+            @property
+            def tag(self):
+                return 'A'
+
+            @property
+            def dependencies(self):
+                return [B(self.task_flow)]
+        register_task_cls(A)
+
+        class B(Task):
+
+            @property
+            def tag(self):
+                return 'B'
+        register_task_cls(B)
+
+        task_flow = new_task_flow(A)
+        assert self.recorder.storage == [('insert', 'id'), ('insert', 'id')]
+        e = raises(TaskFlowDelayed, task_flow.start).value
+        assert ('get', 'task_flow_tasks') in self.recorder.storage
+        assert [name for name, labels in self.recorder.spans] == ['find_next_unmet_task', 'retry']
+        self.recorder.spans = []
+        task_flow.approve(e.task)
+        assert self.recorder.spans == [('find_next_unmet_task', {}), ('call', {'task': 'B'}),
+                                       ('call', {'task': 'A'}), ('execute', {'task': 'A'}),
+                                       ('retry', {})]
+        self.recorder.spans = []
+        task_flow.execute()
+        assert self.recorder.spans == [('execute', {'task': 'A'})]
+        list(pending_tasks(B))
+        assert ('query', 'pending_task') in self.recorder.storage
+
+        self.exporter.write()
+        text = open(self.exporter.path).read()
+        assert 'lite_task_flow_storage_operations_total{index="id",operation="insert"} 3' in text
+        assert 'lite_task_flow_span_seconds_count{span="call",task="B"} 1' in text
+        assert 'lite_task_flow_span_seconds_count{span="retry"} 2' in text
+
+class TestProfiler(BaseTest):
+
+    def test(self):
+
+        class A(Task):
+
+            @property
+            def tag(self):
+                return 'A'
+
+            @property
+            def dependencies(self):
+                return [B(self.task_flow), C(self.task_flow)]
+
+            def __call__(self):
+                time.sleep(0.01)
+        register_task_cls(A)
+
+        class B(Task):
+
+            @property
+            def tag(self):
+                return 'B'
+
+            def __call__(self):
+                time.sleep(0.05)
+
+            def after_executed(self):
+                time.sleep(0.01)
+
+        class C(Task):
+
+            @property
+            def tag(self):
+                return 'C'
+
+        task_flow = new_task_flow(A)
+        with profile(task_flow) as report:
+            e = raises(TaskFlowDelayed, task_flow.start).value
+        assert report.tasks == {}
+        e = raises(TaskFlowDelayed, task_flow.approve, e.task).value
+        with profile(task_flow, persist=True) as report:
+            task_flow.approve(e.task)
+        assert task_flow.profile is None
+        assert sorted(report.tasks) == ['A', 'B', 'C']
+        assert report.tasks['B'].calls == 1
+        assert report.tasks['B'].call_wall >= 0.05
+        assert report.tasks['B'].after_executed_wall >= 0.01
+        path, seconds = report.critical_path()
+        assert path == ['B', 'A']
+        assert seconds >= 0.07
+        assert [task_profile.tag for task_profile in report.slowest(2)] == ['B', 'A']
+        assert report.wall >= seconds
+        assert 'B -> A' in report.render()
+
+        doc = self.task_flow_engine.get_doc(task_flow.id_)
+        assert doc['profile']['critical_path'] == ['B', 'A']
+        assert doc['profile']['tasks']['C']['calls'] == 1
+        # the task flow isn't stale after the profile is saved
+        assert task_flow.rev == doc['_rev']
+        task_flow.update()
+
+        # picklable, e.g. for a ProcessPoolExecutor
+        with profile(TaskFlow('foo', '')) as report:
+            report = pickle.loads(pickle.dumps(report))
+            with report.measure(task_flow.root_task, 'call'):
+                pass
+        assert report.tasks['A'].calls == 1
+
+class TestResumeExecution(BaseTest):
+
+    def test(self):
+        from concurrent.futures import ThreadPoolExecutor
+
+        calls = []
+        broken = set(['C'])
+
+        class A(Task):
+
+            @property
+            def tag(self):
+                return 'A'
+
+            @property
+            def dependencies(self):
+                return [B(self.task_flow), C(self.task_flow)]
+
+            def __call__(self):
+                calls.append(self.tag)
+        register_task_cls(A)
+
+        class B(A):
+
+            @property
+            def tag(self):
+                return 'B'
+
+            @property
+            def dependencies(self):
+                return [D(self.task_flow)]
+
+        class C(A):
+
+            @property
+            def tag(self):
+                return 'C'
+
+            @property
+            def dependencies(self):
+                return [D(self.task_flow)]
+
+            def __call__(self):
+                calls.append(self.tag)
+                if self.tag in broken:
+                    raise RuntimeError()
+
+        class D(A):
+
+            @property
+            def tag(self):
+                return 'D'
+
+            @property
+            def dependencies(self):
+                return []
+
+        for executor in (None, ThreadPoolExecutor(max_workers=2)):
+            self.task_flow_engine.executor = executor
+            broken.add('C')
+            task_flow = new_task_flow(A)
+            raises(TaskFlowDelayed, task_flow.start)
+            raises(TaskFlowDelayed, task_flow.approve, B(task_flow))
+            raises(TaskFlowDelayed, task_flow.approve, D(task_flow))
+            del calls[:]
+            raises(RuntimeError, task_flow.approve, C(task_flow))
+            assert 'A' not in calls and sorted(calls) == ['B', 'C', 'D']
+            assert B(task_flow).checkout().executed
+            assert not C(task_flow).checkout().executed
+
+            # resume from C, B and D are not performed again
+            broken.clear()
+            del calls[:]
+            task_flow.execute()
+            assert calls == ['C', 'A']
+            assert task_flow.status == constants.TASK_FLOW_EXECUTED
+            assert not task_flow.failed
+            assert get_task_flow(task_flow.id_).status == constants.TASK_FLOW_EXECUTED
+            assert all(task.checkout().executed for task in (A(task_flow), B(task_flow),
+                                                             C(task_flow), D(task_flow)))
+            del calls[:]
+            task_flow.execute()
+            assert calls == []
+            if executor is not None:
+                executor.shutdown()
+
+        # the task flow is changed by others while it's executed, the tasks
+        # executed aren't performed again when it's retried
+        self.task_flow_engine.executor = None
+        broken.add('C')
+        task_flow = new_task_flow(A)
+        raises(TaskFlowDelayed, task_flow.start)
+        raises(TaskFlowDelayed, task_flow.approve, B(task_flow))
+        raises(TaskFlowDelayed, task_flow.approve, D(task_flow))
+        raises(RuntimeError, task_flow.approve, C(task_flow))
+        broken.clear()
+        backend = self.task_flow_engine.backend
+        stale = get_task_flow(task_flow.id_)
+        backend.update(backend.get(task_flow.id_))
+        del calls[:]
+        original_call = C.__call__
+
+        def _meddle(task):
+            original_call(task)
+            backend.update(backend.get(task_flow.id_))
+
+        with patch.object(C, '__call__', _meddle):
+            stale.execute()
+        assert calls == ['C', 'A']
+        assert stale.status == constants.TASK_FLOW_EXECUTED
+        assert get_task_flow(task_flow.id_).status == constants.TASK_FLOW_EXECUTED
+
+class TestBackgroundExecution(BaseTest):
+
+    def setup(self):
+        self.path = tempfile.mkdtemp()
+        self.backend = SQLiteBackend(self.path + '/task_flow.db')
+        self.task_flow_engine = TaskFlowEngine(self.backend, background_execution=True)
+
+    def teardown(self):
+        shutil.rmtree(self.path)
+
+    def test(self):
+        import multiprocessing
+
+        log_path = self.path + '/executed.log'
+
+        class A(Task):
+
+            @property
+            def tag(self):
+                return 'A'
+
+            @property
+            def dependencies(self):
+                return [B(self.task_flow)]
+
+            def __call__(self):
+                if self.extra_params.get('fail'):
+                    raise RuntimeError()
+                with open(log_path, 'a') as f:
+                    f.write(self.task_flow.id_ + '\n')
+
+        class B(Task):
+
+            @property
+            def tag(self):
+                return 'B'
+
+        def setup():
+            register_task_cls(A)
+
+        setup()
+        task_flow = new_task_flow(A)
+        e = raises(TaskFlowDelayed, task_flow.start).value
+        # the item is written in the transaction of the approval, nothing is
+        # written if it fails
+        with patch.object(self.backend, '_update', side_effect=RuntimeError()):
+            raises(RuntimeError, task_flow.approve, e.task)
+        assert get_task_flow(task_flow.id_).status == constants.TASK_FLOW_PROCESSING
+        assert list(self.task_flow_engine.iter_queue_item_ids(constants.QUEUE_ITEM_QUEUED)) == []
+        # the approval returns at once, the task flow is executed by a worker
+        task_flow = get_task_flow(task_flow.id_)
+        with patch.object(self.backend, 'update_many', wraps=self.backend.update_many) as update_many:
+            task_flow.approve(B(task_flow))
+        assert [doc['t'] for args, _ in update_many.call_args_list for doc in args[1]] == \
+            [constants.QUEUE_ITEM_TYPE_CODE]
+        assert task_flow.status == constants.TASK_FLOW_APPROVED
+        assert not A(task_flow).checkout().executed
+        failed = new_task_flow(A, fail=True)
+        failed.approve(raises(TaskFlowDelayed, failed.start).value.task)
+
+        assert worker.work(drain=True) == 2
+        executed_ids = [task_flow.id_]
+        assert get_task_flow(task_flow.id_).status == constants.TASK_FLOW_EXECUTED
+        assert get_task_flow(failed.id_).failed
+        assert execution_queue.claim() is None
+        failed_ids = list(self.task_flow_engine.iter_queue_item_ids(constants.QUEUE_ITEM_FAILED))
+        assert len(failed_ids) == 1
+        assert 'RuntimeError' in self.backend.get(failed_ids[0])['error']
+
+        # an item is claimed once even if the claimers race
+        task_flow = new_task_flow(A)
+        task_flow.approve(raises(TaskFlowDelayed, task_flow.start).value.task)
+        doc = self.backend.get(next(self.task_flow_engine.iter_queue_item_ids(
+            constants.QUEUE_ITEM_QUEUED)))
+        self.backend.update(dict(doc))
+        doc['status'] = constants.QUEUE_ITEM_CLAIMED
+        raises(DocumentConflict, self.backend.update, doc)
+
+        # the item claimed by a worker died is queued again once its lease expires
+        doc = execution_queue.claim('dead')
+        assert execution_queue.claim() is None
+        doc['claim_time'] = '2016-01-01 00:00:00'
+        self.backend.update(doc)
+        assert execution_queue.execute_next(lease=60)['task_flow_id'] == task_flow.id_
+        executed_ids.append(task_flow.id_)
+        assert get_task_flow(task_flow.id_).status == constants.TASK_FLOW_EXECUTED
+
+        # the workers in several processes
+        task_flow_ids = []
+        for i in xrange(10):
+            task_flow = new_task_flow(A)
+            task_flow.approve(raises(TaskFlowDelayed, task_flow.start).value.task)
+            task_flow_ids.append(task_flow.id_)
+        processes = [multiprocessing.Process(target=worker.work, kwargs=dict(setup=setup, drain=True))
+                     for i in xrange(3)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        executed = open(log_path).read().split()
+        # each task flow is executed exactly once
+        assert sorted(executed) == sorted(executed_ids + task_flow_ids)
+        for task_flow_id in task_flow_ids:
+            assert get_task_flow(task_flow_id).status == constants.TASK_FLOW_EXECUTED
+
+class TestConcurrentApproval(MemoryTest, BaseTest):
+
+    def test(self):
+        calls = []
+        approving = []
+        both_read = threading.Event()
+
+        class A(Task):
+
+            @property
+            def tag(self):
+                return 'A'
+
+            @property
+            def dependencies(self):
+                return [B(self.task_flow)]
+
+            def __call__(self):
+                calls.append(self.tag)
+        register_task_cls(A)
+
+        class B(Task):
+
+            @property
+            def tag(self):
+                return 'B'
+
+            def on_approved(self):
+                # both clerks have read B unapproved before either writes
+                approving.append(self)
+                if len(approving) == 2:
+                    both_read.set()
+                assert both_read.wait(5)
+
+        task_flow = new_task_flow(A)
+        raises(TaskFlowDelayed, task_flow.start)
+        results = []
+
+        def _approve():
+            task_flow_ = get_task_flow(task_flow.id_)
+            try:
+                task_flow_.approve(B(task_flow_))
+                results.append('approved')
+            except TaskAlreadyApproved:
+                results.append('already approved')
+
+        threads = [threading.Thread(target=_approve) for i in xrange(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert sorted(results) == ['already approved', 'approved']
+        # executed only once
+        assert calls == ['A']
+        assert get_task_flow(task_flow.id_).status == constants.TASK_FLOW_EXECUTED
+
+        # retried at most 'conflict_retries' times
+        task_flow = new_task_flow(A)
+        with patch.object(self.backend, 'update_many', side_effect=DocumentConflict()) as mock_update:
+            raises(DocumentConflict, task_flow.start)
+            assert mock_update.call_count == self.task_flow_engine.conflict_retries + 1
+
+        # a clerk can't approve with the task flow refused by another clerk
+        # since it's loaded
+        task_flow = new_task_flow(A)
+        raises(TaskFlowDelayed, task_flow.start)
+        clerk1 = get_task_flow(task_flow.id_)
+        clerk2 = get_task_flow(task_flow.id_)
+        clerk2.refuse(B(clerk2))
+        raises(TaskFlowRefused, clerk1.approve, B(clerk1))
+        assert calls == ['A']
+        assert get_task_flow(task_flow.id_).status == constants.TASK_FLOW_REFUSED
+        # so is a stale task flow updated directly
+        clerk1 = get_task_flow(task_flow.id_)
+        get_task_flow(task_flow.id_).update()
+        clerk1.status = constants.TASK_FLOW_EXECUTED
+        raises(DocumentConflict, clerk1.update)
+
+        # the approval written before the batch conflicts in the middle (the
+        # backend writes the documents one by one) is not approved again
+        task_flow = new_task_flow(A)
+        b_task = raises(TaskFlowDelayed, task_flow.start).value.task
+        update = self.backend.update
+        conflicts = []
+
+        def _update(doc):
+            if doc['_id'] == task_flow.id_ and not conflicts:
+                # the task flow is changed by others after the approval is written
+                conflicts.append(doc)
+                update(self.backend.get(task_flow.id_))
+            return update(doc)
+
+        with patch.object(self.backend, 'update_many',
+                          lambda docs, inserts=(): ([self.backend.update(doc) for doc in docs],
+                                                    self.backend.insert_many(inserts))):
+            with patch.object(self.backend, 'update', side_effect=_update):
+                task_flow.approve(b_task)
+        assert conflicts
+        assert calls == ['A', 'A']
+        assert get_task_flow(task_flow.id_).status == constants.TASK_FLOW_EXECUTED
+
+class TestShardedBackend(BaseTest):
+
+    def setup(self):
+        self.shards = [MemoryBackend() for i in xrange(3)]
+        self.backend = ShardedBackend(self.shards)
+        self.task_flow_engine = TaskFlowEngine(self.backend)
+
+    def teardown(self):
+        pass
+
+    def test(self):
+
+        class A(Task):
+
+            @property
+            def tag(self):
+                return 'A'
+
+            @property
+            def dependencies(self):
+                return [B(self.task_flow)]
+        register_task_cls(A)
+
+        class B(Task):
+
+            @property
+            def tag(self):
+                return 'B'
+        register_task_cls(B)
+
+        task_flows = [new_task_flow(A) for i in xrange(30)]
+        b_tasks = [raises(TaskFlowDelayed, task_flow.start).value.task for task_flow in task_flows]
+        # the task flows are spread, and the tasks are in their task flow's shard
+        assert all(len(shard) for shard in self.shards)
+        for task_flow, b_task in zip(task_flows, b_tasks):
+            shard = self.backend.shard(task_flow.id_)
+            assert shard.get(task_flow.id_)
+            assert shard.get(b_task.id_)
+            assert shard.get(task_flow.root_task.id_)
+            assert get_task(b_task.id_).tag == 'B'
+
+        for task_flow, b_task in zip(task_flows[:4], b_tasks[:4]):
+            task_flow.approve(b_task)
+        assert sorted(get_task_flows([task_flow.id_ for task_flow in task_flows])) == \
+            sorted(task_flow.id_ for task_flow in task_flows)
+
+        def _ids(iterable):
+            return sorted(item.id_ for item in iterable)
+
+        assert _ids(list_task_flows(status=constants.TASK_FLOW_EXECUTED, batch_size=2)) == \
+            _ids(task_flows[:4])
+        assert _ids(list_task_flows(batch_size=5)) == _ids(task_flows)
+        assert _ids(pending_tasks(B, batch_size=2)) == _ids(b_tasks[4:])
+        # merged by create time
+        docs = [self.backend.get(task_flow.id_) for task_flow in list_task_flows(
+            status=constants.TASK_FLOW_PROCESSING, batch_size=2)]
+        assert [doc['create_time'] for doc in docs] == sorted(doc['create_time'] for doc in docs)
+        # read from the shards' indexes, not their documents
+        with patch.object(MemoryBackend, 'get_many') as mock_get_many:
+            ids = list(self.backend.iter_task_flow_ids(constants.TASK_FLOW_PROCESSING, batch_size=2))
+            assert not mock_get_many.called
+        assert ids == [doc['_id'] for doc in docs]
+
+class TestLongChain(MemoryTest, BaseTest):
+
+    def test(self):
+        from benchmarks import shapes
+
+        depth = 10000
+        refused = []
+
+        class Chain(shapes.task_cls(depth, 1)):
+
+            def __init__(self, task_flow, **kwargs):
+                super(Chain, self).__init__(task_flow, **kwargs)
+                # all the dependencies are approved but the deepest one
+                self.approved = 0 < self.level < depth - 1
+
+            def on_refused(self, caused):
+                refused.append((self.tag, caused))
+        register_task_cls(Chain)
+
+        task_flow = new_task_flow(Chain)
+        plan = ExecutionPlan(task_flow.root_task)
+        assert len(plan.order) == depth
+        assert plan.order[0] == 'n%d_0' % (depth - 1)
+        assert plan.order[-1] == 'n0_0'
+        assert task_flow._find_next_unmet_task(Chain(task_flow, level=1), {}).level == depth - 1
+
+        e = raises(TaskFlowDelayed, task_flow.start).value
+        assert e.task.level == depth - 1
+
+        task_flow = new_task_flow(Chain)
+        task_flow.refuse(task_flow.root_task)
+        assert len(refused) == depth
+        assert refused[0] == ('n0_0', True)
+        assert not any(caused for tag, caused in refused[1:])
+
+class TestDependencyCycle(MemoryTest, BaseTest):
+
+    def test(self):
+
+        class A(Task):
+
+            @property
+            def tag(self):
+                return 'A'
+
+            @property
+            def dependencies(self):
+                return [B(self.task_flow)]
+        register_task_cls(A)
+
+        class B(Task):
+
+            @property
+            def tag(self):
+                return 'B'
+
+            @property
+            def dependencies(self):
+                return [C(self.task_flow)]
+        register_task_cls(B)
+
+        class C(Task):
+
+            @property
+            def tag(self):
+                return 'C'
+
+            @property
+            def dependencies(self):
+                return [B(self.task_flow)]
+        register_task_cls(C)
+
+        task_flow = new_task_flow(A)
+        e = raises(DependencyCycle, ExecutionPlan, task_flow.root_task).value
+        assert e.tags == ['B', 'C', 'B']
+        assert 'B -> C -> B' in str(e)
+        raises(DependencyCycle, new_task_flow(A).refuse, task_flow.root_task)
+
+        # the task flow could be approved until the cycle is reached
+        e = raises(TaskFlowDelayed, task_flow.start).value
+        assert e.task.tag == 'B'
+        e = raises(TaskFlowDelayed, task_flow.approve, e.task).value
+        assert e.task.tag == 'C'
+        raises(DependencyCycle, task_flow.approve, e.task)
+
+class TestGraphTemplate(MemoryTest, BaseTest):
+
+    def test(self):
+        GraphTemplate.clear()
+        walked = []
+        calls = []
+
+        class A(Task):
+
+            static_dependencies = True
+
+            @property
+            def tag(self):
+                return 'A'
+
+            @property
+            def dependencies(self):
+                walked.append(self.tag)
+                return [B(self.task_flow, **self.extra_params), C(self.task_flow)]
+
+            def __call__(self):
+                calls.append(self.tag)
+        register_task_cls(A)
+
+        class B(Task):
+
+            @property
+            def tag(self):
+                return 'B'
+
+            @property
+            def dependencies(self):
+                walked.append(self.tag)
+                return [C(self.task_flow)]
+
+            def __call__(self):
+                calls.append((self.tag, self.extra_params['n']))
+        register_task_cls(B)
+
+        class C(Task):
+
+            @property
+            def tag(self):
+                return 'C'
+
+            @property
+            def dependencies(self):
+                walked.append(self.tag)
+                return []
+
+            def __call__(self):
+                calls.append(self.tag)
+        register_task_cls(C)
+
+        for i in xrange(3):
+            task_flow = new_task_flow(A, n=1)
+            e = raises(TaskFlowDelayed, task_flow.start).value
+            assert e.task.tag == 'B'
+            e = raises(TaskFlowDelayed, task_flow.approve, e.task).value
+            assert e.task.tag == 'C'
+            task_flow.approve(e.task)
+        assert calls == ['C', ('B', 1), 'A'] * 3
+        # compiled once for all the task flows
+        assert sorted(walked) == ['A', 'B', 'C']
+        plan = task_flow.execution_plan()
+        assert plan.order == ['C', 'B', 'A']
+        assert plan.dependencies == {'A': ['B', 'C'], 'B': ['C'], 'C': []}
+        assert plan.tasks['B'].extra_params == {'n': 1}
+
+        # compiled again for the different extra params
+        task_flow = new_task_flow(A, n=2)
+        assert ExecutionPlan(task_flow.root_task).tasks['B'].extra_params == {'n': 2}
+        assert len(walked) == 6
+        assert len(GraphTemplate.of(task_flow.root_task)) == 3
+
+class TestApproveMany(MemoryTest, BaseTest):
+
+    def test(self):
+        from concurrent.futures import ThreadPoolExecutor
+
+        calls = []
+
+        class A(Task):
+
+            @property
+            def tag(self):
+                return 'A'
+
+            @property
+            def dependencies(self):
+                return [B(self.task_flow), C(self.task_flow)]
+
+            def __call__(self):
+                if self.extra_params.get('fail'):
+                    raise RuntimeError('failed')
+                calls.append(self.task_flow.id_)
+        register_task_cls(A)
+
+        class B(Task):
+
+            @property
+            def tag(self):
+                return 'B'
+        register_task_cls(B)
+
+        class C(Task):
+
+            @property
+            def tag(self):
+                return 'C'
+        register_task_cls(C)
+
+        def _start(task_flow):
+            return raises(TaskFlowDelayed, task_flow.start).value.task
+
+        executed, delayed, refused, failed = [new_task_flow(A) for i in xrange(3)] + \
+            [new_task_flow(A, fail=True)]
+        c_tasks = [raises(TaskFlowDelayed, task_flow.approve, _start(task_flow)).value.task
+                   for task_flow in [executed, failed]]
+        b_task = _start(delayed)
+        refused_task = _start(refused)
+        refused.refuse(refused_task)
+        unsubmitted = new_task_flow(A)
+        _start(unsubmitted)
+
+        with patch.object(TaskFlow, 'retry', autospec=True, side_effect=TaskFlow.retry) as mock_retry:
+            outcomes = approve_many([c_tasks[0], b_task, refused_task, b_task, C(unsubmitted),
+                                     c_tasks[1]], ThreadPoolExecutor(2))
+            # retried once per task flow
+            assert mock_retry.call_count == 4
+        assert [outcome.status for outcome in outcomes] == [
+            constants.APPROVAL_EXECUTED, constants.APPROVAL_DELAYED, constants.APPROVAL_REFUSED,
+            constants.APPROVAL_ALREADY_APPROVED, constants.APPROVAL_UNSUBMITTED,
+            constants.APPROVAL_FAILED]
+        assert outcomes[1].unmet_task.tag == 'C'
+        assert str(outcomes[5].error) == 'failed'
+        assert calls == [executed.id_]
+        assert get_task_flow(executed.id_).status == constants.TASK_FLOW_EXECUTED
+        assert get_task_flow(failed.id_).failed
+
+        # approved in one batch, and retried once
+        outcomes = approve_many([outcomes[1].unmet_task])
+        assert outcomes[0].status == constants.APPROVAL_EXECUTED
+        assert calls == [executed.id_, delayed.id_]
+
+class TestBulkCreation(BaseTest):
+
+    def test(self):
+
+        class A(Task):
+
+            @property
+            def tag(self):
+                return 'A%d' % self.extra_params['n']
+
+            @property
+            def dependencies(self):
+                return [B(self.task_flow)]
+        register_task_cls(A)
+
+        class B(Task):
+
+            @property
+            def tag(self):
+                return 'B'
+        register_task_cls(B)
+
+        consumed = []
+        live = []
+        executed = []
+
+        def _params():
+            for n in xrange(250):
+                consumed.append(n)
+                if n == 150:
+                    # created by others meanwhile, it's indexed as usual
+                    task_flow = new_task_flow(A, n=n)
+                    live.append(task_flow.id_ in [task_flow_.id_ for task_flow_ in list_task_flows(
+                        status=constants.TASK_FLOW_PROCESSING, root_task_cls=A)])
+                yield dict(n=n)
+
+        for defer_indexes in [False, True]:
+            del consumed[:]
+            handles = new_task_flows(A, _params(), annotation='bulk', chunk_size=100,
+                                     defer_indexes=defer_indexes)
+            assert len(handles) == len(consumed) == 250
+            task_flow = handles[7].load()
+            assert task_flow.annotation == 'bulk'
+            assert task_flow.root_task.tag == 'A7'
+            assert task_flow.root_task.id_ == handles[7].root_task_id
+            assert get_task(handles[7].root_task_id).extra_params == {'n': 7}
+            b_task = raises(TaskFlowDelayed, task_flow.start).value.task
+            task_flow.approve(b_task)
+            assert get_task_flow(handles[7].id_).status == constants.TASK_FLOW_EXECUTED
+            executed.append(handles[7].id_)
+            # the indexes are up to date
+            assert sorted(task_flow.id_ for task_flow in list_task_flows(
+                status=constants.TASK_FLOW_EXECUTED)) == sorted(executed)
+            assert len(list(list_task_flows(status=constants.TASK_FLOW_PROCESSING,
+                                            root_task_cls=A))) == 250 * (defer_indexes + 1)
+        assert live == [True, True]
+
+class TestBulkCreationInMemory(MemoryTest, TestBulkCreation):
+    pass
+
+class TestBulkCreationInSQLite(TestBulkCreation):
+
+    def setup(self):
+        self.path = tempfile.mkdtemp()
+        self.task_flow_engine = TaskFlowEngine(SQLiteBackend(self.path + '/task_flow.db'))
+
+    def teardown(self):
+        shutil.rmtree(self.path)
+
+    def test_indexes_kept(self):
+        import sqlite3
+
+        def _indexes():
+            connection = sqlite3.connect(self.path + '/task_flow.db')
+            try:
+                return set(row[0] for row in connection.execute(
+                    "SELECT name FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL"))
+            finally:
+                connection.close()
+
+        indexes = _indexes()
+        assert 'task_index' in indexes
+        # the other connections aren't affected by a bulk insert
+        with self.task_flow_engine.deferred_indexes():
+            assert _indexes() == indexes
+
+class TestHookDispatcher(BaseTest):
+
+    def setup(self):
+        self.backend = MemoryBackend()
+        self.dispatcher = HookDispatcher(concurrency={'on_approved': 1}, max_attempts=2,
+                                         retry_delay=0)
+        self.task_flow_engine = TaskFlowEngine(self.backend, hook_dispatcher=self.dispatcher)
+
+    def teardown(self):
+        pass
+
+    def test(self):
+        calls = []
+        failures = []
+        gate = threading.Event()
+
+        class A(Task):
+
+            @property
+            def tag(self):
+                return 'A'
+
+            @property
+            def dependencies(self):
+                return [B(self.task_flow, **self.extra_params)]
+
+            def on_delayed(self, unmet_task):
+                calls.append(('on_delayed', self.tag, unmet_task.tag))
+
+            def after_executed(self):
+                calls.append(('after_executed', self.tag))
+
+            def on_refused(self, caused_by_me):
+                calls.append(('on_refused', self.tag, caused_by_me))
+        register_task_cls(A)
+
+        class B(Task):
+
+            @property
+            def tag(self):
+                return 'B'
+
+            def on_approved(self):
+                if self.extra_params.get('fail') and not failures:
+                    failures.append(self.tag)
+                    raise RuntimeError('failed')
+                if self.extra_params.get('slow'):
+                    assert gate.wait(5)
+                calls.append(('on_approved', self.tag, self.approved))
+        register_task_cls(B)
+
+        task_flow = new_task_flow(A, fail=True)
+        b_task = raises(TaskFlowDelayed, task_flow.start).value.task
+        task_flow.approve(b_task)
+        assert get_task_flow(task_flow.id_).status == constants.TASK_FLOW_EXECUTED
+        # not invoked inline
+        assert calls == []
+
+        # the failed one is delivered again
+        assert self.dispatcher.run(drain=True) == 6
+        assert failures == ['B']
+        assert sorted(calls) == sorted([('on_delayed', 'A', 'B'), ('on_approved', 'B', True),
+                                        ('after_executed', 'A')])
+        assert len(list(self.backend.iter_hook_event_ids(constants.HOOK_EVENT_DELIVERED))) == 5
+
+        # the events of the changes failed to write are never delivered
+        del calls[:]
+        task_flow = new_task_flow(A)
+        b_task = raises(TaskFlowDelayed, task_flow.start).value.task
+        with patch.object(self.backend, 'update_many', side_effect=DocumentConflict()):
+            raises(DocumentConflict, task_flow.approve, b_task)
+        # nothing is left by the attempts, the events are of the start
+        ids = list(self.backend.iter_hook_event_ids(constants.HOOK_EVENT_QUEUED))
+        assert sorted(doc['hook'] for doc in self.backend.get_many(ids).values()) == \
+            ['on_approved', 'on_delayed']
+        task_flow.refuse(b_task)
+        self.dispatcher.start(poll_interval=0.01)
+        for i in xrange(100):
+            if len(calls) == 2:
+                break
+            time.sleep(0.05)
+        self.dispatcher.stop()
+        assert sorted(calls) == [('on_delayed', 'A', 'B'), ('on_refused', 'A', False)]
+
+        # a failed event waits before delivered again
+        while self.dispatcher.deliver():
+            pass
+        del calls[:]
+        del failures[:]
+        self.dispatcher.retry_delay = 60
+        task_flow = new_task_flow(A, fail=True)
+        b_task = raises(TaskFlowDelayed, task_flow.start).value.task
+        task_flow.approve(b_task)
+        # one 'on_approved' is delivered in a batch
+        assert self.dispatcher.deliver() + self.dispatcher.deliver() == 5
+        assert failures == ['B']
+        # the event isn't read before it's due
+        with patch.object(self.backend, 'get_many', wraps=self.backend.get_many) as get_many:
+            assert self.dispatcher.deliver() == 0
+        assert not get_many.called
+        with patch('lite_task_flow.hooks.datetime') as mock_datetime:
+            mock_datetime.now.return_value = datetime.now() + timedelta(seconds=59)
+            assert self.dispatcher.deliver() == 0
+            mock_datetime.now.return_value = datetime.now() + timedelta(seconds=61)
+            assert self.dispatcher.deliver() == 1
+        assert ('on_approved', 'B', True) in calls
+
+        # a slow hook doesn't hold back the results of the others
+        task_flow = new_task_flow(A, slow=True)
+        b_task = raises(TaskFlowDelayed, task_flow.start).value.task
+        while self.dispatcher.deliver():
+            pass
+        del calls[:]
+        with patch.object(self.backend, 'update_many', wraps=self.backend.update_many) as update_many:
+            task_flow.approve(b_task)
+        # the events are inserted along with the changes
+        assert sorted(doc['hook'] for args, _ in update_many.call_args_list for doc in args[1]) == \
+            ['after_executed', 'after_executed', 'on_approved']
+        assert self.dispatcher.deliver(wait=False) == 3
+        for i in xrange(100):
+            self.dispatcher.deliver(wait=False)
+            ids = list(self.backend.iter_hook_event_ids(constants.HOOK_EVENT_CLAIMED))
+            if len(ids) == 1:
+                break
+            time.sleep(0.01)
+        assert [doc['hook'] for doc in self.backend.get_many(ids).values()] == ['on_approved']
+        assert calls == [('after_executed', 'A')]
+        gate.set()
+        assert self.dispatcher.wait(5)
+        assert calls == [('after_executed', 'A'), ('on_approved', 'B', True)]
+        assert list(self.backend.iter_hook_event_ids(constants.HOOK_EVENT_CLAIMED)) == []
+
+class TestHookDispatcherInSQLite(TestHookDispatcher):
+
+    def setup(self):
+        self.path = tempfile.mkdtemp()
+        self.backend = SQLiteBackend(self.path + '/task_flow.db')
+        self.dispatcher = HookDispatcher(concurrency={'on_approved': 1}, max_attempts=2,
+                                         retry_delay=0)
+        self.task_flow_engine = TaskFlowEngine(self.backend, hook_dispatcher=self.dispatcher)
+
+    def teardown(self):
+        shutil.rmtree(self.path)
+
+class TestHookDispatcherInCodernity(TestHookDispatcher):
+
+    def setup(self):
+        BaseTest.setup(self)
+        self.dispatcher = HookDispatcher(concurrency={'on_approved': 1}, max_attempts=2,
+                                         retry_delay=0)
+        self.task_flow_engine = TaskFlowEngine(self.db, hook_dispatcher=self.dispatcher)
+        self.backend = self.task_flow_engine.backend
+
+    def teardown(self):
+        BaseTest.teardown(self)
+
+class TestTimeoutScheduler(BaseTest):
+
+    def test(self):
+        from datetime import datetime, timedelta
+
+        timeouts = []
+        dep_classes = {}
+
+        class A(Task):
+
+            @property
+            def tag(self):
+                return 'A'
+
+            @property
+            def dependencies(self):
+                return [dep_classes[self.extra_params['dep']](self.task_flow)]
+        register_task_cls(A)
+
+        class Escalated(Task):
+
+            timeout = 60
+
+            @property
+            def tag(self):
+                return 'escalated'
+
+            def on_timeout(self):
+                timeouts.append((self.task_flow.id_, self.tag))
+        register_task_cls(Escalated)
+
+        class Refused(Escalated):
+
+            timeout = 30
+            refuse_on_timeout = True
+
+            @property
+            def tag(self):
+                return 'refused'
+        register_task_cls(Refused)
+
+        dep_classes.update(escalated=Escalated, refused=Refused)
+
+        def _start(dep):
+            task_flow = new_task_flow(A, dep=dep)
+            return task_flow, raises(TaskFlowDelayed, task_flow.start).value.task
+
+        escalated, escalated_task = _start('escalated')
+        approved, approved_task = _start('escalated')
+        refused, refused_task = _start('refused')
+        approved.approve(approved_task)
+
+        scheduler = TimeoutScheduler(batch_size=2)
+        now = datetime.now()
+        assert scheduler.fire_due(now) == 0
+        # the earliest one
+        assert timedelta(seconds=28) <= scheduler.next_due_time() - now <= timedelta(seconds=31)
+
+        assert scheduler.fire_due(now + timedelta(seconds=45)) == 1
+        assert timeouts == [(refused.id_, 'refused')]
+        assert get_task_flow(refused.id_).status == constants.TASK_FLOW_REFUSED
+
+        assert scheduler.fire_due(now + timedelta(seconds=90)) == 2
+        assert timeouts == [(refused.id_, 'refused'), (escalated.id_, 'escalated')]
+        assert get_task_flow(escalated.id_).status == constants.TASK_FLOW_PROCESSING
+        # the timer of the task approved is discarded
+        assert len(list(self.task_flow_engine.iter_timer_ids(constants.TIMER_DISCARDED))) == 1
+        assert scheduler.next_due_time() is None
+        assert scheduler.fire_due(now + timedelta(seconds=90)) == 0
+
+class TestTimeoutSchedulerInMemory(MemoryTest, TestTimeoutScheduler):
+    pass
+
+class TestTimeoutSchedulerInSQLite(TestTimeoutScheduler):
+
+    def setup(self):
+        self.path = tempfile.mkdtemp()
+        self.task_flow_engine = TaskFlowEngine(SQLiteBackend(self.path + '/task_flow.db'))
+
+    def teardown(self):
+        shutil.rmtree(self.path)
+
+class TestTransitionLog(BaseTest):
+
+    def setup(self):
+        self.path = tempfile.mkdtemp()
+        self.log = TransitionLog(self.path + '/log', segment_size=300)
+        self.task_flow_engine = TaskFlowEngine(MemoryBackend(), transition_log=self.log)
+
+    def teardown(self):
+        shutil.rmtree(self.path)
+
+    def test(self):
+
+        class A(Task):
+
+            @property
+            def tag(self):
+                return 'A'
+
+            @property
+            def dependencies(self):
+                return [B(self.task_flow)]
+
+            def __call__(self):
+                if self.extra_params.get('fail'):
+                    raise RuntimeError('failed')
+        register_task_cls(A)
+
+        class B(Task):
+
+            @property
+            def tag(self):
+                return 'B'
+        register_task_cls(B)
+
+        def _events(from_offset=0):
+            return [(record['event'], record['task_flow_id'], record.get('tag')) for offset, record in
+                    self.log.follow(from_offset, wait=False)]
+
+        executed = new_task_flow(A)
+        b_task = raises(TaskFlowDelayed, executed.start).value.task
+        executed.approve(b_task)
+        assert _events() == [('task_saved', executed.id_, 'A'),
+                             ('task_approved', executed.id_, 'A'),
+                             ('task_saved', executed.id_, 'B'),
+                             ('task_approved', executed.id_, 'B'),
+                             ('task_flow_approved', executed.id_, None),
+                             ('task_flow_executed', executed.id_, None)]
+        offset = self.log.end_offset
+
+        failed = new_task_flow(A, fail=True)
+        b_task = raises(TaskFlowDelayed, failed.start).value.task
+        raises(RuntimeError, failed.approve, b_task)
+        refused = new_task_flow(A)
+        refused.refuse(refused.root_task)
+        # the transitions failed to write are not appended
+        conflicted = new_task_flow(A)
+        with patch.object(self.task_flow_engine.backend, 'update_many', side_effect=DocumentConflict()):
+            raises(DocumentConflict, conflicted.start)
+        assert _events(offset) == [('task_saved', failed.id_, 'A'),
+                                   ('task_approved', failed.id_, 'A'),
+                                   ('task_saved', failed.id_, 'B'),
+                                   ('task_approved', failed.id_, 'B'),
+                                   ('task_flow_approved', failed.id_, None),
+                                   ('task_flow_failed', failed.id_, None),
+                                   ('task_saved', refused.id_, 'A'),
+                                   ('task_flow_refused', refused.id_, None),
+                                   ('task_saved', conflicted.id_, 'A')]
+        assert len([name for name in os.listdir(self.path + '/log') if name.endswith('.log')]) > 1
+        # resumed from any offset yielded
+        offsets = [offset for offset, record in self.log.follow(wait=False)]
+        assert [offset for offset, record in self.log.follow(offsets[4], wait=False)] == offsets[5:]
+
+        # tail the log
+        records = self.log.follow(self.log.end_offset, poll_interval=0.01)
+        threading.Timer(0.05, new_task_flow, (A,)).start()
+        offset, record = next(records)
+        assert record['event'] == 'task_saved'
+        assert offset == self.log.end_offset
+
+    def test_processes(self):
+        import multiprocessing
+        path = self.path + '/processes'
+        parent_log = TransitionLog(path, segment_size=300)
+
+        def append(name):
+            # one log opened in the process, the other inherited from the parent
+            log = TransitionLog(path, segment_size=300)
+            for i in xrange(50):
+                log.log('task_saved', name, tag=str(i))
+                parent_log.log('task_approved', name, tag=str(i))
+
+        parent_log.log('task_saved', 'parent')
+        processes = [multiprocessing.Process(target=append, args=(str(i),)) for i in xrange(4)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+            assert process.exitcode == 0
+        parent_log.log('task_saved', 'parent')
+
+        records = list(parent_log.follow(wait=False))
+        assert len(records) == 2 + 4 * 50 * 2
+        assert records[-1][0] == parent_log.end_offset
+        assert records[-1][1]['task_flow_id'] == 'parent'
+        for name in ('0', '1', '2', '3'):
+            for event in ('task_saved', 'task_approved'):
+                assert [record['tag'] for offset, record in records
+                        if (record['event'], record['task_flow_id']) == (event, name)] == \
+                    [str(i) for i in xrange(50)]
+        # each segment is started by one process, right after the last record
+        # of the segment before it
+        bases = sorted(int(name[:-4]) for name in os.listdir(path) if name.endswith('.log'))
+        assert len(bases) > 4
+        for base, next_base in zip(bases, bases[1:]):
+            assert os.path.getsize(path + '/%020d.log' % base) == next_base - base
+
+
+class TestIndexUpgrade(BaseTest):
+
+    def setup(self):
+        # a database created by the version which has the task index only
+        self.db = Database(tempfile.mkdtemp())
+        self.db.create()
+        self.db.add_index(TaskIndex(self.db.path, 'task'))
+        self.task_flow_engine = TaskFlowEngine(self.db)
+
+    def test(self):
+
+        class A(Task):
+
+            @property
+            def tag(self):
+                return 'A'
+
+            @property
+            def dependencies(self):
+                return [B(self.task_flow)]
+        register_task_cls(A)
+
+        class B(Task):
+
+            @property
+            def tag(self):
+                return 'B'
+        register_task_cls(B)
+
+        task_flow = new_task_flow(A)
+        raises(IndexNotFoundException, task_flow.load_task_docs)
+        add_index(self.db)
+        # the indexes added are built from the documents stored
+        assert [task_flow_.id_ for task_flow_ in list_task_flows()] == [task_flow.id_]
+        b_task = raises(TaskFlowDelayed, task_flow.start).value.task
+        assert [task.id_ for task in pending_tasks(B)] == [b_task.id_]
+        # the indexes the database has are skipped
+        add_index(self.db)
+        task_flow.approve(b_task)
+        assert get_task_flow(task_flow.id_).status == constants.TASK_FLOW_EXECUTED
+
+if __name__ == "__main__":
+    TestSingleTask().run_plainly()
+    TestMultipleTasks().run_plainly()
+    TestExecution().run_plainly()
+    TestLoadTaskDocs().run_plainly()
+    TestDiamondExecution().run_plainly()
+    TestConcurrentExecution().run_plainly()
+    TestAsyncTaskFlow().run_plainly()
+    TestSession().run_plainly()
+    TestIdentityMap().run_plainly()
+    TestBulkLoaders().run_plainly()
+    TestListTaskFlows().run_plainly()
+    TestPendingTasks().run_plainly()
+    TestSQLiteBackend().run_plainly()
+    TestSingleTaskInMemory().run_plainly()
+    TestMultipleTasksInMemory().run_plainly()
+    TestExecutionInMemory().run_plainly()
+    TestDiamondExecutionInMemory().run_plainly()
+    TestConcurrentExecutionInMemory().run_plainly()
+    TestAsyncTaskFlowInMemory().run_plainly()
+    TestListTaskFlowsInMemory().run_plainly()
+    TestPendingTasksInMemory().run_plainly()
+    TestMemoryBackend().run_plainly()
+    TestBenchmark().run_plainly()
+    TestInstrumentation().run_plainly()
+    TestProfiler().run_plainly()
+    TestResumeExecution().run_plainly()
+
+    TestBackgroundExecution().run_plainly()
+
+    TestConcurrentApproval().run_plainly()
+
+    TestShardedBackend().run_plainly()
 
+    TestLongChain().run_plainly()
+    TestDependencyCycle().run_plainly()
+    TestGraphTemplate().run_plainly()
+    TestApproveMany().run_plainly()
+    TestBulkCreation().run_plainly()
+    TestBulkCreationInMemory().run_plainly()
+    TestBulkCreationInSQLite().run_plainly()
+    TestHookDispatcher().run_plainly()
+    TestHookDispatcherInSQLite().run_plainly()
+    TestHookDispatcherInCodernity().run_plainly()
+    TestTimeoutScheduler().run_plainly()
+    TestTimeoutSchedulerInMemory().run_plainly()
+    TestTimeoutSchedulerInSQLite().run_plainly()
+    TestTransitionLog().run_plainly()
+    TestIndexUpgrade().run_plainly()
+    TestProcessPoolExecution().run_plainly()